@@ -20,6 +20,19 @@
 
 
 if __name__ == '__main__':
-    from wishcalc import main
     import sys
-    sys.exit(main(sys.argv))
+
+    # до импорта всего остального, иначе замерять будет нечего
+    from wcperf import startupProfiler
+    startupProfiler.enable_from_cmdline(sys.argv)
+
+    # при запуске из архива ZIP модули и ресурсы по возможности
+    # берутся из распакованной копии; use_app_cache() меняет sys.argv[0],
+    # потому для разбора командной строки - оригинал
+    args = list(sys.argv)
+
+    from wcappcache import use_app_cache
+    use_app_cache(sys.argv)
+
+    from wishcalc import main
+    sys.exit(main(args))
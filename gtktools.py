@@ -27,14 +27,26 @@ gi_require_version('Gtk', '3.0')
 # если сей модуль, gtktools, указать первым перед прочими связанными
 # с GTK модулями - не придётся из оттудова дёргать gi_require_version()
 from gi.repository import Gtk, Gdk, GObject, GLib, Pango, Gio
-from gi.repository.GdkPixbuf import Pixbuf
+from gi.repository.GdkPixbuf import Pixbuf, Colorspace
 
 
 # для *ResourceLoader
 import zipfile
+import mmap
+from collections import OrderedDict
 from sys import stderr, argv
 import os.path
 
+# для PixbufCache
+import os
+import struct
+import hashlib
+import shutil
+import threading
+
+# для параллельной загрузки изображений
+from concurrent.futures import ThreadPoolExecutor
+
 
 REVISION = 2020112600
 
@@ -353,6 +365,147 @@ def get_resource_loader():
     return ZipFileResourceLoader(appFilePath) if appIsZIP else FileResourceLoader(appFilePath);
 
 
+class PixbufCache():
+    """Дисковый кэш растеризованных изображений.
+
+    Изображения хранятся "как есть" - в виде массива пикселов
+    с небольшим заголовком, чтобы при загрузке не тратить время
+    ни на рендеринг SVG, ни на распаковку PNG.
+
+    Файлы кэша лежат в подкаталоге с именем версии программы,
+    подкаталоги прочих версий удаляются при создании нового.
+    Имена файлов - хэши ключей, поэтому ключ должен включать всё,
+    от чего зависит содержимое изображения (имя ресурса, размеры,
+    масштаб, "подпись" исходного файла и т.п.).
+
+    Ошибки чтения/записи кэша исключений не генерируют - в худшем
+    случае изображение просто будет создано заново."""
+
+    # сигнатура, ширина, высота, rowstride, альфа-канал, бит на канал
+    HEADER = struct.Struct('<4sIIIBB')
+    SIGNATURE = b'WCPB'
+
+    FILE_EXT = '.pixbuf'
+
+    def __init__(self, cachedir, version):
+        """cachedir   - путь к каталогу кэша (может ещё не существовать);
+        version     - строка с версией программы."""
+
+        self.rootDir = cachedir
+        self.cacheDir = os.path.join(cachedir, version)
+        self.version = version
+
+        # None - каталог ещё не проверяли, False - писать некуда
+        self.writable = None
+
+        self.__lock = threading.Lock()
+
+    def get_cache_filename(self, key):
+        """Возвращает полный путь к файлу кэша для ключа key
+        (кортежа или строки)."""
+
+        return os.path.join(self.cacheDir,
+            hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + self.FILE_EXT)
+
+    def get(self, key):
+        """Возвращает экземпляр Pixbuf, если в кэше есть изображение
+        с ключом key, иначе - None."""
+
+        try:
+            with open(self.get_cache_filename(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        if len(data) < self.HEADER.size:
+            return None
+
+        signature, width, height, rowstride, hasalpha, bps = self.HEADER.unpack_from(data)
+
+        if signature != self.SIGNATURE:
+            return None
+
+        if width <= 0 or height <= 0:
+            return None
+
+        # у последней строки выравнивания может и не быть
+        # (см. Pixbuf.get_byte_length())
+        pixels = data[self.HEADER.size:]
+        if len(pixels) < (height - 1) * rowstride + width * (4 if hasalpha else 3) * bps // 8:
+            return None
+
+        return Pixbuf.new_from_bytes(GLib.Bytes.new(pixels),
+            Colorspace.RGB, bool(hasalpha), bps,
+            width, height, rowstride)
+
+    def __prepare_dir(self):
+        """Создание каталога кэша текущей версии и удаление
+        каталогов прочих версий. Возвращает булевское значение -
+        можно ли писать в кэш."""
+
+        with self.__lock:
+            if self.writable is None:
+                try:
+                    if not os.path.exists(self.cacheDir):
+                        if os.path.isdir(self.rootDir):
+                            for dname in os.listdir(self.rootDir):
+                                dpath = os.path.join(self.rootDir, dname)
+                                if os.path.isdir(dpath):
+                                    shutil.rmtree(dpath, ignore_errors=True)
+
+                        os.makedirs(self.cacheDir)
+
+                    self.writable = os.access(self.cacheDir, os.W_OK)
+                except OSError as ex:
+                    print('Icon cache directory "%s" is not available - %s' % (self.cacheDir, str(ex)), file=stderr)
+                    self.writable = False
+
+            return self.writable
+
+    def put(self, key, pixbuf):
+        """Помещение в кэш изображения pixbuf (экземпляра Pixbuf)
+        с ключом key."""
+
+        if not self.__prepare_dir():
+            return
+
+        fname = self.get_cache_filename(key)
+        # имя временного файла - уникальное для потока,
+        # т.к. изображения может грузить несколько потоков сразу
+        tmpfname = '%s.%d.%d.tmp' % (fname, os.getpid(), threading.get_ident())
+
+        try:
+            with open(tmpfname, 'wb') as f:
+                f.write(self.HEADER.pack(self.SIGNATURE,
+                    pixbuf.get_width(), pixbuf.get_height(),
+                    pixbuf.get_rowstride(),
+                    pixbuf.get_has_alpha(),
+                    pixbuf.get_bits_per_sample()))
+                f.write(pixbuf.read_pixel_bytes().get_data())
+
+            os.replace(tmpfname, fname)
+        except OSError as ex:
+            print('Can not write icon cache file "%s" - %s' % (fname, str(ex)), file=stderr)
+
+            if os.path.exists(tmpfname):
+                os.remove(tmpfname)
+
+    def get_or_create(self, key, createfunc):
+        """Возвращает экземпляр Pixbuf из кэша, а при отсутствии
+        в кэше изображения с ключом key - создаёт его вызовом
+        функции createfunc() и помещает в кэш."""
+
+        pixbuf = self.get(key)
+
+        if pixbuf is None:
+            pixbuf = createfunc()
+
+            if pixbuf is not None:
+                self.put(key, pixbuf)
+
+        return pixbuf
+
+
 class FileResourceLoader():
     """Загрузчик файлов ресурсов.
     Mожет использоваться при загрузке файлов иконок, .ui и т.п.
@@ -367,6 +520,20 @@ class FileResourceLoader():
         self.appFilePath = appFilePath
         self.appDir = os.path.split(appFilePath)[0]
 
+        # None или экземпляр PixbufCache, используемый load_pixbuf()
+        self.pixbufCache = None
+
+        # пул потоков для load_pixbuf_async(), создаётся при первом вызове
+        self.executor = None
+
+    def get_signature(self, filename):
+        """Возвращает кортеж, значение которого меняется при изменении
+        файла filename (для ключей PixbufCache)."""
+
+        st = os.stat(os.path.join(self.appDir, filename))
+
+        return (st.st_size, st.st_mtime_ns)
+
     def load(self, filename):
         """Загружает файл filename в память и возвращает в виде
         bytestring.
@@ -415,25 +582,109 @@ class FileResourceLoader():
 
         return self.load_pixbuf(filename, size, size, fallback)
 
-    def load_pixbuf(self, filename, width, height, fallback=None):
+    def load_pixbuf(self, filename, width, height, fallback=None, scale=1):
         """Загружает файл в память и возвращает экземпляр Gdk.Pixbuf.
 
         filename        - имя файла (см. load_bytes),
         width, height   - размеры создаваемого изображения в пикселах,
         fallback        - имя стандартной иконки, которая будет загружена,
                           если не удалось загрузить файл filename;
-                          если fallback=None - генерируется исключение."""
+                          если fallback=None - генерируется исключение;
+        scale           - масштабный коэффициент (целое) для экранов
+                          с высокой плотностью пикселов; реальные размеры
+                          изображения - width * scale и height * scale.
+
+        Если задано поле pixbufCache - изображение сначала ищется
+        в кэше, а после загрузки файла - помещается в кэш."""
 
         try:
+            return self.__render_pixbuf(filename, width, height, scale)
+        except Exception as ex:
+            return self.load_fallback_pixbuf(filename, ex, fallback, height * scale)
+
+    def __render_pixbuf(self, filename, width, height, scale):
+        """Собственно загрузка изображения (см. load_pixbuf()), без
+        обработки ошибок.
+        Не дёргает GTK, потому может вызываться из любого потока."""
+
+        width *= scale
+        height *= scale
+
+        if self.pixbufCache is None:
             return self.pixbuf_from_bytes(self.load_bytes(filename),
                 width, height)
-        except Exception as ex:
-            print('Can not load image "%s" - %s' % (filename, str(ex)), file=stderr)
-            if fallback is None:
-                raise ex
-            else:
-                print('Loading fallback image "%s"' % fallback, file=stderr)
-                return Gtk.IconTheme.get_default().load_icon(fallback, height, Gtk.IconLookupFlags.FORCE_SIZE)
+
+        return self.pixbufCache.get_or_create(
+            (filename, width, height, scale, self.get_signature(filename)),
+            lambda: self.pixbuf_from_bytes(self.load_bytes(filename), width, height))
+
+    @staticmethod
+    def load_fallback_pixbuf(filename, ex, fallback, size):
+        """Обработка ошибки загрузки изображения (см. load_pixbuf()).
+
+        filename    - имя файла, который не удалось загрузить,
+        ex          - экземпляр исключения,
+        fallback    - None или имя стандартной иконки,
+        size        - размер стандартной иконки.
+
+        Если fallback=None - генерирует исключение ex."""
+
+        print('Can not load image "%s" - %s' % (filename, str(ex)), file=stderr)
+        if fallback is None:
+            raise ex
+        else:
+            print('Loading fallback image "%s"' % fallback, file=stderr)
+            return Gtk.IconTheme.get_default().load_icon(fallback, size, Gtk.IconLookupFlags.FORCE_SIZE)
+
+    class PendingPixbuf():
+        """Изображение, загружаемое в фоновом потоке
+        (см. FileResourceLoader.load_pixbuf_async())."""
+
+        def __init__(self, future, filename, fallback, size):
+            self.future = future
+            self.filename = filename
+            self.fallback = fallback
+            self.size = size
+
+        def get(self):
+            """Дожидается окончания загрузки и возвращает экземпляр
+            Gdk.Pixbuf (или стандартную иконку, если загрузить
+            изображение не удалось).
+            Вызывать только из основного потока!"""
+
+            try:
+                return self.future.result()
+            except Exception as ex:
+                return FileResourceLoader.load_fallback_pixbuf(self.filename,
+                    ex, self.fallback, self.size)
+
+        def when_ready(self, callback, *args):
+            """Вызов callback(pixbuf, *args) в основном потоке (из цикла
+            обработки событий GTK) по окончании загрузки."""
+
+            def __deliver():
+                callback(self.get(), *args)
+                return False
+
+            self.future.add_done_callback(lambda f: GLib.idle_add(__deliver))
+
+    # максимальное количество потоков для load_pixbuf_async()
+    MAX_LOADER_THREADS = 4
+
+    def load_pixbuf_async(self, filename, width, height, fallback=None, scale=1):
+        """Делает то же, что load_pixbuf(), но в фоновом потоке
+        (загрузчики GdkPixbuf на время рендеринга отпускают GIL,
+        так что несколько изображений действительно грузятся
+        параллельно).
+        Возвращает экземпляр PendingPixbuf."""
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=min(self.MAX_LOADER_THREADS, os.cpu_count() or 1))
+
+        return self.PendingPixbuf(
+            self.executor.submit(self.__render_pixbuf, filename, width, height, scale),
+            filename, fallback, height * scale)
 
     def load_gtk_builder(self, filename):
         """Загружает в память и возвращает экземпляр класса Gtk.Builder.
@@ -447,7 +698,135 @@ class FileResourceLoader():
 class ZipFileResourceLoader(FileResourceLoader):
     """Загрузчик файлов ресурсов из архива ZIP.
     Архив - сам файл приложения в случае, когда он
-    представляет собой python zip application."""
+    представляет собой python zip application.
+
+    Архив открывается один раз (при первом обращении) и остаётся
+    открытым до вызова close(); по возможности файл архива
+    отображается в память (mmap).
+    Содержимое недавно загруженных файлов хранится в памяти
+    (не более MAX_CACHE_SIZE байт), повторные обращения к ним
+    архив не трогают.
+    Методы могут вызываться из нескольких потоков одновременно."""
+
+    # максимальный суммарный размер загруженных файлов, хранимых в памяти
+    MAX_CACHE_SIZE = 4 * 1024 * 1024
+
+    class MMapFile():
+        """Минимальная файлоподобная обёртка для mmap - чтобы
+        zipfile.ZipFile мог читать архив прямо из отображённой
+        в память области."""
+
+        def __init__(self, mm):
+            self.mm = mm
+
+        def read(self, n=-1):
+            return self.mm.read(n if n is not None and n >= 0 else len(self.mm) - self.mm.tell())
+
+        def seek(self, offset, whence=0):
+            self.mm.seek(offset, whence)
+            return self.mm.tell()
+
+        def tell(self):
+            return self.mm.tell()
+
+        def seekable(self):
+            return True
+
+        def close(self):
+            self.mm.close()
+
+    def __init__(self, appFilePath):
+        super().__init__(appFilePath)
+
+        self.lock = threading.Lock()
+
+        self.zfile = None
+        # словарь, где ключи - имена файлов в архиве,
+        # а значения - экземпляры zipfile.ZipInfo
+        self.index = None
+
+        self.__file = None
+        self.__mmap = None
+
+        # LRU - ключи - имена файлов, значения - bytestring'и
+        self.cache = OrderedDict()
+        self.cacheSize = 0
+
+    def __open_archive(self):
+        """Открытие архива, если он ещё не открыт.
+        Вызывать только при захваченном self.lock."""
+
+        if self.zfile is not None:
+            return
+
+        f = open(self.appFilePath, 'rb')
+        try:
+            if not zipfile.is_zipfile(f):
+                raise TypeError('Файл "%s" не является архивом ZIP' % self.appFilePath)
+
+            try:
+                self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                src = self.MMapFile(self.__mmap)
+            except (OSError, ValueError):
+                # не вышло - обойдёмся обычным файлом
+                self.__mmap = None
+                src = f
+                src.seek(0)
+
+            self.zfile = zipfile.ZipFile(src, allowZip64=True)
+        except Exception:
+            if self.__mmap is not None:
+                self.__mmap.close()
+                self.__mmap = None
+
+            f.close()
+            raise
+
+        self.__file = f
+        self.index = dict(map(lambda zinfo: (zinfo.filename, zinfo), self.zfile.infolist()))
+
+    def __get_info(self, filename):
+        """Возвращает экземпляр zipfile.ZipInfo для файла filename."""
+
+        with self.lock:
+            self.__open_archive()
+
+            zinfo = self.index.get(filename)
+
+        if zinfo is None:
+            raise KeyError('Файл "%s" отсутствует в архиве "%s"' % (filename, self.appFilePath))
+
+        return zinfo
+
+    def close(self):
+        """Закрытие архива и очистка кэша."""
+
+        with self.lock:
+            if self.zfile is not None:
+                self.zfile.close()
+                self.zfile = None
+                self.index = None
+
+            if self.__mmap is not None:
+                self.__mmap.close()
+                self.__mmap = None
+
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+            self.cache.clear()
+            self.cacheSize = 0
+
+    def get_signature(self, filename):
+        """Аналогично FileResourceLoader.get_signature(), но для файла
+        внутри архива.
+
+        filename - путь к файлу внутри архива."""
+
+        zinfo = self.__get_info(filename)
+
+        return (zinfo.file_size, zinfo.CRC)
 
     def load(self, filename):
         """Аналогично FileResourceLoader.load(), загружает файл
@@ -455,15 +834,126 @@ class ZipFileResourceLoader(FileResourceLoader):
 
         filename - путь к файлу внутри архива."""
 
-        if not zipfile.is_zipfile(self.appFilePath):
-            raise TypeError('Файл "%s" не является архивом ZIP' % self.appFilePath)
+        with self.lock:
+            data = self.cache.get(filename)
+            if data is not None:
+                self.cache.move_to_end(filename)
+                return data
 
-        with zipfile.ZipFile(self.appFilePath, allowZip64=True) as zfile:
-            try:
-                with zfile.open(filename, 'r') as f:
-                    return f.read()
-            except Exception as ex:
-                raise Exception('Не удалось загрузить файл "%s" - %s' % (filename, str(ex)))
+        try:
+            zinfo = self.__get_info(filename)
+
+            # ZipFile сам умеет читать из нескольких потоков, и распаковка
+            # идёт без нашей блокировки
+            data = self.zfile.read(zinfo)
+        except Exception as ex:
+            raise Exception('Не удалось загрузить файл "%s" - %s' % (filename, str(ex)))
+
+        dsize = len(data)
+
+        if dsize <= self.MAX_CACHE_SIZE:
+            with self.lock:
+                if filename not in self.cache:
+                    self.cache[filename] = data
+                    self.cacheSize += dsize
+
+                    while self.cacheSize > self.MAX_CACHE_SIZE:
+                        _, olddata = self.cache.popitem(last=False)
+                        self.cacheSize -= len(olddata)
+
+        return data
+
+
+class TreeModelRow():
+    """Строка дерева, полученная get_tree_model_rows().
+
+    Поля:
+        itr         - экземпляр Gtk.TreeIter (копия, пригодная для
+                      использования после обхода, если модель - Gtk.TreeStore
+                      или другая с флагом Gtk.TreeModelFlags.ITERS_PERSIST);
+        depth       - уровень вложенности (1 - верхний уровень обходимого
+                      дерева или поддерева);
+        values      - кортеж значений запрошенных столбцов;
+        parent      - индекс родительской строки в списке строк,
+                      или -1 для строк верхнего уровня;
+        nchildren   - количество непосредственно вложенных строк;
+        end         - индекс строки, следующей за последней вложенной,
+                      т.е. строки поддерева - это [индекс строки, end)."""
+
+    __slots__ = 'itr', 'depth', 'values', 'parent', 'nchildren', 'end'
+
+    def __init__(self, itr, depth, values):
+        self.itr = itr
+        self.depth = depth
+        self.values = values
+        self.parent = -1
+        self.nchildren = 0
+        self.end = 0
+
+    def __repr__(self):
+        # для отладки
+        return '%s(depth=%d, values=%s, parent=%d, nchildren=%d, end=%d)' % (self.__class__.__name__,
+            self.depth, repr(self.values), self.parent, self.nchildren, self.end)
+
+
+def get_tree_model_rows(model, parentitr, *columns):
+    """Обход дерева без рекурсии.
+
+    model       - экземпляр Gtk.TreeModel;
+    parentitr   - None (для обхода всего дерева) или экземпляр
+                  Gtk.TreeIter (для обхода элементов, вложенных в него);
+    columns     - номера столбцов, значения которых нужно получить
+                  (для каждой строки - одним вызовом model.get()).
+
+    Всё дерево обходится вызовом model.foreach(), т.е. перебор строк
+    идёт на стороне GTK; поддерево - с помощью явного стека.
+
+    Возвращает список экземпляров TreeModelRow в прямом порядке
+    (pre-order): каждая строка - перед вложенными в неё.
+    Обратный порядок (post-order) для строки с индексом ix - это
+    момент, когда обход списка доходит до индекса rows[ix].end."""
+
+    rows = []
+
+    if parentitr is None:
+        def __fe_func(model, path, itr, data=None):
+            rows.append(TreeModelRow(itr.copy(), path.get_depth(), model.get(itr, *columns)))
+
+        model.foreach(__fe_func)
+    else:
+        stack = [model.iter_children(parentitr)]
+
+        while stack:
+            itr = stack[-1]
+            if itr is None:
+                stack.pop()
+                continue
+
+            rows.append(TreeModelRow(itr.copy(), len(stack), model.get(itr, *columns)))
+
+            stack[-1] = model.iter_next(itr.copy())
+
+            child = model.iter_children(itr)
+            if child is not None:
+                stack.append(child)
+
+    # вложенность
+    stack = []
+    for ix, row in enumerate(rows):
+        while stack and rows[stack[-1]].depth >= row.depth:
+            rows[stack.pop()].end = ix
+
+        if stack:
+            row.parent = stack[-1]
+            rows[row.parent].nchildren += 1
+
+        stack.append(ix)
+
+    nrows = len(rows)
+    for ix in stack:
+        rows[ix].end = nrows
+
+    return rows
 
 
 class TreeViewShell():
@@ -557,6 +1047,58 @@ class TreeViewShell():
         self.view.set_model(self.store)
 
 
+class TreeViewDetached():
+    """Временное отключение модели от Gtk.TreeView на время массовых
+    изменений модели (удаления, вставки, перестановки множества строк),
+    чтобы TreeView не обрабатывал сигналы от каждой изменяемой строки.
+    Развёрнутые строки после подключения модели разворачиваются снова.
+
+    Используется как контекстный менеджер:
+
+        with TreeViewDetached(treeview, keycolumn):
+            ...
+
+    view        - экземпляр Gtk.TreeView;
+    keycolumn   - номер столбца модели, по значениям которого опознаются
+                  развёрнутые строки (значения должны быть хэшируемыми
+                  и не меняться при изменениях модели, напр. ссылки
+                  на объекты);
+    detach      - булевское значение; если False - модель не отключается
+                  (напр. когда изменений немного и отключение выйдет
+                  дороже)."""
+
+    def __init__(self, view, keycolumn, detach=True):
+        self.view = view
+        self.keycolumn = keycolumn
+        self.detach = detach
+
+        self.model = None
+        self.expanded = set()
+
+    def __enter__(self):
+        if self.detach:
+            self.model = self.view.get_model()
+
+            def __expanded_row(view, path, data=None):
+                self.expanded.add(self.model.get_value(self.model.get_iter(path), self.keycolumn))
+
+            self.view.map_expanded_rows(__expanded_row, None)
+            self.view.set_model(None)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.detach:
+            return
+
+        self.view.set_model(self.model)
+
+        if self.expanded:
+            for row in get_tree_model_rows(self.model, None, self.keycolumn):
+                if row.values[0] in self.expanded:
+                    self.view.expand_row(self.model.get_path(row.itr), False)
+
+
 def __debug_msgdlg():
     print(msg_dialog(None, 'Message dialog test', 'Delete anything?', buttons=Gtk.ButtonsType.YES_NO,
         destructive_response=Gtk.ResponseType.YES,
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" wcappcache.py
+
+    This file is part of WishCalc.
+
+    WishCalc is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    WishCalc is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with WishCalc.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+# внимание! этот модуль, как и wcperf, не должен тянуть за собой GTK
+# и прочие модули WishCalc - он импортируется из __main__.py раньше
+# всех остальных
+
+import os
+import os.path
+import sys
+import re
+import json
+import shutil
+import hashlib
+import zipfile
+import py_compile
+import importlib.util
+
+
+APP_NAME = 'wishcalc'
+
+# файл с описанием содержимого распакованного приложения
+MANIFEST_NAME = 'manifest.json'
+
+# модуль, из которого берётся номер версии; сам модуль импортировать
+# нельзя - он тянет за собой GTK
+VERSION_MODULE = 'wccommon.py'
+VERSION_RX = re.compile(r'''^VERSION\s*=\s*['"]([^'"]+)['"]''', re.MULTILINE)
+
+
+def get_cache_dir():
+    """Возвращает путь к каталогу для кэшей программы (иконок и т.п.).
+    Каталог здесь НЕ создаётся - пусть создают те, кому он нужен."""
+
+    # некоторый костылинг вместо xdg.BaseDirectory, которого есть не для всех ОС
+    cacheHome = os.environ.get('XDG_CACHE_HOME')
+    if not cacheHome:
+        cacheHome = os.path.join(os.path.expanduser('~'), '.cache')
+
+    return os.path.join(cacheHome, APP_NAME)
+
+
+def file_hash(filename):
+    """Возвращает строку с шестнадцатеричным значением SHA-256
+    содержимого файла filename."""
+
+    h = hashlib.sha256()
+
+    with open(filename, 'rb') as f:
+        while True:
+            buf = f.read(65536)
+            if not buf:
+                break
+
+            h.update(buf)
+
+    return h.hexdigest()
+
+
+class AppCache():
+    """Распакованная копия программы, запущенной из архива ZIP
+    (python zip application, см. "make app").
+
+    При запуске из архива zipimport не может сохранять скомпилированные
+    модули, а все ресурсы приходится каждый раз распаковывать.
+    Потому при первом запуске каждой версии программы содержимое
+    архива распаковывается в каталог get_cache_dir()/<версия>,
+    модули там же компилируются, а при следующих запусках модули
+    и ресурсы грузятся уже оттуда.
+
+    Соответствие распакованной копии архиву проверяется по хэшу
+    архива, записанному в MANIFEST_NAME, а целость распакованных
+    файлов и скомпилированных модулей - по их размерам и хэшам
+    оттуда же; при несовпадении копия создаётся заново.
+
+    Поля:
+        archivePath - полный путь к архиву,
+        cacheRoot   - путь к общему каталогу кэшей программы,
+        version     - None или строка с номером версии,
+        appDir      - None или путь к каталогу с распакованной копией
+                      (после успешного вызова activate())."""
+
+    def __init__(self, archivePath, cacheRoot=None):
+        self.archivePath = os.path.abspath(archivePath)
+        self.cacheRoot = cacheRoot if cacheRoot else get_cache_dir()
+        self.version = None
+        self.appDir = None
+
+    @staticmethod
+    def load_manifest(appdir):
+        """Возвращает словарь с содержимым файла MANIFEST_NAME
+        из каталога appdir или None, если файла нет или он испорчен."""
+
+        try:
+            with open(os.path.join(appdir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+
+            return manifest if isinstance(manifest, dict) else None
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def verify_files(appdir, manifest):
+        """Проверка файлов в каталоге appdir по размерам и хэшам
+        из manifest (словаря, см. load_manifest()).
+        Возвращает True, если все файлы на месте и не испорчены."""
+
+        files = manifest.get('files')
+        if not isinstance(files, dict) or not files:
+            return False
+
+        for name, entry in files.items():
+            try:
+                size, digest = entry
+
+                path = os.path.join(appdir, name)
+                # размер - сначала, он проверяется без чтения файла
+                if os.path.getsize(path) != size or file_hash(path) != digest:
+                    return False
+            except (OSError, TypeError, ValueError):
+                return False
+
+        return True
+
+    def __get_version(self, zfile):
+        m = VERSION_RX.search(str(zfile.read(VERSION_MODULE), 'utf-8'))
+        if m is None:
+            raise ValueError('номер версии в %s не найден' % VERSION_MODULE)
+
+        return m.group(1)
+
+    def __extract(self, zfile, destdir, archivehash):
+        """Распаковка архива в каталог destdir, компиляция модулей
+        и запись манифеста."""
+
+        files = dict()
+        destroot = os.path.abspath(destdir) + os.sep
+
+        for zinfo in zfile.infolist():
+            if zinfo.filename.endswith('/'):
+                continue
+
+            target = os.path.abspath(os.path.join(destdir, zinfo.filename))
+            if not target.startswith(destroot):
+                raise ValueError('недопустимое имя файла в архиве - "%s"' % zinfo.filename)
+
+            data = zfile.read(zinfo)
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+
+            # значения - списки [размер, хэш] (см. verify_files())
+            files[zinfo.filename] = [len(data), hashlib.sha256(data).hexdigest()]
+
+            if target.endswith('.py'):
+                cfile = importlib.util.cache_from_source(target)
+
+                py_compile.compile(target,
+                    cfile=cfile,
+                    dfile=os.path.join(self.archivePath, zinfo.filename),
+                    doraise=True)
+
+                # скомпилированные модули тоже грузятся отсюда
+                files[os.path.relpath(cfile, destdir)] = [os.path.getsize(cfile), file_hash(cfile)]
+
+        # манифест пишется последним - каталог без него считается
+        # недораспакованным
+        with open(os.path.join(destdir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+            json.dump({'version':self.version, 'archive':archivehash, 'files':files}, f, indent='  ')
+
+    def __remove_other_versions(self):
+        """Удаление распакованных копий прочих версий программы."""
+
+        for name in os.listdir(self.cacheRoot):
+            if name == self.version:
+                continue
+
+            path = os.path.join(self.cacheRoot, name)
+
+            # чужие каталоги (напр. кэш иконок) не трогаем
+            if self.load_manifest(path) is not None:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def prepare(self):
+        """Проверка распакованной копии и, при необходимости,
+        распаковка архива.
+        Возвращает путь к каталогу с распакованной копией.
+        В случае ошибок генерирует исключения."""
+
+        archivehash = file_hash(self.archivePath)
+
+        with zipfile.ZipFile(self.archivePath, 'r') as zfile:
+            self.version = self.__get_version(zfile)
+
+            appdir = os.path.join(self.cacheRoot, self.version)
+
+            manifest = self.load_manifest(appdir)
+            if manifest is not None and manifest.get('archive') == archivehash \
+                    and self.verify_files(appdir, manifest):
+                return appdir
+
+            # распаковываем во временный каталог и переименовываем
+            # готовый - чтобы одновременно запущенные копии программы
+            # не увидели недораспакованное
+            tmpdir = '%s.tmp-%d' % (appdir, os.getpid())
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+
+            os.makedirs(tmpdir)
+            try:
+                self.__extract(zfile, tmpdir, archivehash)
+
+                if os.path.exists(appdir):
+                    # копия от другой сборки той же версии
+                    olddir = '%s.old-%d' % (appdir, os.getpid())
+                    os.rename(appdir, olddir)
+                    shutil.rmtree(olddir, ignore_errors=True)
+
+                try:
+                    os.rename(tmpdir, appdir)
+                except OSError:
+                    # другая копия программы успела раньше нас
+                    manifest = self.load_manifest(appdir)
+                    if manifest is None or manifest.get('archive') != archivehash:
+                        raise
+            finally:
+                if os.path.exists(tmpdir):
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+
+        self.__remove_other_versions()
+
+        return appdir
+
+    def activate(self):
+        """Подготовка распакованной копии и переключение на неё
+        импорта модулей и загрузки ресурсов.
+        Возвращает True в случае успеха. При ошибках (напр. каталог
+        кэша недоступен для записи) выводит сообщение в stderr,
+        ничего не меняет и возвращает False - программа продолжит
+        работать прямо из архива."""
+
+        try:
+            appdir = self.prepare()
+        except Exception as ex:
+            print('Can not use application cache in "%s" - %s' % (self.cacheRoot, str(ex)), file=sys.stderr)
+            return False
+
+        self.appDir = appdir
+
+        # модули - из распакованной копии
+        sys.path.insert(0, appdir)
+        # get_resource_loader() смотрит на sys.argv[0] - пусть ресурсы
+        # тоже грузятся оттуда
+        sys.argv[0] = os.path.join(appdir, '__main__.py')
+
+        return True
+
+
+def use_app_cache(args):
+    """Если программа запущена из архива ZIP, путь к которому - args[0],
+    переключает её на распакованную копию (см. AppCache).
+    Возвращает None или экземпляр AppCache."""
+
+    if not args or not zipfile.is_zipfile(args[0]):
+        return None
+
+    appcache = AppCache(args[0])
+    appcache.activate()
+
+    return appcache
+
+
+if __name__ == '__main__':
+    print('[debugging %s]' % __file__)
+
+    if len(sys.argv) > 1:
+        appcache = AppCache(sys.argv[1])
+        print('cache: %s' % appcache.prepare())
+    else:
+        print('cache root: %s' % get_cache_dir())
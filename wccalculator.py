@@ -30,8 +30,33 @@ class Calculator():
     ERROR_ICON_POS = Gtk.EntryIconPosition.SECONDARY
     ERROR_ICON_NAME = 'dialog-error'
 
-    def __init__(self, resldr, entry, primaryicon):
-        self.popover = Gtk.Popover.new(entry)
+    def __init__(self, resldr, entry, primaryicon, lazy=False):
+        """resldr      - экземпляр *ResourceLoader,
+        entry       - экземпляр Gtk.Entry, для которого вызывается калькулятор,
+        primaryicon - булевское значение: True - иконка калькулятора
+                      в начале поля ввода, False - в конце;
+        lazy        - булевское значение: True - всплывающее окно
+                      калькулятора создаётся при первом вызове run(),
+                      а не здесь."""
+
+        self.popover = None
+
+        self.entry = entry
+        self.entryiconpos = Gtk.EntryIconPosition.PRIMARY if primaryicon else Gtk.EntryIconPosition.SECONDARY
+        self.entry.set_icon_from_icon_name(self.entryiconpos, self.CALC_ICON_NAME)
+        self.entry.set_icon_sensitive(self.entryiconpos, True)
+        self.entry.set_icon_activatable(self.entryiconpos, True)
+
+        self.entry.connect('icon-release', self.entry_icon_release)
+        self.entry.connect('key-release-event', self.entry_key_release_event)
+
+        if not lazy:
+            self.create_popover()
+
+    def create_popover(self):
+        """Создание всплывающего окна калькулятора."""
+
+        self.popover = Gtk.Popover.new(self.entry)
 
         box = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 0)
         box.set_border_width(WIDGET_SPACING)
@@ -53,15 +78,6 @@ class Calculator():
 
         self.computebtn.connect('clicked', self.computebtn_clicked)
 
-        self.entry = entry
-        self.entryiconpos = Gtk.EntryIconPosition.PRIMARY if primaryicon else Gtk.EntryIconPosition.SECONDARY
-        self.entry.set_icon_from_icon_name(self.entryiconpos, self.CALC_ICON_NAME)
-        self.entry.set_icon_sensitive(self.entryiconpos, True)
-        self.entry.set_icon_activatable(self.entryiconpos, True)
-
-        self.entry.connect('icon-release', self.entry_icon_release)
-        self.entry.connect('key-release-event', self.entry_key_release_event)
-
     def __check_expression(self, expr):
         # кривой костыль для борьбы с дырами безопасности в eval()
 
@@ -113,6 +129,9 @@ class Calculator():
         return False
 
     def run(self):
+        if self.popover is None:
+            self.create_popover()
+
         self.calcentry.set_text(self.entry.get_text())
         self.show_error(False)
 
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" wcclipboard.py
+
+    This file is part of WishCalc.
+
+    WishCalc is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    WishCalc is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with WishCalc.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+from gtktools import *
+
+from gi.repository import Gtk, Gdk
+
+import zlib
+import base64
+
+
+# собственный тип содержимого буфера обмена - для обмена товарами
+# между экземплярами WishCalc
+CLIPBOARD_TARGET = 'application/x-wishcalc-items'
+
+# заголовок данных CLIPBOARD_TARGET - первая строка вида
+# "WISHCALC-ITEMS/<версия формата> <кодировка>"
+FORMAT_NAME = 'WISHCALC-ITEMS'
+FORMAT_VERSION = 1
+
+ENCODING_JSON = 'json'          # JSON как есть (в UTF-8)
+ENCODING_ZLIB = 'zlib+base64'   # JSON, сжатый zlib и закодированный base64
+
+# данные меньшего размера (в байтах) не сжимаются
+COMPRESS_MIN_SIZE = 4096
+
+
+def pack_clipboard_data(text):
+    """Упаковка строки text (JSON) в данные для CLIPBOARD_TARGET.
+    Возвращает bytes."""
+
+    data = text.encode('utf-8')
+
+    if len(data) >= COMPRESS_MIN_SIZE:
+        encoding = ENCODING_ZLIB
+        data = base64.b64encode(zlib.compress(data))
+    else:
+        encoding = ENCODING_JSON
+
+    return ('%s/%d %s\n' % (FORMAT_NAME, FORMAT_VERSION, encoding)).encode('ascii') + data
+
+
+def unpack_clipboard_data(data):
+    """Распаковка данных CLIPBOARD_TARGET (bytes).
+    Возвращает строку (JSON).
+    В случае неподдерживаемого формата или испорченных данных
+    генерирует исключение ValueError."""
+
+    E_FORMAT = 'неподдерживаемый формат данных в буфере обмена'
+
+    header, sep, body = data.partition(b'\n')
+
+    try:
+        fmt, encoding = str(header, 'ascii').split(None, 1)
+        name, version = fmt.split('/', 1)
+        version = int(version)
+    except ValueError:
+        raise ValueError(E_FORMAT)
+
+    if name != FORMAT_NAME or version > FORMAT_VERSION:
+        raise ValueError(E_FORMAT)
+
+    if encoding == ENCODING_ZLIB:
+        try:
+            body = zlib.decompress(base64.b64decode(body, validate=True))
+        except (ValueError, zlib.error) as ex:
+            raise ValueError('данные в буфере обмена повреждены (%s)' % str(ex))
+    elif encoding != ENCODING_JSON:
+        raise ValueError(E_FORMAT)
+
+    return str(body, 'utf-8')
+
+
+class ClipboardOwner():
+    """Владелец содержимого буфера обмена, предлагающий одни и те же
+    данные в виде CLIPBOARD_TARGET (для других экземпляров WishCalc)
+    и в виде обычного текста (для текстовых редакторов и т.п.).
+
+    Gtk.Clipboard.set_with_data() в PyGObject недоступен, потому
+    буфером обмена владеет невидимый виджет, отдающий данные
+    по сигналу "selection-get". Упаковка (сжатие) данных выполняется
+    только при первом запросе CLIPBOARD_TARGET.
+
+    Поля:
+        selection   - экземпляр Gdk.Atom, буфер обмена;
+        itemsAtom   - экземпляр Gdk.Atom для CLIPBOARD_TARGET;
+        text        - None или строка, текущее содержимое;
+        packed      - None или bytes, упакованное содержимое."""
+
+    INFO_TEXT, INFO_ITEMS = range(2)
+
+    TEXT_TARGETS = ('UTF8_STRING', 'text/plain;charset=utf-8', 'text/plain', 'TEXT', 'STRING')
+
+    def __init__(self, selection=Gdk.SELECTION_CLIPBOARD):
+        self.selection = selection
+
+        self.text = None
+        self.packed = None
+
+        self.itemsAtom = Gdk.Atom.intern(CLIPBOARD_TARGET, False)
+
+        self.widget = Gtk.Invisible.new()
+
+        self.widget.selection_add_target(self.selection, self.itemsAtom, self.INFO_ITEMS)
+
+        for target in self.TEXT_TARGETS:
+            self.widget.selection_add_target(self.selection,
+                Gdk.Atom.intern(target, False), self.INFO_TEXT)
+
+        self.widget.connect('selection-get', self.__selection_get)
+        self.widget.connect('selection-clear-event', self.__selection_clear)
+
+    def set_text(self, text):
+        """Помещение в буфер обмена строки text (JSON).
+        Возвращает True в случае успеха."""
+
+        self.text = None
+        self.packed = None
+
+        if not Gtk.selection_owner_set(self.widget, self.selection, Gdk.CURRENT_TIME):
+            return False
+
+        self.text = text
+
+        return True
+
+    def __selection_get(self, widget, selectiondata, info, time):
+        if self.text is None:
+            return
+
+        if info == self.INFO_ITEMS:
+            if self.packed is None:
+                self.packed = pack_clipboard_data(self.text)
+
+            selectiondata.set(self.itemsAtom, 8, self.packed)
+        else:
+            selectiondata.set_text(self.text, -1)
+
+    def __selection_clear(self, widget, event):
+        # буфер обмена занял кто-то другой
+        self.text = None
+        self.packed = None
+
+        return False
+
+
+if __name__ == '__main__':
+    print('[debugging %s]' % __file__)
+
+    for s in ('{"x":1}', '{"x":"%s"}' % ('y' * COMPRESS_MIN_SIZE)):
+        packed = pack_clipboard_data(s)
+        print(packed[:40], len(packed), unpack_clipboard_data(packed) == s)
@@ -26,6 +26,8 @@ from gi.repository import Gtk, Gdk
 import json
 import os, os.path
 
+from wcappcache import get_cache_dir
+
 
 JSON_ENCODING = 'utf-8'
 
@@ -155,12 +157,18 @@ class Config():
     MAINWINDOW = 'mainwindow'
     ITEMEDITORWINDOW = 'itemeditorwindow'
     RECENTFILES = 'recentfiles'
+    SHOWPERFSTATUS = 'showperfstatus'
+    UNDODEPTH = 'undodepth'
 
     CFGFN = 'settings.json'
     CFGAPP = 'wishcalc'
 
     MAX_RECENT_FILES = 16 # ибо нефиг
 
+    # количество шагов отмены изменений
+    DEFAULT_UNDO_DEPTH = 50
+    MAX_UNDO_DEPTH = 1000
+
     def __init__(self):
         #
         # положение и состояние окон
@@ -175,6 +183,12 @@ class Config():
         # ранее открывавшиеся файлы (список строк)
         self.recentFiles = []
 
+        # показывать ли панель статистики производительности
+        self.showPerfStatus = False
+
+        # максимальное количество запоминаемых шагов отмены изменений
+        self.undoDepth = self.DEFAULT_UNDO_DEPTH
+
         # определяем каталог для настроек
         # или принудительно создаём, если его ещё нет
 
@@ -186,6 +200,10 @@ class Config():
         self.configPath = os.path.join(self.configDir, self.CFGFN)
         # вот сейчас самого файла может ещё не быть!
 
+        # каталог для кэшей (иконок и т.п.);
+        # здесь НЕ создаётся - пусть создают те, кому он нужен
+        self.cacheDir = get_cache_dir()
+
     def load(self):
         E_SETTINGS = 'Ошибка в файле настроек "%s": %%s' % self.configPath
 
@@ -223,6 +241,20 @@ class Config():
 
                     self.add_recent_file(rfn)
 
+                #
+                # прочие настройки
+                #
+                self.showPerfStatus = d.get(self.SHOWPERFSTATUS, False)
+                if not isinstance(self.showPerfStatus, bool):
+                    raise TypeError(E_SETTINGS % ('недопустимый тип элемента "%s"' % self.SHOWPERFSTATUS))
+
+                self.undoDepth = d.get(self.UNDODEPTH, self.DEFAULT_UNDO_DEPTH)
+                if not isinstance(self.undoDepth, int) or isinstance(self.undoDepth, bool):
+                    raise TypeError(E_SETTINGS % ('недопустимый тип элемента "%s"' % self.UNDODEPTH))
+
+                if self.undoDepth < 1 or self.undoDepth > self.MAX_UNDO_DEPTH:
+                    raise ValueError(E_SETTINGS % ('значение элемента "%s" вне допустимого диапазона (1..%d)' % (self.UNDODEPTH, self.MAX_UNDO_DEPTH)))
+
     def add_recent_file(self, fname):
         self.recentFiles.append(fname)
 
@@ -236,15 +268,22 @@ class Config():
         if self.recentFiles:
             tmpd[self.RECENTFILES] = self.recentFiles
 
+        if self.showPerfStatus:
+            tmpd[self.SHOWPERFSTATUS] = self.showPerfStatus
+
+        if self.undoDepth != self.DEFAULT_UNDO_DEPTH:
+            tmpd[self.UNDODEPTH] = self.undoDepth
+
         with open(self.configPath, 'w+', encoding=JSON_ENCODING) as f:
             json.dump(tmpd, f, ensure_ascii=False, indent='  ')
 
     def __repr__(self):
         # для отладки
 
-        return '%s(configDir="%s", configPath="%s", mainWindow=%s, itemEditorWindow=%s, recentFiles=%s)' % (self.__class__.__name__,
-            self.configDir, self.configPath, self.mainWindow,
-            self.itemEditorWindow, repr(self.recentFiles))
+        return '%s(configDir="%s", configPath="%s", cacheDir="%s", mainWindow=%s, itemEditorWindow=%s, recentFiles=%s, showPerfStatus=%s, undoDepth=%d)' % (self.__class__.__name__,
+            self.configDir, self.configPath, self.cacheDir, self.mainWindow,
+            self.itemEditorWindow, repr(self.recentFiles), self.showPerfStatus,
+            self.undoDepth)
 
 
 if __name__ == '__main__':
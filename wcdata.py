@@ -25,10 +25,14 @@ import os.path
 #from gi.repository import Gtk, GObject
 #from gi.repository.GdkPixbuf import Pixbuf
 
-from collections import namedtuple
+from collections import namedtuple, deque
+from bisect import bisect_left
+import random
+import re
 
 from wcconfig import JSON_ENCODING
 from wccommon import *
+from wcperf import PerfTimer
 
 import csv
 
@@ -158,6 +162,69 @@ def url_to_csv_str(url):
     return ','.join(tmp)
 
 
+class UndoHistory():
+    """История изменений для отмены/повтора - стеки записей, по которым
+    восстанавливается состояние документа: снимков документа
+    (см. WishCalc.make_snapshot()) или записей об изменении пометок
+    (см. WishCalc.make_checked_change()).
+
+    Поля:
+        depth       - максимальное количество хранимых шагов отмены;
+        undoStack,
+        redoStack   - экземпляры collections.deque с записями."""
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.undoStack = deque(maxlen=depth)
+        self.redoStack = deque(maxlen=depth)
+
+    def clear(self):
+        self.undoStack.clear()
+        self.redoStack.clear()
+
+    def can_undo(self):
+        return len(self.undoStack) > 0
+
+    def can_redo(self):
+        return len(self.redoStack) > 0
+
+    def push(self, entry):
+        """Запоминание записи entry (состояния документа перед
+        изменением). Запись, совпадающая с последней запомненной,
+        повторно не запоминается.
+        Стек повтора при этом очищается."""
+
+        if self.undoStack and self.undoStack[-1].same_as(entry):
+            return
+
+        self.undoStack.append(entry)
+        self.redoStack.clear()
+
+    def undo(self, restore):
+        """Отмена изменения.
+        restore - функция, восстанавливающая состояние документа
+                  по записи из истории (единственный параметр)
+                  и возвращающая запись с состоянием, бывшим
+                  до восстановления (для повтора).
+        Возвращает True, если было что отменять."""
+
+        if not self.undoStack:
+            return False
+
+        self.redoStack.append(restore(self.undoStack.pop()))
+        return True
+
+    def redo(self, restore):
+        """Повтор отменённого изменения. Параметр и возвращаемое
+        значение - как у undo()."""
+
+        if not self.redoStack:
+            return False
+
+        self.undoStack.append(restore(self.redoStack.pop()))
+        return True
+
+
 class WishCalc():
     """Обёртка для Gtk.TreeStore, хранящего ссылки на экземпляры Item
     и данные для отображения в Gtk.TreeView.
@@ -171,9 +238,513 @@ class WishCalc():
     Внимание! При изменениях в wishcalc.ui нижеследующие константы
     должны быть приведены в соответствие!"""
 
-    COL_ITEM_OBJ, COL_NAME, COL_COST, COL_NEEDED,\
-    COL_NEED_ICON, COL_NEED_MONTHS, COL_INFO, COL_QUANTITY, COL_SUM,\
-    COL_IMPORTANCE, COL_SELECTED, COL_INCART, COL_SELECTEDSUBITEMS = range(13)
+    # отображаемые значения (название, цены, иконки и т.п.) в TreeStore
+    # не хранятся - их вычисляет UI только для отрисовываемых строк
+    # (см. wishcalc.py); здесь - только то, что нужно самой модели
+    # и фильтрующим/упорядочивающим моделям поверх неё
+    COL_ITEM_OBJ, COL_SELECTED, COL_SELECTEDSUBITEMS,\
+    COL_VISIBLE,\
+    COL_SORT_SUM, COL_SORT_MONTHS, COL_SORT_IMPORTANCE, COL_SORT_NAME = range(8)
+
+    # столбцы с ключами для отображения списка упорядоченным без изменения
+    # порядка элементов (см. view_sort_values()); ключи числовые (кроме
+    # названия), чтобы Gtk.TreeModelSort сравнивал их сам, без разбора
+    # строк и без вызова функций на питоне
+    VIEW_SORT_COLUMNS = (COL_SORT_SUM, COL_SORT_MONTHS, COL_SORT_IMPORTANCE, COL_SORT_NAME)
+
+    class ValueTable():
+        """Таблица общих для всего документа значений полей товаров.
+
+        В больших списках одни и те же описания, отображаемые имена URL
+        и т.п. повторяются тысячи раз; через эту таблицу все товары
+        ссылаются на один экземпляр каждого значения.
+
+        Списки URL хранятся в виде неизменяемых кортежей, потому
+        могут без опаски использоваться несколькими товарами
+        одновременно (см. WishCalc.Item.get_data_from())."""
+
+        __slots__ = 'strings', 'urls'
+
+        def __init__(self):
+            # ключи и значения - одни и те же строки
+            self.strings = dict()
+            # ключи и значения - одни и те же кортежи URL
+            self.urls = dict()
+
+        def clear(self):
+            self.strings.clear()
+            self.urls.clear()
+
+        def intern_str(self, s):
+            """Возвращает хранящийся в таблице экземпляр строки,
+            равной s (при необходимости добавляя s в таблицу)."""
+
+            return self.strings.setdefault(s, s)
+
+        def intern_url(self, url):
+            """Возвращает хранящийся в таблице кортеж, равный url -
+            последовательности пар (URL, отображаемое имя)."""
+
+            if not url:
+                return ()
+
+            ret = self.urls.get(url)
+            if ret is None:
+                ret = tuple(map(lambda u: (self.intern_str(u[0]), self.intern_str(u[1])), url))
+                self.urls[ret] = ret
+
+            return ret
+
+        def intern_item(self, item):
+            """Замена значений полей item (экземпляра WishCalc.Item)
+            на хранящиеся в таблице."""
+
+            if item.info:
+                item.info = self.intern_str(item.info)
+
+            item.url = self.intern_url(item.url)
+
+    class ItemCalc():
+        """Значения, вычисляемые для товара при вызове
+        WishCalc.recalculate().
+        Хранятся отдельно от WishCalc.Item, т.к. используются только UI,
+        в файле не сохраняются и при копировании товара не копируются.
+
+        Значения могут зависеть от предыдущих по списку товаров!
+        Вычисленные значения - целые положительные числа;
+        значение поля, равное 0, означает, что уже усё, денег достаточно;
+        значение None означает "вычислить не удалось" и ошибкой не является."""
+
+        __slots__ = 'needCash', 'needTotal', 'availCash', 'needMonths', \
+            'childrenImportance', 'childrenSelected', 'childrenInCart', \
+            'checked', 'parent', 'rowIndex', 'rowEnd', \
+            'subSelectedSum', 'subSelectedCount', 'snapshot', \
+            'version', 'rowValues', 'rowKey', 'rowView'
+
+        def __init__(self):
+            # недостающая сумма
+            self.needCash = None
+
+            # недостающая сумма с учётом предыдущих по списку товаров
+            self.needTotal = None
+
+            # доступная сумма
+            self.availCash = None
+
+            # кол-во месяцев на накопление
+            self.needMonths = None
+
+            # максимальное значение importance вложенных товаров
+            self.childrenImportance = 0
+
+            self.childrenSelected = False
+            self.childrenInCart = False
+
+            # поля для WishCalc.set_item_checked() - чтобы при пометке
+            # элемента не пересчитывать всё дерево:
+
+            # копия значения столбца COL_SELECTED
+            self.checked = False
+
+            # None или экземпляр ItemCalc группы, которой принадлежит товар
+            self.parent = None
+
+            # индекс строки в порядке обхода дерева и индекс строки,
+            # следующей за последним вложенным элементом
+            self.rowIndex = 0
+            self.rowEnd = 0
+
+            # сумма и количество помеченных вложенных элементов
+            # (без учёта вложенных в помеченные)
+            self.subSelectedSum = 0
+            self.subSelectedCount = 0
+
+            # None или узел последнего снимка дерева, в который попал
+            # товар (см. WishCalc.make_snapshot())
+            self.snapshot = None
+
+            # номер версии данных товара, увеличивается при каждом
+            # изменении товара на месте (см. WishCalc.apply_item_changes())
+            self.version = 0
+
+            # None или кортеж значений столбцов строки TreeStore,
+            # записанных туда при последнем обновлении отображения;
+            # если вновь вычисленные значения совпадают с ним - строку
+            # можно не перезаписывать
+            self.rowValues = None
+
+            # None или кортеж значений, от которых зависит отображение
+            # строки (версия, вычисленные суммы и т.п.; см. wishcalc.py),
+            # на момент последнего обновления отображения
+            self.rowKey = None
+
+            # None или кортеж отображаемых значений строки, вычисляемый
+            # при первой отрисовке строки после изменения rowKey
+            self.rowView = None
+
+        def __repr__(self):
+            # для отладки
+            return '%s(needCash=%s, needTotal=%s, availCash=%s, needMonths=%s, childrenImportance=%d, childrenSelected=%s, childrenInCart=%s)' %\
+                (self.__class__.__name__,
+                 self.needCash, self.needTotal, self.availCash, self.needMonths,
+                 self.childrenImportance, self.childrenSelected, self.childrenInCart)
+
+    class CheckedIndex():
+        """Индекс помеченных элементов дерева, упорядоченный по порядку
+        обхода дерева (см. ItemCalc.rowIndex).
+        Заполняется при вызове WishCalc.recalculate() и обновляется
+        WishCalc.set_item_checked(); после изменений в структуре дерева
+        до вызова recalculate() недействителен."""
+
+        __slots__ = 'rows', 'entries'
+
+        def __init__(self):
+            # упорядоченный список индексов строк помеченных элементов
+            self.rows = []
+            # ключи - индексы строк, значения - кортежи
+            # (экземпляр Gtk.TreeIter, экземпляр ItemCalc)
+            self.entries = dict()
+
+        def clear(self):
+            self.rows.clear()
+            self.entries.clear()
+
+        def __len__(self):
+            return len(self.rows)
+
+        def append(self, itr, calc):
+            """Добавление элемента в конец индекса (при обходе дерева)."""
+
+            self.rows.append(calc.rowIndex)
+            self.entries[calc.rowIndex] = (itr, calc)
+
+        def add(self, itr, calc):
+            if calc.rowIndex in self.entries:
+                return
+
+            self.rows.insert(bisect_left(self.rows, calc.rowIndex), calc.rowIndex)
+            self.entries[calc.rowIndex] = (itr, calc)
+
+        def remove(self, calc):
+            if calc.rowIndex not in self.entries:
+                return
+
+            del self.rows[bisect_left(self.rows, calc.rowIndex)]
+            del self.entries[calc.rowIndex]
+
+        def get_iters(self, nested=False):
+            """Возвращает список экземпляров Gtk.TreeIter помеченных
+            элементов в порядке обхода дерева.
+            Если nested=False, вложенные в помеченные элементы
+            в список не попадают."""
+
+            lret = []
+            # индекс строки, до которой идут вложенные в помеченный элемент
+            subselend = 0
+
+            for ix in self.rows:
+                if ix < subselend and not nested:
+                    continue
+
+                itr, calc = self.entries[ix]
+                lret.append(itr)
+
+                if calc.rowEnd > subselend:
+                    subselend = calc.rowEnd
+
+            return lret
+
+    class SearchIndex():
+        """Индекс для поиска товаров по названию, описанию и URL.
+
+        Текст товара приводится к виду, не зависящему от регистра
+        (str.casefold()); из него берутся слова и все подстроки длиной
+        TRIGRAM символов (триграммы).
+        Слово запроса длиной от TRIGRAM символов ищется пересечением
+        множеств товаров по его триграммам, более короткое - по словам
+        текста, начинающимся с него (поиск по отсортированному списку
+        слов); найденные кандидаты проверяются поиском подстроки в тексте.
+
+        Индекс строится при первом поиске (см. WishCalc.search_items()),
+        далее при пересчёте обновляется только для новых и изменившихся
+        товаров (см. ItemCalc.version).
+
+        Поля:
+            active      - булевское значение, False, если индекс ещё
+                          не строился;
+            entries     - словарь, где ключи - Item.id, значения - кортежи
+                          из трёх элементов: экземпляр Item, значение
+                          ItemCalc.version и текст товара;
+            trigrams    - словарь, где ключи - триграммы, значения -
+                          множества Item.id;
+            words       - словарь, где ключи - слова, значения -
+                          множества Item.id;
+            sortedWords - None или отсортированный список ключей words
+                          (составляется при необходимости)."""
+
+        TRIGRAM = 3
+
+        WORD_RX = re.compile(r'\w+')
+
+        def __init__(self):
+            self.clear()
+
+        def clear(self):
+            self.active = False
+            self.entries = dict()
+            self.trigrams = dict()
+            self.words = dict()
+            self.sortedWords = None
+
+        def __len__(self):
+            return len(self.entries)
+
+        @staticmethod
+        def item_text(item):
+            """Возвращает текст товара item для индексирования."""
+
+            parts = [item.name, item.info]
+
+            for url, urlname in item.url:
+                parts.append(url)
+                parts.append(urlname)
+
+            return '\n'.join(parts).casefold()
+
+        @classmethod
+        def text_trigrams(cls, text):
+            return set(map(lambda ix: text[ix:ix + cls.TRIGRAM],
+                range(len(text) - cls.TRIGRAM + 1)))
+
+        @staticmethod
+        def __index_add(index, keys, itemid):
+            for key in keys:
+                ids = index.get(key)
+                if ids is None:
+                    ids = index[key] = set()
+
+                ids.add(itemid)
+
+        @staticmethod
+        def __index_remove(index, keys, itemid):
+            for key in keys:
+                ids = index.get(key)
+                if ids is not None:
+                    ids.discard(itemid)
+                    if not ids:
+                        del index[key]
+
+        def __add_text(self, itemid, text):
+            self.__index_add(self.trigrams, self.text_trigrams(text), itemid)
+
+            words = set(self.WORD_RX.findall(text))
+            nwords = len(self.words)
+            self.__index_add(self.words, words, itemid)
+
+            if len(self.words) != nwords:
+                self.sortedWords = None
+
+        def __remove_text(self, itemid, text):
+            self.__index_remove(self.trigrams, self.text_trigrams(text), itemid)
+
+            nwords = len(self.words)
+            self.__index_remove(self.words, set(self.WORD_RX.findall(text)), itemid)
+
+            if len(self.words) != nwords:
+                self.sortedWords = None
+
+        def update(self, item, version):
+            """Добавление товара item (экземпляра WishCalc.Item с назначенным
+            идентификатором) в индекс или обновление, если с прошлого раза
+            изменились экземпляр Item или номер версии version."""
+
+            entry = self.entries.get(item.id)
+
+            if entry is not None and entry[0] is item and entry[1] == version:
+                return
+
+            text = self.item_text(item)
+
+            if entry is not None:
+                if entry[2] == text:
+                    self.entries[item.id] = (item, version, entry[2])
+                    return
+
+                self.__remove_text(item.id, entry[2])
+
+            self.entries[item.id] = (item, version, text)
+            self.__add_text(item.id, text)
+
+        def remove(self, itemid):
+            entry = self.entries.pop(itemid, None)
+            if entry is not None:
+                self.__remove_text(itemid, entry[2])
+
+        def prune(self, validids):
+            """Удаление из индекса товаров, идентификаторов которых
+            нет в validids (словаре или множестве)."""
+
+            for itemid in list(filter(lambda i: i not in validids, self.entries)):
+                self.remove(itemid)
+
+        def __word_candidates(self, word):
+            """Возвращает множество Item.id товаров, которые могут
+            содержать слово запроса word."""
+
+            if len(word) >= self.TRIGRAM:
+                sets = []
+                for trigram in self.text_trigrams(word):
+                    ids = self.trigrams.get(trigram)
+                    if ids is None:
+                        return set()
+
+                    sets.append(ids)
+
+                # пересекаем начиная с самого короткого
+                sets.sort(key=len)
+                return sets[0].intersection(*sets[1:])
+
+            if self.sortedWords is None:
+                self.sortedWords = sorted(self.words)
+
+            ret = set()
+
+            ix = bisect_left(self.sortedWords, word)
+            while ix < len(self.sortedWords) and self.sortedWords[ix].startswith(word):
+                ret.update(self.words[self.sortedWords[ix]])
+                ix += 1
+
+            return ret
+
+        def search(self, query):
+            """Поиск товаров, в тексте которых есть все слова строки
+            query. Возвращает множество Item.id."""
+
+            result = None
+
+            # длинные слова - первыми, у них меньше кандидатов
+            for word in sorted(set(query.casefold().split()), key=len, reverse=True):
+                candidates = self.__word_candidates(word)
+                if result is not None:
+                    candidates &= result
+
+                if len(word) >= self.TRIGRAM:
+                    # триграммы могут быть и не подряд
+                    candidates = set(filter(lambda i: word in self.entries[i][2], candidates))
+
+                result = candidates
+                if not result:
+                    break
+
+            return result if result is not None else set()
+
+    class TreeLayout():
+        """Плоское представление дерева - строки в порядке обхода
+        (pre-order, он же Euler tour без возвратов). Строки любого
+        поддерева идут подряд: у элемента с ItemCalc.rowIndex = start
+        и ItemCalc.rowEnd = end строки поддерева - [start, end),
+        вложенные - [start + 1, end).
+
+        Строится при вызове WishCalc.recalculate(). После изменений
+        в структуре дерева до вызова recalculate() пусто.
+
+        Поля:
+            iters       - список экземпляров Gtk.TreeIter,
+            items       - список экземпляров WishCalc.Item."""
+
+        __slots__ = 'iters', 'items'
+
+        def __init__(self):
+            self.clear()
+
+        def clear(self):
+            self.iters = []
+            self.items = []
+
+        def __len__(self):
+            return len(self.iters)
+
+        def build(self, rows):
+            """Заполнение полей.
+            rows - список экземпляров TreeModelRow (см. get_tree_model_rows())
+                   со значением столбца COL_ITEM_OBJ первым."""
+
+            self.iters = list(map(lambda row: row.itr, rows))
+            self.items = list(map(lambda row: row.values[0], rows))
+
+        def subtree_items(self, calc, withself=False):
+            """Возвращает список экземпляров Item, вложенных в элемент
+            с полями calc (экземпляром ItemCalc) на всех уровнях,
+            в порядке обхода; если withself=True - и сам элемент."""
+
+            return self.items[calc.rowIndex if withself else calc.rowIndex + 1:calc.rowEnd]
+
+    class RandomPicker():
+        """Случайный выбор из списка с заданными весами элементов
+        за O(1) (alias method, он же метод Уолкера-Воуза).
+        Таблица строится один раз при создании экземпляра."""
+
+        __slots__ = 'candidates', 'prob', 'alias'
+
+        def __init__(self, candidates, weights=None):
+            """candidates  - список, из которого производится выбор;
+            weights         - None (равновероятный выбор) или список
+                              положительных чисел - весов элементов
+                              candidates."""
+
+            self.candidates = candidates
+            self.prob = None
+            self.alias = None
+
+            if weights is None or not candidates:
+                return
+
+            n = len(candidates)
+            total = sum(weights)
+
+            # вероятности, отмасштабированные так, что в среднем равны 1
+            scaled = list(map(lambda w: w * n / total, weights))
+
+            self.prob = [1.0] * n
+            self.alias = list(range(n))
+
+            small = []
+            large = []
+
+            for ix, p in enumerate(scaled):
+                (small if p < 1.0 else large).append(ix)
+
+            while small and large:
+                ixs = small.pop()
+                ixl = large[-1]
+
+                self.prob[ixs] = scaled[ixs]
+                self.alias[ixs] = ixl
+
+                scaled[ixl] -= 1.0 - scaled[ixs]
+                if scaled[ixl] < 1.0:
+                    large.pop()
+                    small.append(ixl)
+
+            # оставшиеся (в т.ч. из-за погрешностей округления) - с prob = 1.0
+
+        def __len__(self):
+            return len(self.candidates)
+
+        def pick(self, rnd=random):
+            """Возвращает случайный элемент списка candidates
+            или None, если список пуст.
+            rnd - экземпляр random.Random или модуль random."""
+
+            if not self.candidates:
+                return None
+
+            ix = rnd.randrange(len(self.candidates))
+
+            if self.prob is not None and rnd.random() >= self.prob[ix]:
+                ix = self.alias[ix]
+
+            return self.candidates[ix]
 
     class Item():
         """Данные для описания товара.
@@ -181,9 +752,15 @@ class WishCalc():
         JSON.
         Внимание! Имя "items" предназначено для обработчика JSON,
         списки вложенных элементов хранятся в Gtk.TreeStore,
-        а не в экземпляре Item!"""
+        а не в экземпляре Item!
+
+        Экземпляров может быть очень много, потому поля - в __slots__."""
+
+        __slots__ = 'id', 'name', 'cost', 'quantity', 'info', 'url', \
+            'incart', 'paid', 'importance', 'sum', 'calc'
 
         # имена полей (для JSON)
+        ID = 'id'
         NAME = 'name'
         COST = 'cost'
         QUANTITY = 'quantity'
@@ -195,6 +772,9 @@ class WishCalc():
         PAID = 'paid'
         ITEMS = 'items'
 
+        # поля исходных данных (т.е. все, кроме вычисляемых)
+        DATA_FIELDS = (NAME, COST, QUANTITY, INFO, URL, INCART, PAID, IMPORTANCE)
+
         __expar = namedtuple('__expar', 'name dispname tostr')
 
         CSV_FIELDS = (__expar(NAME, 'Название', str),
@@ -217,13 +797,21 @@ class WishCalc():
             return ni
 
         def __init__(self):
+            # идентификатор товара - целое > 0, уникальное в пределах
+            # документа, или None, если ещё не назначен;
+            # назначается при вызове WishCalc.recalculate(), хранится
+            # в файле; при копировании товара НЕ копируется
+            self.id = None
+
             # поля исходных данных
 
             self.name = ''
             self.cost = 0
             self.quantity = 1
             self.info = ''
-            self.url = []
+            # кортеж из кортежей по ДВА элемента - URL и отображаемое имя;
+            # кортеж неизменяемый, при изменениях заменяется целиком!
+            self.url = ()
             self.incart = False
             self.paid = False
 
@@ -235,49 +823,28 @@ class WishCalc():
             # следующие поля используются только UI и в файле не сохраняются!
             #
 
-            # поля, которые вычисляются при вызове WishCalc.recalculate()
-            # их значения могут зависеть от предыдущих по списку товаров!
-            # вычисленные значения - целые положительные числа;
-            # значение поля, равное 0, означает, что уже усё, денег достаточно
-            # значение None означает "вычислить не удалось" и ошибкой не является
-
             # сумма (cost * quantity)
             self.sum = 0
 
-            # недостающая сумма
-            self.needCash = None
-
-            # недостающая сумма с учётом предыдущих по списку товаров
-            self.needTotal = None
-
-            # доступная сумма
-            self.availCash = None
-
-            # кол-во месяцев на накопление
-            self.needMonths = None
-
-            # максимальное значение importance вложенных товаров
-            self.childrenImportance = 0
-
-            self.childrenSelected = False
-            self.childrenInCart = False
+            # None или экземпляр WishCalc.ItemCalc - значения, вычисляемые
+            # при вызове WishCalc.recalculate()
+            self.calc = None
 
         def clear(self):
             """Очистка полей данных"""
 
+            self.id = None
             self.name = ''
             self.cost = 0
             self.quantity = 1 # внимание! значение 0 - тоже верное!
             self.sum = 0
             self.info = ''
-            self.url.clear()
+            self.url = ()
             self.importance = 0
             self.incart = False
             self.paid = False
 
-            self.childrenImportance = 0
-            self.childSelected = False
-            self.childInCart = False
+            self.calc = None
 
         def calculate_sum(self):
             self.sum = self.cost * self.quantity
@@ -296,22 +863,38 @@ class WishCalc():
 
             self.info = other.info
 
-            # патамушто список!
-            self.url = other.url.copy()
+            # кортеж неизменяемый, копировать незачем
+            self.url = other.url
 
             self.incart = other.incart
             self.paid = other.paid
 
             self.importance = other.importance
 
+        def get_changes(self, other):
+            """Сравнение полей исходных данных с полями other (экземпляра
+            WishCalc.Item).
+            Возвращает словарь, где ключи - имена отличающихся полей,
+            а значения - значения полей other; если отличий нет -
+            словарь пустой."""
+
+            changes = dict()
+
+            for field in self.DATA_FIELDS:
+                value = getattr(other, field)
+                if value != getattr(self, field):
+                    changes[field] = value
+
+            return changes
+
         def __repr__(self):
             # для отладки
-            return '%s(name="%s", cost=%d, quantity=%d, sum=%d, info="%s", url=%s, importance=%d, incart=%s, paid=%s, needCash=%s, needTotal=%s, availCash=%s, needMonths=%s)' %\
+            return '%s(name="%s", cost=%d, quantity=%d, sum=%d, info="%s", url=%s, importance=%d, incart=%s, paid=%s, calc=%s)' %\
                 (self.__class__.__name__,
                  self.name, self.cost, self.quantity, self.sum,
                  self.info, repr(self.url),
                  self.importance, self.incart, self.paid,
-                 self.needCash, self.needTotal, self.availCash, self.needMonths)
+                 repr(self.calc))
 
         def get_fields_dict(self):
             """Возвращает словарь с именами и значениями полей"""
@@ -335,6 +918,9 @@ class WishCalc():
             if self.paid:
                 d[self.PAID] = self.paid
 
+            if self.id is not None:
+                d[self.ID] = self.id
+
             # поля sum и need* для сохранения не предназначены и в словарь не кладутся!
 
             return d
@@ -351,6 +937,11 @@ class WishCalc():
 
             self.clear()
 
+            # в файлах старых версий идентификаторов нет
+            self.id = get_dict_item(srcdict, self.ID, int,
+                rangecheck=lambda i: i > 0 and not isinstance(i, bool),
+                fallback=None, failifnokey=False)
+
             self.name = get_dict_item(srcdict, self.NAME, str, rangecheck=lambda s: s != '')
             self.cost = get_dict_item(srcdict, self.COST, int) #lambda c: c >= -1)
             self.quantity = get_dict_item(srcdict, self.QUANTITY, int,
@@ -359,7 +950,7 @@ class WishCalc():
 
             self.info = get_dict_item(srcdict, self.INFO, str, fallback='')
 
-            self.url.clear()
+            urls = []
             _url = get_dict_item(srcdict, self.URL, str, list, fallback=[])
 
             # загрузка данных версии < 2.7.0
@@ -367,7 +958,7 @@ class WishCalc():
                 # начиная с версии 2.7.0 можно хранить несколько URL
                 # в списке по ДВА элемента - URL и отображаемое имя (м.б. пустое)
                 if _url:
-                    self.url.append([_url, ''])
+                    urls.append((_url, ''))
             elif isinstance(_url, list):
                 for surl in _url:
                     if len(surl) != 2:
@@ -379,10 +970,12 @@ class WishCalc():
 
                     if surl[0]:
                         #TODO а не надо ли ограничить максимальное кол-во URL?
-                        self.url.append(surl)
+                        urls.append(tuple(surl))
             else:
                 raise TypeError('неправильный тип элемента url')
 
+            self.url = tuple(urls)
+
             self.importance = get_dict_item(srcdict, self.IMPORTANCE, int, fallback=0)
             # принудительно вгоним в рамки
             if self.importance < IMPORTANCE_LEVEL_MIN:
@@ -407,8 +1000,31 @@ class WishCalc():
         totalCash           - все имеющиеся в наличии средства;
         refillCash          - планируемая сумма ежемесячных пополнений;
         totalRemain         - расчётный остаток (в файле не хранится);
+        valueTable          - экземпляр ValueTable, общие значения полей
+                              товаров;
         comment             - краткое описание файла для отображения в UI
-                              (в заголовке окна)."""
+                              (в заголовке окна);
+        totalItems          - общее количество элементов дерева
+                              (обновляется при вызове recalculate());
+        totalItemsChecked   - общее количество помеченных элементов
+                              дерева, включая вложенные в помеченные;
+        totalSelectedSum,
+        totalSelectedCount  - сумма и количество помеченных элементов
+                              без учёта вложенных в помеченные;
+                              эти три поля обновляются при вызове
+                              recalculate() и set_item_checked();
+        checkedIndex        - экземпляр CheckedIndex;
+        layout              - экземпляр TreeLayout, плоское представление
+                              дерева (обновляется при вызове recalculate());
+        randomPickers       - словарь, где ключи - кортежи параметров
+                              random_item_iter(), а значения -
+                              экземпляры RandomPicker;
+        treeDepth           - максимальная глубина вложенности дерева
+                              (обновляется при вызове recalculate());
+        lastRecalcTime,
+        lastSaveTime        - продолжительность последнего пересчёта
+                              и сохранения в секундах (None, если
+                              их ещё не было)."""
 
         self.filename = filename
 
@@ -423,16 +1039,16 @@ class WishCalc():
         дерево объектов храним непосредственно в Gtk.TreeStore."""
 
         # при изменениях в wishcalc.ui - приводить в соответствие!
-        self.store = Gtk.TreeStore(GObject.TYPE_PYOBJECT, GObject.TYPE_STRING,
-            GObject.TYPE_STRING, GObject.TYPE_STRING,
-            Pixbuf, GObject.TYPE_STRING, GObject.TYPE_STRING,
-            GObject.TYPE_STRING, GObject.TYPE_STRING,
-            Pixbuf,
+        self.store = Gtk.TreeStore(GObject.TYPE_PYOBJECT,
             GObject.TYPE_BOOLEAN,
-            Pixbuf,
             GObject.TYPE_BOOLEAN,
+            GObject.TYPE_BOOLEAN,
+            GObject.TYPE_INT64, GObject.TYPE_INT64, GObject.TYPE_INT,
+            GObject.TYPE_STRING,
             )
 
+        self.valueTable = self.ValueTable()
+
         self.totalCash = 0
         self.refillCash = 0
         self.totalRemain = 0
@@ -442,6 +1058,29 @@ class WishCalc():
         self.totalInCartCount = 0
         self.comment = ''
 
+        self.totalItems = 0
+        self.totalItemsChecked = 0
+        self.checkedIndex = self.CheckedIndex()
+        self.layout = self.TreeLayout()
+        self.randomPickers = dict()
+        self.searchIndex = self.SearchIndex()
+
+        # индекс товаров по идентификаторам: ключи - значения Item.id,
+        # значения - экземпляры Gtk.TreeIter (итераторы TreeStore
+        # остаются действительными, пока строка не удалена);
+        # строится при вызове recalculate()
+        self.itemIndex = dict()
+        # следующий свободный идентификатор товара
+        self.nextItemId = 1
+
+        self.treeDepth = 0
+        self.lastRecalcTime = None
+        self.lastSaveTime = None
+
+        # кортеж узлов верхнего уровня последнего снимка
+        # (см. make_snapshot())
+        self.lastSnapshotItems = ()
+
     def __str__(self):
         # для отладки
         return '%s: filename="%s", comment="%s", totalCash=%d, refillCash=%d, totalRemain=%d' %\
@@ -458,6 +1097,10 @@ class WishCalc():
         """Очистка списка."""
 
         self.store.clear()
+        self.valueTable.clear()
+        self.invalidate_indexes()
+        self.searchIndex.clear()
+        self.nextItemId = 1
 
         self.totalCash = 0
         self.refillCash = 0
@@ -475,9 +1118,25 @@ class WishCalc():
                       сообщений об ошибках.
 
         Если parent == None - элементы добавляются в верхний уровень
-        дерева, иначе - как дочерние относительно parent."""
+        дерева, иначе - как дочерние относительно parent.
+
+        Вложенные списки обрабатываются без рекурсии, с помощью
+        явного стека, так что глубина дерева не ограничена."""
+
+        # стек из кортежей (parentitr, итератор по списку, level)
+        stack = [(parentitr, enumerate(fromlist, 1), level)]
+
+        while stack:
+            parentitr, items, level = stack[-1]
+
+            nextitem = next(items, None)
+            if nextitem is None:
+                # список кончился
+                stack.pop()
+                continue
+
+            ixitem, itemdict = nextitem
 
-        for ixitem, itemdict in enumerate(fromlist, 1):
             nextlevel = level + [ixitem]
             __val_error = lambda s: '%s элемента %s списка "%s"' %\
                 (s, ':'.join(map(str, nextlevel)), self.VAR_WISHLIST)
@@ -492,11 +1151,123 @@ class WishCalc():
 
                 # есть вложенные элементы?
                 subitems = get_dict_item(itemdict, item.ITEMS, list, fallback=[])
-                if subitems:
-                    self.load_subitems(itr, subitems, nextlevel)
             except Exception as ex:
                 raise ValueError(__val_error(str(ex)))
 
+            if subitems:
+                stack.append((itr, enumerate(subitems, 1), nextlevel))
+
+    @classmethod
+    def items_from_list(cls, fromlist, errors=None):
+        """Создание дерева экземпляров WishCalc.Item из списка словарей
+        с полями элементов (напр. из буфера обмена).
+
+        fromlist    - список словарей с полями элементов;
+        errors      - None или список; в последнем случае сообщения
+                      об ошибках добавляются в него, а ошибочные элементы
+                      (вместе с вложенными) пропускаются; иначе при первой
+                      же ошибке генерируется исключение ValueError.
+
+        TreeStore и прочие поля WishCalc здесь не используются, потому
+        метод можно вызывать из другого потока.
+        Возвращает кортеж из двух элементов:
+        1й: список кортежей (экземпляр Item, список вложенных
+            таких же кортежей),
+        2й: общее количество созданных элементов."""
+
+        nitems = 0
+        ret = []
+
+        # стек из кортежей (список для выхлопа, итератор по списку, level)
+        stack = [(ret, enumerate(fromlist, 1), [])]
+
+        while stack:
+            dest, items, level = stack[-1]
+
+            nextitem = next(items, None)
+            if nextitem is None:
+                stack.pop()
+                continue
+
+            ixitem, itemdict = nextitem
+
+            nextlevel = level + [ixitem]
+
+            try:
+                if not isinstance(itemdict, dict):
+                    raise ValueError('неправильный тип')
+
+                item = cls.Item()
+                item.set_fields_dict(itemdict)
+
+                subitems = get_dict_item(itemdict, item.ITEMS, list, fallback=[])
+            except Exception as ex:
+                emsg = 'элемент %s: %s' % (':'.join(map(str, nextlevel)), str(ex))
+
+                if errors is None:
+                    raise ValueError(emsg)
+
+                errors.append(emsg)
+                continue
+
+            nitems += 1
+            subdest = []
+            dest.append((item, subdest))
+
+            if subitems:
+                stack.append((subdest, enumerate(subitems, 1), nextlevel))
+
+        return (ret, nitems)
+
+    def insert_items(self, parentitr, afteritr, items):
+        """Вставка в self.store дерева элементов, созданного
+        items_from_list().
+
+        parentitr   - None или экземпляр Gtk.TreeIter - группа, в которую
+                      вставляются элементы;
+        afteritr    - None или экземпляр Gtk.TreeIter - элемент уровня
+                      parentitr, после которого вставляются элементы
+                      (если None - элементы вставляются в начало уровня,
+                      как у Gtk.TreeStore.insert_after());
+        items       - список кортежей (см. items_from_list()).
+
+        Возвращает кортеж из экземпляров Item и Gtk.TreeIter последнего
+        вставленного элемента верхнего уровня (или (None, None),
+        если вставлять было нечего).
+        После вызова этого метода должен быть вызван recalculate()."""
+
+        lastitem = None
+
+        # вставленные элементы - новые товары, идентификаторы (если они
+        # были в буфере обмена) им будут назначены при пересчёте
+
+        for item, subitems in items:
+            item.id = None
+            afteritr = self.store.insert_after(parentitr, afteritr, self.make_store_row(item))
+            lastitem = item
+
+            # вложенные - без рекурсии
+            stack = [(afteritr, iter(subitems))]
+
+            while stack:
+                subparentitr, subiter = stack[-1]
+
+                nextitem = next(subiter, None)
+                if nextitem is None:
+                    stack.pop()
+                    continue
+
+                subitem, subsubitems = nextitem
+                subitem.id = None
+                itr = self.append_item(subparentitr, subitem)
+
+                if subsubitems:
+                    stack.append((itr, iter(subsubitems)))
+
+        self.invalidate_indexes()
+
+        return (lastitem, afteritr if lastitem is not None else None)
+
     def load_str(self, s):
         """Загрузка списка из строки.
         s - строка, которая должна содержать правильный JSON.
@@ -563,31 +1334,255 @@ class WishCalc():
 
         return self.store.get_value(itr, WishCalc.COL_ITEM_OBJ)
 
-    def get_item_checked(self, itr):
-        """Проверяет значение столбца COL_SELECTED элемента дерева,
-        на который указывает itr, и возвращает булевское значение."""
+    def find_item_by_id(self, itemid):
+        """Возвращает экземпляр Gtk.TreeIter элемента дерева с товаром,
+        у которого Item.id == itemid, или None, если такого нет.
+        Если после последнего recalculate() дерево не менялось - O(1)."""
 
-        return self.store.get_value(itr, WishCalc.COL_SELECTED)
+        itr = self.itemIndex.get(itemid)
+        if itr is not None:
+            return itr
+
+        for row in get_tree_model_rows(self.store, None, self.COL_ITEM_OBJ):
+            if row.values[0].id == itemid:
+                return row.itr
+
+        return None
+
+    def get_item_iter(self, item):
+        """Возвращает экземпляр Gtk.TreeIter элемента дерева, содержащего
+        item (экземпляр WishCalc.Item), или None, если такого нет."""
+
+        if item.id is not None:
+            itr = self.itemIndex.get(item.id)
+            if itr is not None and self.get_item(itr) is item:
+                return itr
+
+        # индекс не построен или у товара ещё нет идентификатора
+        for row in get_tree_model_rows(self.store, None, self.COL_ITEM_OBJ):
+            if row.values[0] is item:
+                return row.itr
+
+        return None
+
+    def search_items(self, query, shown=()):
+        """Поиск товаров, в названии, описании или URL которых есть все
+        слова строки query (без учёта регистра; слова короче
+        SearchIndex.TRIGRAM символов ищутся по началам слов).
+        При первом вызове строится индекс (см. SearchIndex), поэтому
+        перед вызовом должен быть вызван recalculate().
+
+        shown   - последовательность Item.id товаров, которые должны
+                  быть видны независимо от query (напр. добавленных
+                  во время поиска); отсутствующие в дереве пропускаются.
+
+        Возвращает кортеж из двух множеств Item.id: найденных товаров
+        и видимых - найденных и shown вместе со всеми группами,
+        в которые они вложены."""
+
+        searchIndex = self.searchIndex
+
+        if not searchIndex.active:
+            if len(self.layout):
+                items = self.layout.items
+            else:
+                items = map(lambda row: row.values[0],
+                    get_tree_model_rows(self.store, None, self.COL_ITEM_OBJ))
+
+            for item in items:
+                if item.id is not None:
+                    searchIndex.update(item, item.calc.version if item.calc is not None else 0)
+
+            searchIndex.active = True
+
+        found = searchIndex.search(query)
+
+        visible = set(found)
+        visible.update(filter(lambda itemid: itemid in searchIndex.entries, shown))
+
+        for itemid in list(visible):
+            # поднимаемся по группам, пока не встретим уже учтённую
+            calc = searchIndex.entries[itemid][0].calc
+
+            while calc is not None and calc.parent is not None:
+                calc = calc.parent
+
+                parentitem = self.layout.items[calc.rowIndex] if calc.rowIndex < len(self.layout) else None
+                if parentitem is None or parentitem.id in visible:
+                    break
+
+                visible.add(parentitem.id)
+
+        return (found, visible)
+
+    def get_item_checked(self, itr):
+        """Проверяет значение столбца COL_SELECTED элемента дерева,
+        на который указывает itr, и возвращает булевское значение."""
+
+        return self.store.get_value(itr, WishCalc.COL_SELECTED)
+
+    def get_subtree_items(self, itr):
+        """Возвращает список экземпляров Item, вложенных (на всех уровнях)
+        в элемент дерева, на который указывает itr, в порядке обхода.
+        Если после последнего recalculate() дерево не менялось - список
+        берётся из self.layout без обхода дерева."""
+
+        item = self.get_item(itr)
+        calc = item.calc
+
+        if calc is not None and calc.rowIndex < len(self.layout) \
+                and self.layout.items[calc.rowIndex] is item:
+            return self.layout.subtree_items(calc)
+
+        return list(map(lambda row: row.values[0],
+            get_tree_model_rows(self.store, itr, self.COL_ITEM_OBJ)))
+
+    def invalidate_indexes(self):
+        """Сброс индексов (помеченных элементов, строк дерева и т.п.),
+        построенных при последнем вызове recalculate().
+        Вызывается при изменениях в структуре дерева; индексы
+        перестраиваются следующим вызовом recalculate()."""
+
+        self.checkedIndex.clear()
+        self.layout.clear()
+        self.randomPickers.clear()
+        self.itemIndex.clear()
+
+    # параметры random_item_iter()
+    RANDOM_UNPAID = 1       # выбирать только неоплаченные
+    RANDOM_UNCHECKED = 2    # выбирать только непомеченные
+
+    def random_item_iter(self, weighted=False, flags=0, rnd=random, itemids=None):
+        """Случайный выбор элемента дерева.
+
+        weighted    - булевское значение; если True - вероятность выбора
+                      элемента пропорциональна его важности (элементы
+                      с неуказанной важностью считаются имеющими вес
+                      на единицу меньше низкой важности);
+        flags       - 0 или комбинация констант RANDOM_*;
+        rnd         - экземпляр random.Random или модуль random;
+        itemids     - None или множество Item.id элементов, из которых
+                      следует выбирать (напр. видимых при поиске).
+
+        Выбор из всего дерева производится из self.layout.iters за O(1);
+        таблица для выбора с учётом важности и/или отбора строится
+        при первом вызове с такими параметрами после recalculate().
+        Таблица для выбора из itemids строится при каждом вызове,
+        за O(len(itemids)), без обхода дерева.
+        Возвращает экземпляр Gtk.TreeIter или None, если выбирать
+        не из чего."""
+
+        def __make_picker(rows):
+            # rows - последовательность кортежей (Gtk.TreeIter, Item)
+            candidates = []
+            weights = [] if weighted else None
+
+            for itr, item in rows:
+
+                if flags & self.RANDOM_UNPAID and item.paid:
+                    continue
+
+                if flags & self.RANDOM_UNCHECKED and item.calc.checked:
+                    continue
+
+                candidates.append(itr)
+
+                if weighted:
+                    weights.append(item.importance + 1)
+
+            return self.RandomPicker(candidates, weights)
+
+        if itemids is not None:
+            # порядок - по идентификаторам, чтобы при одинаковом
+            # состоянии rnd выбор был одинаковым
+            itrs = filter(lambda itr: itr is not None, map(self.itemIndex.get, sorted(itemids)))
+
+            return __make_picker(map(lambda itr: (itr, self.get_item(itr)), itrs)).pick(rnd)
+
+        if not weighted and not flags:
+            return rnd.choice(self.layout.iters) if self.layout.iters else None
+
+        key = (weighted, flags)
+
+        picker = self.randomPickers.get(key)
+
+        if picker is None:
+            picker = self.randomPickers[key] = __make_picker(zip(self.layout.iters, self.layout.items))
+
+        return picker.pick(rnd)
 
     def get_checked_items(self):
-        """Проверяет значение столбцов COL_SELECTED элементов дерева,
-        и возвращает список экземпляров Gtk.TreeIter."""
+        """Возвращает список экземпляров Gtk.TreeIter помеченных
+        элементов дерева (в порядке обхода дерева).
+        Вложенные в помеченный элемент в список не попадают.
+        Список берётся из self.checkedIndex, т.е. дерево не обходится,
+        но после изменений в структуре дерева перед вызовом этого
+        метода должен быть вызван recalculate()."""
+
+        return self.checkedIndex.get_iters()
+
+    def set_item_checked(self, itr, checked):
+        """Установка значения столбца COL_SELECTED элемента дерева,
+        на который указывает itr, равным checked (булевскому значению).
+
+        Значения totalSelectedSum, totalSelectedCount, totalItemsChecked
+        и индекс помеченных элементов обновляются здесь же - проходом
+        только по группам, содержащим элемент, а не по всему дереву.
+        Для элементов, добавленных после последнего вызова recalculate(),
+        вызывается полный пересчёт."""
+
+        self.store.set_value(itr, self.COL_SELECTED, checked)
+
+        calc = self.get_item(itr).calc
+        if calc is None:
+            self.recalculate()
+            return
+
+        if calc.checked == checked:
+            return
+
+        def __selected(calc):
+            # вклад элемента в сумму и количество помеченных на уровне
+            if calc.checked:
+                return (self.get_item(itr).sum, 1)
+            else:
+                return (calc.subSelectedSum, calc.subSelectedCount)
 
-        def __get_checked_from(itr):
-            if (itr is not None) and (self.store.get_value(itr, self.COL_SELECTED)):
-                return [itr]
+        oldsum, oldcount = __selected(calc)
 
-            lret = []
+        calc.checked = checked
 
-            itr = self.store.iter_children(itr)
-            while itr is not None:
-                lret += __get_checked_from(itr)
+        if checked:
+            self.checkedIndex.add(itr, calc)
+            self.totalItemsChecked += 1
+        else:
+            self.checkedIndex.remove(calc)
+            self.totalItemsChecked -= 1
 
-                itr = self.store.iter_next(itr)
+        # таблицы случайного выбора непомеченных - устарели
+        for key in list(filter(lambda k: k[1] & self.RANDOM_UNCHECKED, self.randomPickers)):
+            del self.randomPickers[key]
 
-            return lret
+        newsum, newcount = __selected(calc)
+
+        dsum = newsum - oldsum
+        dcount = newcount - oldcount
+
+        # обновляем группы, в которые вложен элемент; помеченная группа
+        # учитывается целиком, потому выше неё изменения не идут
+        parent = calc.parent
+        while parent is not None:
+            parent.subSelectedSum += dsum
+            parent.subSelectedCount += dcount
+            parent.childrenSelected = parent.subSelectedCount > 0
+
+            if parent.checked:
+                return
+
+            parent = parent.parent
 
-        return __get_checked_from(None)
+        self.totalSelectedSum += dsum
+        self.totalSelectedCount += dcount
 
     def replace_item(self, itr, item):
         """Замена элемента в TreeStore.
@@ -598,24 +1593,48 @@ class WishCalc():
         Внимание! В store сейчас кладём только ссылку на объект,
         прочие поля будут заполняться из UI и методом recalculate()."""
 
+        self.valueTable.intern_item(item)
         self.store.set_value(itr, self.COL_ITEM_OBJ, item)
 
+    def apply_item_changes(self, itr, changes):
+        """Изменение товара на месте - без замены экземпляра WishCalc.Item
+        в TreeStore (в отличие от replace_item()), так что вычисленные
+        ранее значения (и строка в TreeView) остаются привязанными к нему.
+
+        itr         - экземпляр Gtk.TreeIter, позиция в TreeStore;
+        changes     - словарь с изменёнными полями (см. WishCalc.Item.get_changes()).
+
+        Если changes не пустой, номер версии товара (ItemCalc.version)
+        увеличивается.
+        Возвращает экземпляр WishCalc.Item.
+        После вызова этого метода должен быть вызван recalculate()."""
+
+        item = self.get_item(itr)
+
+        if not changes:
+            return item
+
+        for field, value in changes.items():
+            setattr(item, field, value)
+
+        self.valueTable.intern_item(item)
+        item.calculate_sum()
+
+        if item.calc is None:
+            item.calc = self.ItemCalc()
+
+        item.calc.version += 1
+
+        return item
+
     def select_items(self, select):
         """Устанавливает значение столбца COL_SELECTED для всех элементов
         store значением select (булевским)."""
 
-        def __select_items(parentitr):
-            itr = self.store.iter_children(parentitr)
-            while itr is not None:
-                item = self.store.set_value(itr, self.COL_SELECTED, select)
-
-                # "дети" есть? а если найду?
-                if self.store.iter_n_children(itr) > 0:
-                    __select_items(itr)
+        def __select_item(model, path, itr, data=None):
+            model.set_value(itr, self.COL_SELECTED, select)
 
-                itr = self.store.iter_next(itr)
-
-        __select_items(None)
+        self.store.foreach(__select_item)
 
     def make_store_row(self, item):
         """Создаёт и возвращает кортеж со значениями полей для вставки/добавления
@@ -624,9 +1643,14 @@ class WishCalc():
         значения остальных полей изменяются из UI и вызовом метода
         recalculate().
         Метод же make_store_row() нужен для того, чтоб в ста местах
-        программы не вспоминать количество и порядок полей TreeModel."""
+        программы не вспоминать количество и порядок полей TreeModel.
+        Заодно значения полей item заменяются общими для документа
+        (см. ValueTable)."""
+
+        self.valueTable.intern_item(item)
 
-        return (item, '', '', '', None, '', '', '', '', None, False, None, False)
+        return (item, False, False, False,
+            0, 0, 0, '')
 
     def append_item(self, parentitr, item):
         """Добавление нового элемента в TreeStore.
@@ -654,20 +1678,91 @@ class WishCalc():
 
         items = []
 
-        itr = self.store.iter_children(parentitr)
-        while itr is not None:
-            item = self.store.get_value(itr, self.COL_ITEM_OBJ)
-            itemdict = item.get_fields_dict()
+        rows = get_tree_model_rows(self.store, parentitr, self.COL_ITEM_OBJ)
 
-            # "дети" есть? а если найду?
-            if self.store.iter_n_children(itr) > 0:
-                itemdict[self.Item.ITEMS] = self.items_to_list(itr)
+        # словари, соответствующие строкам rows
+        itemdicts = []
 
-            items.append(itemdict)
-            itr = self.store.iter_next(itr)
+        for row in rows:
+            itemdict = row.values[0].get_fields_dict()
+            itemdicts.append(itemdict)
+
+            if row.parent < 0:
+                items.append(itemdict)
+            else:
+                parentdict = itemdicts[row.parent]
+
+                # "дети" есть? а если найду?
+                if self.Item.ITEMS not in parentdict:
+                    parentdict[self.Item.ITEMS] = []
+
+                parentdict[self.Item.ITEMS].append(itemdict)
 
         return items
 
+    def items_to_json_str(self, itrs):
+        """Возвращает строку с компактным (без отступов) JSON - списком
+        словарей с полями элементов, на которые указывают экземпляры
+        Gtk.TreeIter из списка itrs, со всеми вложенными элементами.
+
+        Результат тот же, что у json.dumps() списка словарей, полученных
+        get_fields_dict() и items_to_list(), но промежуточные словари
+        для всего дерева не создаются - JSON каждого элемента сразу
+        дописывается в выхлоп."""
+
+        encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+        itemsopen = ',%s:[' % encode(self.Item.ITEMS)
+
+        buf = ['[']
+        # после элемента (но не после открывающей скобки) нужна запятая
+        needcomma = False
+
+        def __item_begin(item, haschildren):
+            nonlocal needcomma
+
+            if needcomma:
+                buf.append(',')
+
+            itemstr = encode(item.get_fields_dict())
+
+            if haschildren:
+                # словарь не закрываем - дальше будут вложенные
+                buf.append(itemstr[:-1])
+                buf.append(itemsopen)
+                needcomma = False
+            else:
+                buf.append(itemstr)
+                needcomma = True
+
+        for itr in itrs:
+            rows = get_tree_model_rows(self.store, itr, self.COL_ITEM_OBJ)
+
+            __item_begin(self.get_item(itr), len(rows) > 0)
+
+            # стек индексов строк, на которых заканчиваются незакрытые группы
+            stack = [len(rows)] if rows else []
+
+            for ix, row in enumerate(rows):
+                while stack[-1] <= ix:
+                    stack.pop()
+                    buf.append(']}')
+                    needcomma = True
+
+                __item_begin(row.values[0], row.nchildren > 0)
+
+                if row.nchildren:
+                    stack.append(row.end)
+
+            while stack:
+                stack.pop()
+                buf.append(']}')
+                needcomma = True
+
+        buf.append(']')
+
+        return ''.join(buf)
+
     def save_str(self):
         """Возвращает строку, содержащую JSON с содержимым списка элементов
         TreeStore и прочих полей.
@@ -698,35 +1793,32 @@ class WishCalc():
             csvw.writerow(map(lambda ep: ep.dispname if self.exportHRHeaders else ep.name,
                 self.Item.CSV_FIELDS))
 
-            def __export_node(fromitr, subsel):
-                itr = self.store.iter_children(fromitr)
-
-                while itr is not None:
-                    item, selected = self.store.get(itr, self.COL_ITEM_OBJ, self.COL_SELECTED)
-
-                    if selected or subsel or self.totalSelectedCount == 0:
-                        rd = item.get_fields_dict()
-                        erow = []
-
-                        for ep in self.Item.CSV_FIELDS:
-                            if ep.name not in rd:
-                                es = ''
-                            elif self.exportHRValues:
-                                es = ep.tostr(rd[ep.name])
-                            else:
-                                es = str(rd[ep.name])
-
-                            erow.append(es)
-
-                        csvw.writerow(erow)
-
-                    # "дети" есть? а если найду?
-                    if self.store.iter_n_children(itr) > 0:
-                        __export_node(itr, selected or subsel)
+            if self.totalSelectedCount == 0:
+                items = map(lambda row: row.values[0],
+                    get_tree_model_rows(self.store, None, self.COL_ITEM_OBJ))
+            else:
+                # только помеченные элементы и вложенные в них -
+                # остальное дерево не трогаем
+                items = []
+                for itr in self.get_checked_items():
+                    items.append(self.get_item(itr))
+                    items += self.get_subtree_items(itr)
+
+            for item in items:
+                rd = item.get_fields_dict()
+                erow = []
+
+                for ep in self.Item.CSV_FIELDS:
+                    if ep.name not in rd:
+                        es = ''
+                    elif self.exportHRValues:
+                        es = ep.tostr(rd[ep.name])
+                    else:
+                        es = str(rd[ep.name])
 
-                    itr = self.store.iter_next(itr)
+                    erow.append(es)
 
-            __export_node(None, False)
+                csvw.writerow(erow)
 
     def save(self):
         """Сохраняет содержимое списка элементов TreeStore и прочих полей
@@ -736,188 +1828,288 @@ class WishCalc():
         if not self.filename:
             raise ValueError('%s.save(): не указано имя файла' % self.__class__.__name__)
 
-        tmps = self.save_str()
-
-        # пытаемся сохранить "безопасно"
-        tmpfn = self.filename + '.tmp'
-        with open(tmpfn, 'w+', encoding=JSON_ENCODING) as f:
-            f.write(tmps)
+        with PerfTimer() as t:
+            tmps = self.save_str()
 
-        if os.path.exists(self.filename):
-            os.remove(self.filename)
-        os.rename(tmpfn, self.filename)
+            # пытаемся сохранить "безопасно"
+            tmpfn = self.filename + '.tmp'
+            with open(tmpfn, 'w+', encoding=JSON_ENCODING) as f:
+                f.write(tmps)
 
-    def __recalculate_items(self, parentitr, totalCash, refillCash, totalRemain):
-        """Перерасчет.
-        Производится проход по TreeStore для элементов, дочерних
-        относительно parentitr (экземпляр Gtk.TreeIter, м.б. None для
-        верхнего уровня дерева), для каждого элемента
-        расчитываются значения полей item.needCash и item.needMonths
-        на основе параметров totalCash, refillCash, totalRemain
-        и значений полей элементов (при необходимости рекурсивно).
-
-        Возвращает кортеж из следующих элементов:
-        1й: суммарная цена элементов (с учётом количества),
-        2й: суммарная цена за вычетом оплаченных товаров,
-        3й: обновлённое значение totalRemain,
-        4й: максимальное значение поля importance вложенных элементов
-            (товаров),
-        5й: суммарная стоимость помеченных чекбоксами в UI элементов;
-        6й: количество помеченных элементов (без учёта вложенности, если помечен элемент верхнего уровня);
-        7й: суммарная стоимость заказанных товаров;
-        8й: количество заказанных товаров;
-        9й: общее количество элементов на текущем и вложенных уровнях;
-        10й: общее количество помеченных элементов на текущем и вложенных уровнях."""
-
-        totalNeedCash = 0
-        totalCost = 0 # общая сумма
-        totalNeed = 0 # общая сумма за вычетом оплаченных
-        maxImportance = 0
-        totalSelectedSum = 0
-        totalSelectedCount = 0
-        totalInCartSum = 0
-        totalInCartCount = 0
-
-        totalItems = 0
-        totalItemsChecked = 0
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmpfn, self.filename)
 
-        itr = self.store.iter_children(parentitr)
-        while itr is not None:
-            item = self.store.get_value(itr, self.COL_ITEM_OBJ)
-            itemsel = self.store.get_value(itr, self.COL_SELECTED)
+        self.lastSaveTime = t.elapsed
 
-            totalItems += 1
+    class RecalcLevel():
+        """Промежуточные значения пересчёта одного уровня дерева
+        (см. __recalculate_items())."""
 
-            # сбрасываем, дабы обновлялось!
-            item.childrenImportance = 0
+        __slots__ = 'rowIndex', 'totalRemain', 'totalNeedCash', 'totalCost', \
+            'maxImportance', 'selectedSum', 'selectedCount', \
+            'inCartSum', 'inCartCount', 'totalItems', 'itemsChecked'
 
-            # внимание! всё считаем на основе item.sum, а не item.cost!
+        def __init__(self, rowIndex, totalRemain):
+            """rowIndex     - индекс строки группы, которой принадлежит
+                              уровень (-1 для верхнего уровня дерева);
+            totalRemain     - остаток средств на начало уровня."""
 
-            # "дети" есть? а если найду?
-            nchildren = self.store.iter_n_children(itr)
+            self.rowIndex = rowIndex
+            self.totalRemain = totalRemain
 
-            if nchildren == 0:
-                # одиночный товар
-                if itemsel:
-                    totalSelectedSum += item.sum
-                    totalSelectedCount += 1
+            self.totalNeedCash = 0
+            self.totalCost = 0 # общая сумма
+            self.maxImportance = 0
+            self.selectedSum = 0
+            self.selectedCount = 0 # без учёта вложенности, если помечен элемент верхнего уровня
+            self.inCartSum = 0
+            self.inCartCount = 0
 
-                    totalItemsChecked += 1
+            self.totalItems = 0 # на текущем и вложенных уровнях
+            self.itemsChecked = 0 # на текущем и вложенных уровнях
 
-                if item.incart:
-                    totalInCartSum += item.sum
-                    totalInCartCount += 1
+    def __recalculate_items(self, refillCash, totalRemain):
+        """Перерасчет.
+        Производится проход по TreeStore, для каждого элемента
+        расчитываются значения полей item.calc (экземпляра ItemCalc)
+        на основе параметров refillCash, totalRemain и значений полей
+        элементов.
 
-                item.childSelected = False
-                item.childInCart = False
-            else:
-                # не товар, а группа товаров! для них цена -
-                # общая стоимость вложенных!
-                item.cost, subNeed, subRemain, subImportance, subSelectedSum,\
-                    subSelectedCount, subInCartSum, subInCartCount,\
-                    subTotalItems, subTotalItemsChecked = self.__recalculate_items(itr,
-                        totalCash, refillCash, totalRemain)
-                item.calculate_sum()
-
-                totalItems += subTotalItems
-                # для этого счётчика учитывается и сам элемент, и вложенные!
-                totalItemsChecked += subTotalItemsChecked
+        Дерево обходится без рекурсии (см. get_tree_model_rows());
+        для каждой группы товаров заводится свой экземпляр RecalcLevel,
+        вложенные в группу элементы считаются от остатка на момент
+        начала группы, а сама группа - после вложенных.
 
-                item.childrenSelected = subSelectedCount > 0
-                item.childrenInCart = subInCartCount > 0
+        Возвращает экземпляр RecalcLevel с итогами верхнего уровня
+        дерева (значение totalRemain - обновлённое)."""
 
-                # внимание! если помечена группа товаров - учитываем общую сумму,
-                # а не отдельные помеченные вложенные!
-                if itemsel:
-                    totalSelectedSum += item.sum
-                    totalSelectedCount += 1
-                    # для этого счётчика учитывается и сам элемент, и вложенные!
-                    totalItemsChecked += 1
-                elif subSelectedSum:
-                    totalSelectedSum += subSelectedSum
-                    totalSelectedCount += subSelectedCount
-
-                # внимание! если заказана группа товаров - учитываем общую сумму,
-                # а не отдельные заказанные вложенные!
-                if item.incart:
-                    totalInCartSum += item.sum
-                    totalInCartCount += 1
-                elif subInCartSum:
-                    totalInCartSum += subInCartSum
-                    totalInCartCount += subInCartCount
+        def __item_needs(level, item, calc):
+            """Общая часть расчёта для товаров и групп - после того,
+            как у группы посчитаны вложенные."""
 
-                if item.childrenImportance < subImportance:
-                    item.childrenImportance = subImportance
+            if level.maxImportance < item.importance:
+                level.maxImportance = item.importance
 
-                if item.importance == 0:
-                    if maxImportance < subImportance:
-                        maxImportance = subImportance
-
-            if maxImportance < item.importance:
-                maxImportance = item.importance
-
-            totalCost += item.sum #!!!
+            level.totalCost += item.sum #!!!
 
             if item.sum <= 0:
-                item.needCash = None
-                item.availCash = None
-                item.needMonths = None
+                calc.needCash = None
+                calc.availCash = None
+                calc.needMonths = None
             else:
-                item.needCash = 0
-                item.needTotal = 0
-                item.needMonths = 0
+                calc.needCash = 0
+                calc.needTotal = 0
+                calc.needMonths = 0
 
                 if not (item.incart and item.paid):
-                    if totalRemain >= item.sum:
-                        item.needCash = 0
-                        item.availCash = item.sum
-                        totalRemain -= item.sum
-                    elif totalRemain > 0:
-                        item.needCash = item.sum - totalRemain
-                        item.availCash = totalRemain
-                        totalRemain = 0
+                    if level.totalRemain >= item.sum:
+                        calc.needCash = 0
+                        calc.availCash = item.sum
+                        level.totalRemain -= item.sum
+                    elif level.totalRemain > 0:
+                        calc.needCash = item.sum - level.totalRemain
+                        calc.availCash = level.totalRemain
+                        level.totalRemain = 0
                     else:
-                        item.needCash = item.sum
-                        item.availCash = 0
+                        calc.needCash = item.sum
+                        calc.availCash = 0
 
-                    if item.needCash:
-                        totalNeedCash += item.needCash
-                        item.needTotal = totalNeedCash
+                    if calc.needCash:
+                        level.totalNeedCash += calc.needCash
+                        calc.needTotal = level.totalNeedCash
 
                         if refillCash > 0:
-                            item.needMonths = self.need_months(totalNeedCash, refillCash)
+                            calc.needMonths = self.need_months(level.totalNeedCash, refillCash)
                         else:
-                            item.needMonths = None
+                            calc.needMonths = None
 
-            itr = self.store.iter_next(itr)
+        def __group_done(sub, level):
+            """Завершение расчёта группы товаров.
+            sub     - экземпляр RecalcLevel с итогами вложенных в группу,
+            level   - экземпляр RecalcLevel уровня, на котором
+                      находится группа."""
+
+            item, itemsel = rows[sub.rowIndex].values
+            calc = item.calc
+
+            # не товар, а группа товаров! для них цена -
+            # общая стоимость вложенных!
+            item.cost = sub.totalCost
+            item.calculate_sum()
+
+            level.totalItems += sub.totalItems
+            # для этого счётчика учитывается и сам элемент, и вложенные!
+            level.itemsChecked += sub.itemsChecked
+
+            calc.childrenSelected = sub.selectedCount > 0
+            calc.childrenInCart = sub.inCartCount > 0
+
+            calc.subSelectedSum = sub.selectedSum
+            calc.subSelectedCount = sub.selectedCount
+
+            # внимание! если помечена группа товаров - учитываем общую сумму,
+            # а не отдельные помеченные вложенные!
+            if itemsel:
+                level.selectedSum += item.sum
+                level.selectedCount += 1
+                # для этого счётчика учитывается и сам элемент, и вложенные!
+                level.itemsChecked += 1
+            elif sub.selectedCount:
+                level.selectedSum += sub.selectedSum
+                level.selectedCount += sub.selectedCount
+
+            # внимание! если заказана группа товаров - учитываем общую сумму,
+            # а не отдельные заказанные вложенные!
+            if item.incart:
+                level.inCartSum += item.sum
+                level.inCartCount += 1
+            elif sub.inCartSum:
+                level.inCartSum += sub.inCartSum
+                level.inCartCount += sub.inCartCount
+
+            if calc.childrenImportance < sub.maxImportance:
+                calc.childrenImportance = sub.maxImportance
+
+            if item.importance == 0:
+                if level.maxImportance < sub.maxImportance:
+                    level.maxImportance = sub.maxImportance
+
+            __item_needs(level, item, calc)
+
+        rows = get_tree_model_rows(self.store, None, self.COL_ITEM_OBJ, self.COL_SELECTED)
+
+        self.invalidate_indexes()
+        checkedIndex = self.checkedIndex
+        itemIndex = self.itemIndex
+        searchIndex = self.searchIndex if self.searchIndex.active else None
+
+        # товары без идентификаторов (или с повторяющимися)
+        noids = []
+
+        # стек уровней - вместо рекурсии
+        stack = [self.RecalcLevel(-1, totalRemain)]
+
+        for ix, row in enumerate(rows):
+            # завершаем группы, все вложенные элементы которых посчитаны
+            while stack[-1].rowIndex >= 0 and rows[stack[-1].rowIndex].end <= ix:
+                sub = stack.pop()
+                __group_done(sub, stack[-1])
+
+            level = stack[-1]
+
+            if row.depth > self.treeDepth:
+                self.treeDepth = row.depth
+
+            item, itemsel = row.values
+
+            level.totalItems += 1
+
+            calc = item.calc
+            if calc is None:
+                calc = item.calc = self.ItemCalc()
+
+            # сбрасываем, дабы обновлялось!
+            calc.childrenImportance = 0
+
+            calc.checked = itemsel
+            calc.parent = rows[row.parent].values[0].calc if row.parent >= 0 else None
+            calc.rowIndex = ix
+            calc.rowEnd = row.end
+            calc.subSelectedSum = 0
+            calc.subSelectedCount = 0
+
+            if itemsel:
+                checkedIndex.append(row.itr, calc)
+
+            if item.id is None or item.id in itemIndex:
+                noids.append(row)
+            else:
+                itemIndex[item.id] = row.itr
+
+                if item.id >= self.nextItemId:
+                    self.nextItemId = item.id + 1
+
+                if searchIndex is not None:
+                    searchIndex.update(item, calc.version)
+
+            # внимание! всё считаем на основе item.sum, а не item.cost!
+
+            if row.nchildren == 0:
+                # одиночный товар
+                if itemsel:
+                    level.selectedSum += item.sum
+                    level.selectedCount += 1
+
+                    level.itemsChecked += 1
+
+                if item.incart:
+                    level.inCartSum += item.sum
+                    level.inCartCount += 1
+
+                calc.childrenSelected = False
+                calc.childrenInCart = False
+
+                __item_needs(level, item, calc)
+            else:
+                # группа - сначала считаем вложенные, с текущим остатком
+                stack.append(self.RecalcLevel(ix, level.totalRemain))
+
+        while len(stack) > 1:
+            sub = stack.pop()
+            __group_done(sub, stack[-1])
+
+        # новые идентификаторы - больше всех имеющихся
+        for row in noids:
+            item = row.values[0]
+            item.id = self.nextItemId
+            itemIndex[self.nextItemId] = row.itr
+            self.nextItemId += 1
+
+            if searchIndex is not None:
+                searchIndex.update(item, item.calc.version)
+
+        # в индексе поиска остались удалённые товары
+        if searchIndex is not None and len(searchIndex) > len(itemIndex):
+            searchIndex.prune(itemIndex)
+
+        # после пересчёта - суммы групп уже известны
+        self.layout.build(rows)
+
+        level = stack[0]
 
         # на всякий пожарный случай
-        if totalRemain < 0:
-            totalRemain = 0
+        if level.totalRemain < 0:
+            level.totalRemain = 0
 
-        return (totalCost, totalNeed, totalRemain, maxImportance,
-            totalSelectedSum, totalSelectedCount,
-            totalInCartSum, totalInCartCount,
-            totalItems, totalItemsChecked)
+        return level
 
     def recalculate(self):
         """Перерасчет.
         Производится проход по списку items, для каждого элемента
-        расчитываются значения полей item.needCash и item.needMonths
-        на основе полей self.totalCash, self.refillCash и значений
-        полей элементов).
+        расчитываются значения полей item.calc на основе полей
+        self.totalCash, self.refillCash и значений полей элементов).
         По завершению обновляется значение self.totalRemain.
         Возвращает кортеж из двух элементов:
         1й: общее количество элементов в дереве,
         2й: количество помеченных элементов."""
 
-        __totalCost, __totalNeed, self.totalRemain, __importance, \
-            self.totalSelectedSum, self.totalSelectedCount, \
-            self.totalInCartSum, self.totalInCartCount,\
-            totalItems, totalItemsChecked = self.__recalculate_items(None,
-                self.totalCash, self.refillCash, self.totalCash)
+        self.treeDepth = 0
+
+        with PerfTimer() as t:
+            totals = self.__recalculate_items(self.refillCash, self.totalCash)
+
+        self.totalRemain = totals.totalRemain
+        self.totalSelectedSum = totals.selectedSum
+        self.totalSelectedCount = totals.selectedCount
+        self.totalInCartSum = totals.inCartSum
+        self.totalInCartCount = totals.inCartCount
 
-        return (totalItems, totalItemsChecked)
+        self.lastRecalcTime = t.elapsed
+        self.totalItems = totals.totalItems
+        self.totalItemsChecked = totals.itemsChecked
+
+        return (totals.totalItems, totals.itemsChecked)
 
     @staticmethod
     def need_months(needcash, refillcash):
@@ -930,6 +2122,200 @@ class WishCalc():
 
         return m
 
+    # способы упорядочивания товаров для sort_items()
+    SORT_IMPORTANCE, SORT_COST, SORT_SUM, SORT_NAME, SORT_MONTHS = range(5)
+
+    @staticmethod
+    def __months_sort_key(item):
+        # товары, срок накопления которых неизвестен - в конец
+        months = item.calc.needMonths if item.calc is not None else None
+
+        return (months is None, months if months is not None else 0)
+
+    # ключи сортировки; важность - по убыванию, остальное - по возрастанию
+    SORT_KEYS = {SORT_IMPORTANCE:lambda item: -item.importance,
+        SORT_COST:lambda item: item.cost,
+        SORT_SUM:lambda item: item.sum,
+        SORT_NAME:lambda item: item.name.lower(),
+        SORT_MONTHS:__months_sort_key.__func__}
+
+    # значение ключа COL_SORT_MONTHS для товаров, срок накопления
+    # которых неизвестен - чтоб были в конце
+    SORT_MONTHS_UNKNOWN = 1 << 62
+
+    def view_sort_values(self, item):
+        """Возвращает кортеж со значениями столбцов VIEW_SORT_COLUMNS
+        для товара item (экземпляра WishCalc.Item с уже вычисленными
+        значениями item.calc)."""
+
+        calc = item.calc
+
+        importance = item.importance
+        if importance < calc.childrenImportance:
+            importance = calc.childrenImportance
+
+        return (item.sum,
+            calc.needMonths if calc.needMonths is not None else self.SORT_MONTHS_UNKNOWN,
+            importance,
+            item.name.casefold())
+
+    def sort_items(self, parentitr, sortby, recursive):
+        """Упорядочивание товаров одного уровня дерева.
+
+        parentitr   - None или экземпляр Gtk.TreeIter; упорядочиваются
+                      элементы, вложенные в parentitr;
+        sortby      - способ упорядочивания (одна из констант SORT_*);
+        recursive   - булевское значение; если True - упорядочиваются
+                      также все вложенные уровни.
+
+        Новый порядок для каждого уровня вычисляется здесь и применяется
+        одним вызовом Gtk.TreeStore.reorder(); элементы с одинаковыми
+        значениями ключа сохраняют взаимный порядок.
+        После вызова этого метода должен быть вызван recalculate()."""
+
+        keyfunc = self.SORT_KEYS[sortby]
+
+        # уровни дерева: список кортежей (экземпляр Gtk.TreeIter
+        # группы, список элементов уровня)
+        levels = []
+
+        if recursive:
+            rows = get_tree_model_rows(self.store, parentitr, self.COL_ITEM_OBJ)
+
+            children = [[]]
+            # индексы в списке children для строк rows
+            levelix = []
+
+            for row in rows:
+                if row.nchildren:
+                    levelix.append(len(children))
+                    children.append([])
+                else:
+                    levelix.append(-1)
+
+                children[0 if row.parent < 0 else levelix[row.parent]].append(row.values[0])
+
+            levels.append((parentitr, children[0]))
+            for row, ix in zip(rows, levelix):
+                if ix >= 0:
+                    levels.append((row.itr, children[ix]))
+        else:
+            items = []
+            itr = self.store.iter_children(parentitr)
+            while itr is not None:
+                items.append(self.get_item(itr))
+                itr = self.store.iter_next(itr)
+
+            levels.append((parentitr, items))
+
+        for levelitr, items in levels:
+            neworder = sorted(range(len(items)), key=lambda ix: keyfunc(items[ix]))
+
+            if neworder != list(range(len(items))):
+                self.store.reorder(levelitr, neworder)
+
+        self.invalidate_indexes()
+
+    def move_checked_items(self, tobottom):
+        """Перемещение всех помеченных элементов дерева в начало
+        (или в конец, если tobottom=True) их уровней дерева.
+        Взаимный порядок помеченных и непомеченных элементов
+        сохраняется; каждый затронутый уровень переупорядочивается
+        одним вызовом Gtk.TreeStore.reorder().
+        Индекс помеченных элементов должен быть актуальным (см.
+        get_checked_items()).
+        После вызова этого метода должен быть вызван recalculate()."""
+
+        # ключи - кортежи индексов пути группы, значения - кортежи
+        # (экземпляр Gtk.TreeIter группы, множество индексов помеченных)
+        levels = dict()
+
+        for itr in self.checkedIndex.get_iters(True):
+            indices = self.store.get_path(itr).get_indices()
+            levelkey = tuple(indices[:-1])
+
+            level = levels.get(levelkey)
+            if level is None:
+                level = levels[levelkey] = (self.store.iter_parent(itr), set())
+
+            level[1].add(indices[-1])
+
+        for levelitr, checked in levels.values():
+            nitems = self.store.iter_n_children(levelitr)
+
+            neworder = sorted(checked)
+            unchecked = list(filter(lambda ix: ix not in checked, range(nitems)))
+
+            if tobottom:
+                neworder = unchecked + neworder
+            else:
+                neworder += unchecked
+
+            self.store.reorder(levelitr, neworder)
+
+        self.invalidate_indexes()
+
+    def normalize_iters(self, itrs):
+        """Возвращает список кортежей (индексы, itr) для элементов,
+        на которые указывают экземпляры Gtk.TreeIter из списка itrs,
+        отсортированный в порядке обхода дерева; индексы - список
+        индексов пути элемента (см. Gtk.TreePath.get_indices()).
+        Элементы, вложенные в другие элементы из itrs, а также повторы
+        в выхлоп не попадают."""
+
+        paths = sorted(map(lambda itr: (self.store.get_path(itr).get_indices(), itr), itrs),
+            key=lambda p: p[0])
+
+        lret = []
+        lastindices = None
+
+        for indices, itr in paths:
+            # в отсортированном списке вложенные элементы (и повторы)
+            # идут сразу за своим "предком"
+            if lastindices is not None and indices[:len(lastindices)] == lastindices:
+                continue
+
+            lret.append((indices, itr))
+            lastindices = indices
+
+        return lret
+
+    def items_delete(self, itrs, ispurchased):
+        """Удаление нескольких товаров из списка.
+
+        itrs        - список экземпляров Gtk.TreeIter; элементы,
+                      вложенные в другие элементы из списка, удаляются
+                      вместе с ними и отдельно не учитываются;
+        ispurchased - булевское значение: если True, товары считаются
+                      купленными, и их общая цена вычитается из суммы
+                      доступных наличных.
+
+        Строки удаляются с конца дерева, чтобы удаление не сдвигало
+        ещё не удалённые строки.
+        Возвращает количество удалённых элементов (без учёта вложенных).
+        После вызова этого метода может понадобиться вызвать recalculate()."""
+
+        paths = self.normalize_iters(itrs)
+
+        if ispurchased:
+            totalCash = self.totalCash
+
+            for indices, itr in paths:
+                itemsum = self.get_item(itr).sum
+                if itemsum:
+                    totalCash -= itemsum
+                    if totalCash < 0:
+                        totalCash = 0
+
+            self.totalCash = totalCash
+
+        for indices, itr in reversed(paths):
+            self.store.remove(itr)
+
+        self.invalidate_indexes()
+
+        return len(paths)
+
     def item_delete(self, itr, ispurchased):
         """Удаление товара из списка.
 
@@ -940,43 +2326,381 @@ class WishCalc():
 
         После вызова этого метода может понадобиться вызвать recalculate()."""
 
-        item = self.get_item(itr)
+        self.items_delete((itr,), ispurchased)
 
-        if ispurchased:
-            if item.sum:
-                self.totalCash -= item.sum
-                if self.totalCash < 0:
-                    self.totalCash = 0
+    class Snapshot():
+        """Снимок документа для отмены/повтора изменений.
 
-        self.store.remove(itr)
+        Дерево хранится в виде неизменяемых узлов - кортежей
+        (состояние товара, кортеж вложенных узлов), где состояние
+        товара - кортеж из значений полей (см. WishCalc.ITEM_STATE_FIELDS)
+        и пометки. Узлы неизменившихся поддеревьев у последовательных
+        снимков - общие, т.е. каждый снимок добавляет в память только
+        узлы изменившихся товаров и групп, в которые они вложены.
 
+        Поля:
+            items       - кортеж узлов верхнего уровня дерева;
+            totalCash,
+            refillCash  - соответствующие поля WishCalc."""
 
-def __debug_dump(wishcalc):
-    wishcalc.select_items(True)
+        __slots__ = 'items', 'totalCash', 'refillCash'
 
-    wishcalc.recalculate()
+        def __init__(self, items, totalCash, refillCash):
+            self.items = items
+            self.totalCash = totalCash
+            self.refillCash = refillCash
+
+        def same_as(self, other):
+            return isinstance(other, WishCalc.Snapshot) and self.items is other.items \
+                and self.totalCash == other.totalCash and self.refillCash == other.refillCash
+
+    class CheckedChange():
+        """Запись для отмены/повтора изменения пометок элементов дерева.
+        В отличие от Snapshot, хранит только пометки изменяемых элементов,
+        так что для её создания не требуется обходить всё дерево.
+
+        Поля:
+            changes - список кортежей (Item.id, значение COL_SELECTED)."""
+
+        __slots__ = 'changes',
+
+        def __init__(self, changes):
+            self.changes = changes
+
+        def same_as(self, other):
+            return False
+
+    # при большем количестве изменяемых пометок apply_checked_change()
+    # вместо обновления элементов по одному выполняет полный пересчёт
+    CHECKED_CHANGE_MAX_INCREMENTAL = 64
+
+    def make_checked_change(self, itrs):
+        """Возвращает экземпляр CheckedChange с текущими пометками
+        элементов дерева itrs (последовательности Gtk.TreeIter),
+        или None, если у кого-то из них ещё нет идентификатора
+        (тогда следует запомнить снимок - см. make_snapshot())."""
+
+        changes = []
+
+        for itr in itrs:
+            itemid = self.get_item(itr).id
+            if itemid is None:
+                return None
+
+            changes.append((itemid, self.get_item_checked(itr)))
+
+        return self.CheckedChange(changes)
+
+    def make_select_items_change(self, select):
+        """Возвращает экземпляр CheckedChange (или None - см.
+        make_checked_change()) с пометками элементов, которые изменит
+        вызов select_items(select)."""
+
+        return self.make_checked_change(map(lambda row: row.itr,
+            filter(lambda row: row.values[0] != select,
+                get_tree_model_rows(self.store, None, self.COL_SELECTED))))
+
+    def apply_checked_change(self, change):
+        """Восстановление пометок элементов дерева из change (экземпляра
+        CheckedChange). Элементы, которых в дереве уже нет, пропускаются.
+
+        Небольшое количество пометок обновляется вызовами
+        set_item_checked(), иначе после их изменения вызывается
+        recalculate().
+        Возвращает экземпляр CheckedChange с пометками, бывшими
+        до вызова."""
+
+        incremental = len(change.changes) <= self.CHECKED_CHANGE_MAX_INCREMENTAL
+
+        if incremental:
+            itrs = list(map(lambda c: self.find_item_by_id(c[0]), change.changes))
+        else:
+            # один проход по дереву вместо поиска каждого элемента
+            ids = dict(change.changes)
+            found = dict()
+
+            for row in get_tree_model_rows(self.store, None, self.COL_ITEM_OBJ):
+                itemid = row.values[0].id
+                if itemid in ids:
+                    found[itemid] = row.itr
+
+            itrs = list(map(lambda c: found.get(c[0]), change.changes))
+
+        prev = []
+
+        for (itemid, checked), itr in zip(change.changes, itrs):
+            if itr is None:
+                continue
+
+            prev.append((itemid, self.get_item_checked(itr)))
+
+            if incremental:
+                self.set_item_checked(itr, checked)
+            else:
+                self.store.set_value(itr, self.COL_SELECTED, checked)
+
+        if not incremental:
+            self.recalculate()
+
+        return self.CheckedChange(prev)
+
+    # поля WishCalc.Item, сохраняемые в снимках
+    ITEM_STATE_FIELDS = Item.DATA_FIELDS + (Item.ID,)
+    # индекс Item.id в кортеже состояния товара
+    ITEM_STATE_ID = ITEM_STATE_FIELDS.index(Item.ID)
+
+    def __item_state(self, item, checked):
+        return tuple(map(lambda f: getattr(item, f), self.ITEM_STATE_FIELDS)) + (checked,)
+
+    def __set_item_state(self, item, state):
+        for field, value in zip(self.ITEM_STATE_FIELDS, state):
+            setattr(item, field, value)
+
+        item.calculate_sum()
+
+    def make_snapshot(self):
+        """Возвращает экземпляр Snapshot с текущим состоянием документа.
+        Узлы товаров, не изменившихся с предыдущего снимка (вместе
+        со всеми вложенными), берутся из предыдущего снимка."""
+
+        rows = get_tree_model_rows(self.store, None, self.COL_ITEM_OBJ, self.COL_SELECTED)
+
+        # вложенные узлы, собранные для ещё не обработанных групп;
+        # ключи - индексы строк групп (-1 - верхний уровень)
+        pending = dict()
+
+        # обходим строки с конца, чтобы вложенные узлы были готовы
+        # раньше узла группы
+        for ix in range(len(rows) - 1, -1, -1):
+            row = rows[ix]
+            item, itemsel = row.values
+
+            children = pending.pop(ix, None)
+            children = tuple(reversed(children)) if children else ()
+
+            state = self.__item_state(item, itemsel)
+
+            calc = item.calc
+            if calc is None:
+                calc = item.calc = self.ItemCalc()
+
+            node = calc.snapshot
+            if node is not None:
+                if node[0] == state:
+                    state = node[0]
+
+                prevchildren = node[1]
+                if len(children) == len(prevchildren) and \
+                        all(map(lambda n: n[0] is n[1], zip(children, prevchildren))):
+                    children = prevchildren
 
-    def __print_items(store, parentitr, indent):
-        itr = store.iter_children(parentitr)
+                if state is not node[0] or children is not prevchildren:
+                    node = None
 
-        sindent = ' ' * indent * 2
+            if node is None:
+                node = calc.snapshot = (state, children)
 
+            pchildren = pending.get(row.parent)
+            if pchildren is None:
+                pchildren = pending[row.parent] = []
+
+            pchildren.append(node)
+
+        items = pending.get(-1)
+        items = tuple(reversed(items)) if items else ()
+
+        previtems = self.lastSnapshotItems
+        if len(items) == len(previtems) and \
+                all(map(lambda n: n[0] is n[1], zip(items, previtems))):
+            items = previtems
+        else:
+            self.lastSnapshotItems = items
+
+        return self.Snapshot(items, self.totalCash, self.refillCash)
+
+    def __new_item_from_node(self, node):
+        item = self.Item()
+        self.__set_item_state(item, node[0])
+
+        item.calc = self.ItemCalc()
+        item.calc.snapshot = node
+
+        return item
+
+    def __insert_nodes(self, parentitr, nodes):
+        """Добавление в конец уровня parentitr строк для узлов nodes
+        со всеми вложенными. Возвращает список Gtk.TreeIter добавленных
+        строк верхнего уровня."""
+
+        ret = []
+
+        stack = [(parentitr, iter(nodes), ret)]
+
+        while stack:
+            levelitr, levelnodes, added = stack[-1]
+
+            node = next(levelnodes, None)
+            if node is None:
+                stack.pop()
+                continue
+
+            itr = self.append_item(levelitr, self.__new_item_from_node(node))
+            self.store.set_value(itr, self.COL_SELECTED, node[0][-1])
+
+            if added is not None:
+                added.append(itr)
+
+            if node[1]:
+                stack.append((itr, iter(node[1]), None))
+
+        return ret
+
+    def __restore_level(self, parentitr, curnodes, newnodes, stack):
+        """Приведение уровня дерева parentitr, соответствующего узлам
+        curnodes текущего снимка, в соответствие с узлами newnodes.
+        Уровни, которые требуется обновить следом, добавляются в stack."""
+
+        itrs = []
+        itr = self.store.iter_children(parentitr)
         while itr is not None:
-            item = store.get_value(itr, WishCalc.COL_ITEM_OBJ)
-            selected = store.get_value(itr, WishCalc.COL_SELECTED)
-            nchildren = store.iter_n_children(itr)
+            itrs.append(itr)
+            itr = self.store.iter_next(itr)
+
+        # строки, узлы которых не изменились (в т.ч. если строки только
+        # переставлены) - остаются как есть
+        unchanged = dict()
+        for ix, node in enumerate(curnodes):
+            unchanged.setdefault(id(node), []).append(ix)
+
+        # для каждой позиции newnodes - индекс строки в itrs или None
+        assigned = [None] * len(newnodes)
+        used = [False] * len(curnodes)
+
+        for jx, node in enumerate(newnodes):
+            ixs = unchanged.get(id(node))
+            if ixs:
+                ix = ixs.pop(0)
+                assigned[jx] = ix
+                used[ix] = True
+
+        # изменившиеся товары - по Item.id, чтобы строка (а с ней
+        # и экземпляр Item, и состояние ветви в TreeView) осталась
+        # у того же товара
+        byid = dict()
+        for ix, node in enumerate(curnodes):
+            if not used[ix]:
+                byid.setdefault(node[0][self.ITEM_STATE_ID], []).append(ix)
+
+        for jx, node in enumerate(newnodes):
+            if assigned[jx] is not None:
+                continue
+
+            ixs = byid.get(node[0][self.ITEM_STATE_ID])
+            if ixs:
+                ix = ixs.pop(0)
+                assigned[jx] = ix
+                used[ix] = True
+
+        # оставшиеся строки по порядку обновляются на месте
+        # оставшимися узлами
+        freeixs = list(filter(lambda ix: not used[ix], range(len(curnodes))))
+        freeixs.reverse()
+
+        for jx in range(len(newnodes)):
+            if assigned[jx] is not None or not freeixs:
+                continue
+
+            ix = freeixs.pop()
+            assigned[jx] = ix
+            used[ix] = True
+
+        for jx, node in enumerate(newnodes):
+            ix = assigned[jx]
+            if ix is None or curnodes[ix] is node:
+                continue
+
+            itr = itrs[ix]
+            curnode = curnodes[ix]
+            item = self.get_item(itr)
+
+            if curnode[0] != node[0]:
+                self.__set_item_state(item, node[0])
+                item.calc.version += 1
+                if curnode[0][-1] != node[0][-1]:
+                    self.store.set_value(itr, self.COL_SELECTED, node[0][-1])
+
+            item.calc.snapshot = node
+
+            if curnode[1] is not node[1]:
+                stack.append((itr, curnode[1], node[1]))
+
+        # лишние строки удаляем
+        positions = [None] * len(curnodes)
+        npos = 0
+        for ix, itr in enumerate(itrs):
+            if used[ix]:
+                positions[ix] = npos
+                npos += 1
+            else:
+                self.store.remove(itr)
+
+        # недостающие - добавляем в конец уровня
+        newixs = list(filter(lambda jx: assigned[jx] is None, range(len(newnodes))))
+        self.__insert_nodes(parentitr, map(lambda jx: newnodes[jx], newixs))
+
+        # ...и переставляем всё по местам одним вызовом reorder()
+        neworder = []
+        for jx in range(len(newnodes)):
+            if assigned[jx] is not None:
+                neworder.append(positions[assigned[jx]])
+            else:
+                neworder.append(npos)
+                npos += 1
+
+        if neworder != list(range(len(neworder))):
+            self.store.reorder(parentitr, neworder)
+
+    def restore_snapshot(self, snapshot):
+        """Восстановление состояния документа из снимка snapshot
+        (экземпляра Snapshot).
+        TreeStore обновляется только там, где текущее дерево отличается
+        от снимка: поддеревья с общими узлами не трогаются, изменившиеся
+        товары обновляются на месте, переставленные - переставляются.
+        После вызова этого метода должен быть вызван recalculate().
+        Возвращает экземпляр Snapshot с состоянием документа,
+        бывшим до вызова."""
+
+        current = self.make_snapshot()
+
+        if current.items is not snapshot.items:
+            stack = [(None, current.items, snapshot.items)]
 
-            print('%s%s %s (%d, %d, %d), %d (%s)' % (sindent,
-                '*' if nchildren == 0 else '>',
-                item.name, item.cost, item.quantity, item.sum,
-                item.importance, selected))
+            while stack:
+                parentitr, curnodes, newnodes = stack.pop()
+                self.__restore_level(parentitr, curnodes, newnodes, stack)
 
-            if nchildren > 0:
-                __print_items(store, itr, indent + 1)
+        self.lastSnapshotItems = snapshot.items
+
+        self.totalCash = snapshot.totalCash
+        self.refillCash = snapshot.refillCash
+
+        self.invalidate_indexes()
+
+        return current
+
+
+def __debug_dump(wishcalc):
+    wishcalc.select_items(True)
+
+    wishcalc.recalculate()
 
-            itr = store.iter_next(itr)
+    for row in get_tree_model_rows(wishcalc.store, None, WishCalc.COL_ITEM_OBJ, WishCalc.COL_SELECTED):
+        item, selected = row.values
 
-    __print_items(wishcalc.store, None, 0)
+        print('%s%s %s (%d, %d, %d), %d (%s)' % (' ' * (row.depth - 1) * 2,
+            '*' if row.nchildren == 0 else '>',
+            item.name, item.cost, item.quantity, item.sum,
+            item.importance, selected))
 
     #print(wishcalc.get_item(wishcalc.store.get_iter_first()))
 
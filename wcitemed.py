@@ -37,7 +37,9 @@ class ImportanceIcons():
     """Ресурсы для отображения меню и комбобоксов "важности" товара.
 
     Поля:
-        icons   - список экземпляров impicon."""
+        icons   - список экземпляров impicon; изображения загружаются
+                  в фоновых потоках, список заполняется при первом
+                  обращении к полю."""
 
     impicon = namedtuple('impicon', 'pixbuf label')
 
@@ -48,11 +50,19 @@ class ImportanceIcons():
 
         nmiconsize = Gtk.IconSize.lookup(Gtk.IconSize.MENU)[1]
 
-        self.icons = []
+        self.__icons = None
 
-        for ixicon, label in enumerate(IMPORTANCE_LEVELS):
-            self.icons.append(self.impicon(resldr.load_pixbuf('images/impicon%.2d.svg' % ixicon, nmiconsize, nmiconsize),
-                label))
+        self.__pending = list(map(lambda ixicon: resldr.load_pixbuf_async('images/impicon%.2d.svg' % ixicon, nmiconsize, nmiconsize),
+            range(len(IMPORTANCE_LEVELS))))
+
+    @property
+    def icons(self):
+        if self.__icons is None:
+            self.__icons = list(map(lambda pi: self.impicon(pi[0].get(), pi[1]),
+                zip(self.__pending, IMPORTANCE_LEVELS)))
+            self.__pending = None
+
+        return self.__icons
 
 
 class ItemEditorDlg():
@@ -61,12 +71,14 @@ class ItemEditorDlg():
     Ибо как-то некрасиво в одной куче держать обработчики событий
     основного окна и прочие"""
 
-    def __init__(self, parentwnd, resldr, cfgWinState, importanceIcons):
+    def __init__(self, parentwnd, resldr, cfgWinState, importanceIcons, lazycalc=False):
         """parentwnd    - родительское окно,
         resldr          - экземпляр *ResourceLoader,
         cfgWinState     - экземпляр класса для сохранения состояния окна,
         importanceIcons - список экземпляров Gdk.Pixbuf - иконок
-                          для комбобокса "важность"."""
+                          для комбобокса "важность";
+        lazycalc        - булевское значение, True, если калькулятор
+                          поля цены создаётся при первом вызове."""
 
         self.windowState = cfgWinState
 
@@ -83,7 +95,7 @@ class ItemEditorDlg():
             ('costlabel', 'itemcostentry', 'quantitylabel'))
 
         self.itemcostentry = uibldr.get_object('itemcostentry')
-        self.calc = Calculator(resldr, self.itemcostentry, True)
+        self.calc = Calculator(resldr, self.itemcostentry, True, lazycalc)
 
         self.itemquantityentry = uibldr.get_object('itemquantityentry')
 
@@ -231,7 +243,10 @@ class ItemEditorDlg():
 
         Возвращает None, если редактирование отменено (нажата кнопка
         "Отмена"), или экземпляр WishCalc.Item с новыми или изменёнными
-        данными."""
+        данными.
+        Сам item не изменяется - редактируется его копия; для изменения
+        товара на месте см. WishCalc.Item.get_changes()
+        и WishCalc.apply_item_changes()."""
 
         if item is None:
             dtitle = 'Новый товар'
@@ -319,18 +334,25 @@ class ItemEditorDlg():
                     self.iteminfoentrybuf.get_end_iter(), False))
 
                 # в поле tempItem.url засасываем значения из itemurls.store
-                self.tempItem.url.clear()
+                urls = []
 
                 def __urls_fe_func(lstore, path, itr, data=None):
                     url, urlname = lstore.get(itr, self.URLCOL_URL, self.URLCOL_NAME)
                     if url:
                         # пустые URL НЕ сохраняем!
-                        self.tempItem.url.append([url, urlname])
+                        urls.append((url, urlname))
 
                 self.itemurls.store.foreach(__urls_fe_func)
 
+                # кортеж может быть общим с другими товарами, потому
+                # заменяем целиком
+                self.tempItem.url = tuple(urls)
+
                 self.tempItem.calculate_sum()
-                return WishCalc.Item.new_copy(self.tempItem)
+
+                # при следующем вызове edit() tempItem будет заменён
+                # новым экземпляром, так что повторно не копируем
+                return self.tempItem
 
         finally:
             self.dlgItemEditor.hide()
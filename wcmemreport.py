@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" wcmemreport.py
+
+    This file is part of WishCalc.
+
+    WishCalc is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    WishCalc is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with WishCalc.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+import sys
+import os.path
+import tracemalloc
+from io import StringIO
+
+from wcdata import *
+from wcperf import format_size, get_process_rss
+
+
+# параметр командной строки для вывода отчёта вместо запуска UI
+CMDLINE_OPTION = '--memory-report'
+
+# приблизительные размеры структур GTK/GLib в байтах (для 64-битных
+# платформ) - память, выделенную библиотеками на C, tracemalloc
+# не видит, потому её можно только оценить
+GNODE_SIZE = 40     # узел GtkTreeStore (GNode)
+GVALUE_SIZE = 24    # значение одного столбца строки (GValue)
+
+
+class MemoryReport():
+    """Сборщик статистики расхода памяти на содержимое списка.
+
+    Поля:
+        categories  - словарь, где ключи - названия категорий,
+                      а значения - размеры в байтах;
+        nitems      - количество товаров;
+        loadTraced  - None или прирост памяти, выделенной интерпретатором
+                      во время WishCalc.load_str() (по данным tracemalloc);
+        loadRSS     - None или прирост размера резидентной памяти
+                      процесса во время WishCalc.load_str();
+        loadTop     - список экземпляров tracemalloc.StatisticDiff -
+                      места программы, выделившие больше всего памяти
+                      во время WishCalc.load_str()."""
+
+    C_ITEM = 'поля Item (без URL и описаний)'
+    C_CALC = 'вычисляемые поля (ItemCalc)'
+    C_URL = 'списки URL'
+    C_INFO = 'описания (info)'
+    C_ROWS = 'строки TreeStore (оценка)'
+    C_ROWSTR = 'текст строк TreeStore и TreeView (оценка)'
+    C_PIXBUFS = 'изображения, на которые ссылаются строки'
+
+    CATEGORIES = (C_ITEM, C_CALC, C_URL, C_INFO, C_ROWS, C_ROWSTR, C_PIXBUFS)
+
+    def __init__(self):
+        self.categories = dict(map(lambda c: (c, 0), self.CATEGORIES))
+        self.nitems = 0
+
+        self.loadTraced = None
+        self.loadRSS = None
+        self.loadTop = []
+
+        # id уже учтённых объектов - общие для нескольких товаров
+        # строки и кортежи должны учитываться один раз
+        self.__seen = set()
+
+    def __sizeof(self, obj):
+        """Возвращает sys.getsizeof(obj), если obj ещё не учтён, иначе 0."""
+
+        oid = id(obj)
+        if oid in self.__seen:
+            return 0
+
+        self.__seen.add(oid)
+        return sys.getsizeof(obj)
+
+    def trace_load(self, s, ntop=10):
+        """Загрузка документа из строки s (JSON) в новый экземпляр
+        WishCalc под присмотром tracemalloc.
+        ntop - количество запоминаемых мест программы, выделивших
+        больше всего памяти.
+        Возвращает экземпляр WishCalc."""
+
+        wishcalc = WishCalc(None)
+
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(1)
+
+        try:
+            rss0 = get_process_rss()
+            snap0 = tracemalloc.take_snapshot()
+
+            wishcalc.load_str(s)
+
+            snap1 = tracemalloc.take_snapshot()
+            rss1 = get_process_rss()
+        finally:
+            if started:
+                tracemalloc.stop()
+
+        # сам модуль tracemalloc тоже выделяет память - её не считаем
+        filters = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        snap0 = snap0.filter_traces(filters)
+        snap1 = snap1.filter_traces(filters)
+
+        diff = snap1.compare_to(snap0, 'lineno')
+
+        self.loadTraced = sum(map(lambda sd: sd.size_diff, diff))
+        self.loadRSS = rss1 - rss0 if rss0 is not None and rss1 is not None else None
+        self.loadTop = list(filter(lambda sd: sd.size_diff > 0, diff))[:ntop]
+
+        return wishcalc
+
+    def measure(self, wishcalc):
+        """Подсчёт памяти, занимаемой содержимым wishcalc
+        (экземпляра WishCalc)."""
+
+        store = wishcalc.store
+        ncolumns = store.get_n_columns()
+
+        strcols = []
+        pixbufcols = []
+        for col in range(ncolumns):
+            ctype = store.get_column_type(col)
+            if ctype == GObject.TYPE_STRING:
+                strcols.append(col)
+            elif ctype == Pixbuf.__gtype__:
+                pixbufcols.append(col)
+
+        cats = self.categories
+
+        def __measure_row(model, path, itr, data=None):
+            item = model.get_value(itr, WishCalc.COL_ITEM_OBJ)
+
+            self.nitems += 1
+
+            cats[self.C_ITEM] += self.__sizeof(item) + self.__sizeof(item.name) + \
+                self.__sizeof(item.cost) + self.__sizeof(item.quantity) + \
+                self.__sizeof(item.sum)
+
+            if item.calc is not None:
+                cats[self.C_CALC] += self.__sizeof(item.calc)
+
+                # отображаемые значения - только у уже отрисованных строк
+                rowview = item.calc.rowView
+                if rowview is not None:
+                    cats[self.C_ROWSTR] += self.__sizeof(rowview) + self.__sizeof(item.calc.rowKey)
+
+                    for v in rowview:
+                        if isinstance(v, str):
+                            cats[self.C_ROWSTR] += self.__sizeof(v)
+                        elif v is not None and id(v) not in self.__seen:
+                            self.__seen.add(id(v))
+                            cats[self.C_PIXBUFS] += v.get_byte_length()
+
+            urlsize = self.__sizeof(item.url)
+            for urlpair in item.url:
+                urlsize += self.__sizeof(urlpair)
+                for us in urlpair:
+                    urlsize += self.__sizeof(us)
+            cats[self.C_URL] += urlsize
+
+            cats[self.C_INFO] += self.__sizeof(item.info)
+
+            cats[self.C_ROWS] += GNODE_SIZE + GVALUE_SIZE * ncolumns
+
+            for s in model.get(itr, *strcols):
+                if s:
+                    cats[self.C_ROWSTR] += len(s.encode('utf-8')) + 1
+
+            for pixbuf in model.get(itr, *pixbufcols):
+                if pixbuf is not None and id(pixbuf) not in self.__seen:
+                    self.__seen.add(id(pixbuf))
+                    cats[self.C_PIXBUFS] += pixbuf.get_byte_length()
+
+        store.foreach(__measure_row)
+
+    def print_report(self, f=sys.stdout):
+        """Вывод собранной статистики в файл f."""
+
+        nitems = self.nitems if self.nitems else 1
+
+        print('Товаров: %d' % self.nitems, file=f)
+
+        print('\n%-45s %12s %12s' % ('Память', 'всего', 'на товар'), file=f)
+
+        total = 0
+        for cat in self.CATEGORIES:
+            size = self.categories[cat]
+            total += size
+            print('  %-43s %12s %12s' % (cat, format_size(size), format_size(size // nitems)), file=f)
+
+        print('  %-43s %12s %12s' % ('итого', format_size(total), format_size(total // nitems)), file=f)
+
+        if self.loadTraced is not None:
+            print('\nЗагрузка (WishCalc.load_str()):', file=f)
+            print('  %-43s %12s' % ('выделено интерпретатором', format_size(self.loadTraced)), file=f)
+            if self.loadRSS is not None:
+                print('  %-43s %12s' % ('прирост резидентной памяти', format_size(self.loadRSS)), file=f)
+
+            print('\nБольше всего памяти при загрузке выделили:', file=f)
+            for sd in self.loadTop:
+                frame = sd.traceback[0]
+                print('  %-43s %12s %10d блоков' % ('%s:%d' % (os.path.basename(frame.filename), frame.lineno),
+                    format_size(sd.size_diff), sd.count_diff), file=f)
+
+
+def memory_report(wishcalc=None, filename=None, f=sys.stdout):
+    """Формирование и вывод в файл f отчёта о расходе памяти.
+
+    wishcalc    - None или экземпляр WishCalc (напр. открытый в UI
+                  документ); в последнем случае для замеров загрузки
+                  используется его копия;
+    filename    - None или имя файла документа (если wishcalc=None).
+
+    В случае ошибок генерируются исключения."""
+
+    report = MemoryReport()
+
+    if wishcalc is None:
+        with open(filename, 'r', encoding=JSON_ENCODING) as srcf:
+            s = srcf.read()
+    else:
+        s = wishcalc.save_str()
+
+    loaded = report.trace_load(s)
+    if wishcalc is None:
+        wishcalc = loaded
+        wishcalc.recalculate()
+
+    report.measure(wishcalc)
+    report.print_report(f)
+
+
+def memory_report_str(wishcalc):
+    """Возвращает отчёт о расходе памяти документом wishcalc
+    (экземпляром WishCalc) в виде строки."""
+
+    f = StringIO()
+    memory_report(wishcalc, f=f)
+    return f.getvalue()
+
+
+if __name__ == '__main__':
+    print('[debugging %s]' % __file__)
+
+    memory_report(filename=sys.argv[1] if len(sys.argv) > 1 else DEFAULT_FILENAME)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" wcperf.py
+
+    This file is part of WishCalc.
+
+    WishCalc is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    WishCalc is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with WishCalc.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+# внимание! этот модуль не должен тянуть за собой GTK и прочие
+# модули WishCalc - он может импортироваться раньше всех остальных
+
+import os
+import sys
+import threading
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:
+    # не у всех ОС оно есть
+    resource = None
+
+
+# переменная окружения, включающая отладочные пункты меню и т.п.
+DEBUG_ENV = 'WISHCALC_DEBUG'
+
+debugMode = bool(os.environ.get(DEBUG_ENV))
+
+
+def get_process_rss():
+    """Возвращает текущий размер резидентной памяти процесса в байтах,
+    или None, если узнать его не удалось."""
+
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split(None)[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+
+    if resource is not None:
+        # за неимением лучшего - пиковое значение;
+        # в линуксах оно в килобайтах
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def format_size(nbytes):
+    """Возвращает строку с человекочитаемым размером nbytes (в байтах)."""
+
+    if nbytes is None:
+        return '?'
+
+    for units in ('байт', 'КиБ', 'МиБ'):
+        if nbytes < 1024:
+            return '%d %s' % (nbytes, units) if units == 'байт' else '%.1f %s' % (nbytes, units)
+
+        nbytes /= 1024.0
+
+    return '%.1f ГиБ' % nbytes
+
+
+def format_duration(seconds):
+    """Возвращает строку с человекочитаемой продолжительностью seconds
+    (в секундах, вещественное число или None)."""
+
+    if seconds is None:
+        return '-'
+
+    if seconds < 1.0:
+        return '%.1f мс' % (seconds * 1000.0)
+
+    return '%.2f с' % seconds
+
+
+class PerfTimer():
+    """Секундомер для замера продолжительности операций.
+    Используется как контекстный менеджер:
+
+        with PerfTimer() as t:
+            ...
+        print(t.elapsed)"""
+
+    __slots__ = 'elapsed', 'started'
+
+    def __init__(self):
+        self.elapsed = None
+        self.started = None
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = perf_counter() - self.started
+
+
+class StartupProfiler():
+    """Сборщик статистики времени запуска программы: продолжительность
+    импорта каждого модуля и этапов инициализации основного окна.
+
+    Включается параметром командной строки CMDLINE_OPTION; выключенный
+    ничего не замеряет и почти ничего не стоит.
+
+    Поля:
+        enabled - булевское значение, True, если статистика собирается;
+        imports - список кортежей (имя модуля, общее время, "собственное"
+                  время без учёта вложенных импортов);
+        phases  - список кортежей (название этапа, продолжительность)."""
+
+    CMDLINE_OPTION = '--startup-profile'
+
+    class ImportTimer():
+        """Поисковик модулей для sys.meta_path. Сам ничего не ищет,
+        а спрашивает остальных поисковиков и подсовывает в найденную
+        спецификацию загрузчик с секундомером."""
+
+        def __init__(self, profiler):
+            self.profiler = profiler
+
+        def find_spec(self, fullname, path, target=None):
+            started = perf_counter()
+
+            for finder in sys.meta_path:
+                if finder is self:
+                    continue
+
+                find_spec = getattr(finder, 'find_spec', None)
+                if find_spec is None:
+                    # допотопные поисковики пусть отрабатывают сами,
+                    # уже без секундомера
+                    continue
+
+                spec = find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+
+            if spec.loader is not None:
+                findtime = perf_counter() - started
+
+                if hasattr(spec.loader, 'exec_module'):
+                    spec.loader = StartupProfiler.TimedLoader(self.profiler, spec.loader, fullname, findtime)
+                else:
+                    spec.loader = StartupProfiler.TimedLegacyLoader(self.profiler, spec.loader, fullname, findtime)
+
+            return spec
+
+    class TimedLoader():
+        """Обёртка загрузчика модуля, замеряющая время его загрузки."""
+
+        def __init__(self, profiler, loader, fullname, findtime):
+            self.profiler = profiler
+            self.loader = loader
+            self.fullname = fullname
+            # время поиска и create_module() - в виде кортежа
+            # (общее время, "собственное" время)
+            self.spent = (findtime, findtime)
+
+        def __getattr__(self, name):
+            # всё, чего не знаем сами - спрашиваем у настоящего загрузчика
+            return getattr(self.loader, name)
+
+        def create_module(self, spec):
+            create_module = getattr(self.loader, 'create_module', None)
+            if create_module is None:
+                return None
+
+            self.profiler.import_started(self.fullname, self.spent)
+            try:
+                return create_module(spec)
+            finally:
+                # время create_module() и exec_module() одного и того же
+                # модуля учитываем одной записью
+                self.spent = self.profiler.import_finished(False)
+
+        def exec_module(self, module):
+            self.profiler.import_started(self.fullname, self.spent)
+            try:
+                self.loader.exec_module(module)
+            finally:
+                self.profiler.import_finished(True)
+
+    class TimedLegacyLoader(TimedLoader):
+        """То же, что TimedLoader, для загрузчиков, умеющих только
+        load_module() (напр. zipimporter в старых версиях Python)."""
+
+        def load_module(self, fullname):
+            self.profiler.import_started(self.fullname, self.spent)
+            try:
+                return self.loader.load_module(fullname)
+            finally:
+                self.profiler.import_finished(True)
+
+    def __init__(self):
+        self.enabled = False
+        self.started = None
+
+        self.imports = []
+        self.phases = []
+
+        self.__lastPhaseEnd = None
+        self.__importTimer = None
+        # стек вложенных импортов - свой у каждого потока
+        self.__local = threading.local()
+
+    def enable(self):
+        """Включение сбора статистики. Должно вызываться как можно раньше,
+        до импорта остальных модулей программы."""
+
+        if self.enabled:
+            return
+
+        self.enabled = True
+        self.started = perf_counter()
+        self.__lastPhaseEnd = self.started
+
+        self.__importTimer = self.ImportTimer(self)
+        sys.meta_path.insert(0, self.__importTimer)
+
+    def enable_from_cmdline(self, args):
+        """Включение сбора статистики, если в списке параметров
+        командной строки args есть CMDLINE_OPTION."""
+
+        if self.CMDLINE_OPTION in args[1:]:
+            self.enable()
+
+    def import_started(self, fullname, spent):
+        """Начало загрузки модуля fullname.
+        spent - кортеж из двух элементов - уже потраченное на этот модуль
+        время (общее и "собственное"), напр. на его поиск."""
+
+        stack = getattr(self.__local, 'stack', None)
+        if stack is None:
+            stack = self.__local.stack = []
+
+        # [имя, время начала, время вложенных импортов, потраченное ранее]
+        stack.append([fullname, perf_counter(), 0.0, spent])
+
+    def import_finished(self, record):
+        """Завершение загрузки модуля.
+        record - булевское значение; если True - результат заносится
+        в список imports.
+        Возвращает кортеж из общего и "собственного" времени загрузки."""
+
+        stack = self.__local.stack
+        fullname, started, childtime, spent = stack.pop()
+
+        elapsed = perf_counter() - started
+
+        if stack:
+            stack[-1][2] += elapsed
+
+        total = spent[0] + elapsed
+        own = spent[1] + elapsed - childtime
+
+        if record:
+            self.imports.append((fullname, total, own))
+
+        return (total, own)
+
+    def phase_done(self, name):
+        """Отметка завершения этапа запуска с названием name.
+        Продолжительность этапа отсчитывается от завершения
+        предыдущего (или от вызова enable())."""
+
+        if not self.enabled:
+            return
+
+        now = perf_counter()
+        self.phases.append((name, now - self.__lastPhaseEnd))
+        self.__lastPhaseEnd = now
+
+    def report(self, f=sys.stderr):
+        """Вывод собранной статистики в файл f и выключение сбора
+        статистики."""
+
+        if not self.enabled:
+            return
+
+        total = perf_counter() - self.started
+
+        if self.__importTimer in sys.meta_path:
+            sys.meta_path.remove(self.__importTimer)
+
+        self.enabled = False
+
+        print('Время запуска: %s' % format_duration(total), file=f)
+
+        print('\nЭтапы:', file=f)
+        for name, elapsed in self.phases:
+            print('  %-40s %12s' % (name, format_duration(elapsed)), file=f)
+
+        print('\nИмпорт модулей (общее время / без вложенных):', file=f)
+        importstotal = 0.0
+        for fullname, elapsed, own in sorted(self.imports, key=lambda r: r[2], reverse=True):
+            importstotal += own
+            print('  %-40s %12s %12s' % (fullname, format_duration(elapsed), format_duration(own)), file=f)
+
+        print('  %-40s %12s' % ('итого', format_duration(importstotal)), file=f)
+
+
+startupProfiler = StartupProfiler()
+
+
+if __name__ == '__main__':
+    print('[debugging %s]' % __file__)
+
+    startupProfiler.enable()
+    import json, csv, zipfile
+    startupProfiler.phase_done('импорт')
+    startupProfiler.report(sys.stdout)
+
+    with PerfTimer() as t:
+        rss = get_process_rss()
+
+    print('RSS: %s (%s)' % (format_size(rss), format_duration(t.elapsed)))
@@ -19,6 +19,13 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>."""
 
 
+import sys
+
+# при запуске не через __main__.py замер времени запуска включаем
+# здесь, до импорта всего, что тянет за собой GTK
+from wcperf import startupProfiler
+startupProfiler.enable_from_cmdline(sys.argv)
+
 from gtktools import *
 
 from gi.repository import Gtk, Gdk, GObject, Pango, GLib
@@ -27,9 +34,11 @@ from gi.repository.GLib import markup_escape_text
 
 import webbrowser
 import os.path
-import sys
+import argparse
 
-from random import choice as random_choice
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 
 from enum import IntEnum
 
@@ -40,6 +49,9 @@ from wcconfig import *
 from wccommon import *
 from wcitemed import *
 from wccalculator import *
+from wcperf import *
+from wcclipboard import *
+from wcmemreport import memory_report, memory_report_str, CMDLINE_OPTION as MEMORY_REPORT_OPTION
 
 
 class MainWnd():
@@ -47,6 +59,10 @@ class MainWnd():
 
     CLIPBOARD_DATA = 'wishcalc2_clipboard_data'
 
+    # при изменении большего количества строк за раз модель на время
+    # изменений отключается от TreeView (см. TreeViewDetached)
+    BULK_CHANGE_DETACH_ROWS = 32
+
     def wnd_destroy(self, widget):
         Gtk.main_quit()
 
@@ -77,15 +93,61 @@ class MainWnd():
 
         self.cfg.mainWindow.set_window_state(self.window)
 
-    def __init__(self, wlfname):
-        #
-        resldr = get_resource_loader()
-        uibldr = get_gtk_builder(resldr, 'wishcalc.ui')
+    def __init__(self, wlfname, fastStart=False):
+        """wlfname   - None или имя файла для загрузки;
+        fastStart   - булевское значение: если True - всё, что
+                      не нужно для отображения основного окна
+                      (редактор товара, калькуляторы, диалоговые
+                      окна), создаётся при первом обращении;
+                      иначе - в фоне, после отображения окна."""
+
+        startupProfiler.phase_done('импорт модулей')
+
+        self.fastStart = fastStart
 
         self.windowStateLoaded = False
         self.cfg = Config()
+        self.cfg.load()
         self.wishCalc = None
 
+        # история изменений списка для отмены/повтора
+        self.undoHistory = UndoHistory(self.cfg.undoDepth)
+
+        startupProfiler.phase_done('загрузка настроек')
+
+        #
+        self.resldr = get_resource_loader()
+        self.resldr.pixbufCache = PixbufCache(os.path.join(self.cfg.cacheDir, 'icons'), VERSION)
+
+        #
+        # иконки рендерятся в фоновых потоках, пока разбирается
+        # wishcalc.ui; дожидаемся их ниже, только там, где они нужны
+        #
+        nmiconsizeix = Gtk.IconSize.MENU
+        nmiconsize = Gtk.IconSize.lookup(nmiconsizeix)[1]
+        dlgiconsize = Gtk.IconSize.lookup(Gtk.IconSize.DIALOG)[1]
+
+        def __load_nmicon(name):
+            return self.resldr.load_pixbuf_async('images/%s.svg' % name, nmiconsize, nmiconsize)
+
+        pendingWndIcon = self.resldr.load_pixbuf_async('images/wishcalc.svg', dlgiconsize, dlgiconsize, 'calc')
+
+        pendingNMIcons = list(map(__load_nmicon,
+            ('nmiconok', 'nmiconempty',
+             'nmiconincart', 'nmiconchildrenincart', 'nmiconnotincart',
+             'nmiconunk', 'nmicon6m', 'nmicon12m', 'nmicon18m', 'nmicon36m')))
+
+        pendingPercentIcons = list(map(lambda i: __load_nmicon('nmicon_p%d' % i), range(self.PERCENT_RANGE)))
+
+        pendingPasteIntoIcon = __load_nmicon('paste-into')
+
+        # иконки "важности" товара
+        self.importanceIcons = ImportanceIcons(self.resldr)
+
+        uibldr = get_gtk_builder(self.resldr, 'wishcalc.ui')
+
+        startupProfiler.phase_done('разбор wishcalc.ui')
+
         #
         # основное окно
         #
@@ -93,8 +155,8 @@ class MainWnd():
 
         self.headerbar = uibldr.get_object('headerbar')
 
-        icon = resldr.load_pixbuf_icon_size('images/wishcalc.svg', Gtk.IconSize.DIALOG, 'calc')
-        self.window.set_icon(icon)
+        # иконка окна для первого кадра не нужна
+        pendingWndIcon.when_ready(lambda pixbuf: self.window.set_icon(pixbuf))
 
         #
         # главное меню
@@ -105,52 +167,101 @@ class MainWnd():
         # список желаемого
         #
 
-        # иконки
-        nmiconsizeix = Gtk.IconSize.MENU
-        nmiconsize = Gtk.IconSize.lookup(nmiconsizeix)[1]
-
-        self.iconNMok = resldr.load_pixbuf('images/nmiconok.svg', nmiconsize, nmiconsize)
-        self.iconNMempty = resldr.load_pixbuf('images/nmiconempty.svg', nmiconsize, nmiconsize)
-
-        self.iconNMincart = resldr.load_pixbuf('images/nmiconincart.svg', nmiconsize, nmiconsize)
-        self.iconNMchildrenincart = resldr.load_pixbuf('images/nmiconchildrenincart.svg', nmiconsize, nmiconsize)
-        self.iconNMnotincart = resldr.load_pixbuf('images/nmiconnotincart.svg', nmiconsize, nmiconsize)
+        # иконки - нужны уже для первого обновления списка
+        self.iconNMok, self.iconNMempty, \
+        self.iconNMincart, self.iconNMchildrenincart, self.iconNMnotincart, \
+        self.iconNMunk, self.iconNM6m, self.iconNM12m, self.iconNM18m, self.iconNM36m = map(lambda pp: pp.get(), pendingNMIcons)
 
-        self.iconNMunk = resldr.load_pixbuf('images/nmiconunk.svg', nmiconsize, nmiconsize)
-        self.iconNM6m = resldr.load_pixbuf('images/nmicon6m.svg', nmiconsize, nmiconsize)
-        self.iconNM12m = resldr.load_pixbuf('images/nmicon12m.svg', nmiconsize, nmiconsize)
-        self.iconNM18m = resldr.load_pixbuf('images/nmicon18m.svg', nmiconsize, nmiconsize)
-        self.iconNM36m = resldr.load_pixbuf('images/nmicon36m.svg', nmiconsize, nmiconsize)
-
-        self.iconPercent = list(map(lambda i: resldr.load_pixbuf('images/nmicon_p%d.svg' % i, nmiconsize, nmiconsize), range(self.PERCENT_RANGE)))
+        self.iconPercent = list(map(lambda pp: pp.get(), pendingPercentIcons))
 
         #
         # иконки для кнопки "открыть URL"
 
         self.iconOpenURL = load_system_icon('applications-internet', nmiconsizeix, symbolic=True)
-        self.iconOpenURLs = create_doubled_pixbuf(self.iconOpenURL)
-
-        #
-        # иконки "важности" товара
-
-        self.importanceIcons = ImportanceIcons(resldr)
+        # иконка берётся из темы, потому тема - тоже часть ключа
+        self.iconOpenURLs = self.resldr.pixbufCache.get_or_create(
+            ('doubled', 'applications-internet', nmiconsize,
+             Gtk.Settings.get_default().get_property('gtk-icon-theme-name')),
+            lambda: create_doubled_pixbuf(self.iconOpenURL))
 
         # TreeStore используется как хранилище данных во время работы
         # в первом столбце (WishCalc.COL_ITEM_OBJ) хранится ссылка
         # на экземпляр WishCalc.Item (см. wcdata.py)
 
         self.wishlistview = uibldr.get_object('wishlistview')
-        self.wishlistview.set_tooltip_column(WishCalc.COL_INFO)
+        # всплывающие подсказки строк сочиняются только по запросу
+        # (см. wl_query_tooltip()), а не для всех строк при каждом обновлении;
+        # LRU - ключи - см. get_item_tooltip(), значения - строки
+        self.wishlistview.set_has_tooltip(True)
+        self.itemTooltips = OrderedDict()
+
+        # значения столбцов, кроме чекбоксов, в TreeStore не хранятся
+        # и вычисляются только для отрисовываемых строк (см. get_item_row_view())
+        for colname, crname, ix, prop in (
+                ('colItemInCart', 'crInCart', self.ROW_VIEW_INCART_ICON, 'pixbuf'),
+                ('colItemImportance', 'crItemImportance', self.ROW_VIEW_IMPORTANCE_ICON, 'pixbuf'),
+                ('colItemName', 'crName', self.ROW_VIEW_NAME, 'markup'),
+                ('colItemCost', 'crCost', self.ROW_VIEW_COST, 'text'),
+                ('colItemQuantity', 'crQuantity', self.ROW_VIEW_QUANTITY, 'text'),
+                ('colItemSum', 'crSum', self.ROW_VIEW_SUM, 'text'),
+                ('colItemNeedCash', 'crNeededIcon', self.ROW_VIEW_NEEDS_ICON, 'pixbuf'),
+                ('colItemNeedCash', 'crNeeded', self.ROW_VIEW_NEEDS, 'text'),
+                ('colItemNeedMonths', 'crNeedMonths', self.ROW_VIEW_MONTHS, 'text')):
+            uibldr.get_object(colname).set_cell_data_func(uibldr.get_object(crname),
+                self.wl_cell_data, (ix, prop))
 
         self.wishlistviewsel = uibldr.get_object('wishlistviewsel')
 
+        #
+        # поиск
+        #
+        self.searchbar, self.searchentry, self.searchresultlabel = get_ui_widgets(uibldr,
+            ('searchbar', 'searchentry', 'searchresultlabel'))
+        self.searchbar.connect_entry(self.searchentry)
+
+        # None или строка поиска; пока поиск включен, в TreeView
+        # вместо TreeStore подключен фильтр searchFilter
+        # (Gtk.TreeModelFilter), показывающий только строки, у которых
+        # значение столбца WishCalc.COL_VISIBLE равно True
+        self.searchQuery = None
+        self.searchFilter = None
+        # множество Item.id строк, у которых COL_VISIBLE == True
+        self.searchVisible = set()
+        # множество Item.id товаров, добавленных во время поиска -
+        # они видны до изменения строки поиска, даже если не подходят
+        self.searchShown = set()
+        # None или значение WishCalc.nextItemId на момент последнего
+        # обновления списка - товары с Item.id не меньше него добавлены
+        # после обновления
+        self.searchNextItemId = None
+
+        #
+        # отображение списка в другом порядке - без изменения самого
+        # списка; ключи упорядочивания - в столбцах WishCalc.VIEW_SORT_COLUMNS
+        #
+        mnuViewSortNone, mnuViewSortSum, mnuViewSortMonths, mnuViewSortImportance, mnuViewSortName = get_ui_widgets(uibldr,
+            ('mnuViewSortNone', 'mnuViewSortSum', 'mnuViewSortMonths', 'mnuViewSortImportance', 'mnuViewSortName'))
+
+        # значения - None или кортежи (номер столбца, Gtk.SortType)
+        self.viewSortModes = {mnuViewSortNone:None,
+            mnuViewSortSum:(WishCalc.COL_SORT_SUM, Gtk.SortType.DESCENDING),
+            mnuViewSortMonths:(WishCalc.COL_SORT_MONTHS, Gtk.SortType.ASCENDING),
+            mnuViewSortImportance:(WishCalc.COL_SORT_IMPORTANCE, Gtk.SortType.DESCENDING),
+            mnuViewSortName:(WishCalc.COL_SORT_NAME, Gtk.SortType.ASCENDING)}
+
+        self.viewSort = None
+        # None или экземпляр Gtk.TreeModelSort
+        self.sortModel = None
+
         self.wlv_colItemSelect, self.wlv_colItemInCart, self.wlv_colItemImportance = get_ui_widgets(uibldr,
             ('colItemSelect', 'colItemInCart', 'colItemImportance'))
 
         uibldr.get_object('imgCart').set_from_pixbuf(self.iconNMincart)
         uibldr.get_object('imgImportance').set_from_pixbuf(self.importanceIcons.icons[0].pixbuf)
 
-        uibldr.get_object('imgItemPasteInto').set_from_pixbuf(resldr.load_pixbuf('images/paste-into.svg', nmiconsize, nmiconsize))
+        pendingPasteIntoIcon.when_ready(uibldr.get_object('imgItemPasteInto').set_from_pixbuf)
+
+        startupProfiler.phase_done('загрузка иконок')
 
         #
         # наличность и остаток
@@ -158,8 +269,19 @@ class MainWnd():
         self.cashentry, self.refillentry, self.remainsentry = get_ui_widgets(uibldr,
             ('cashentry', 'refillentry', 'remainsentry'))
 
-        self.cashcalc = Calculator(resldr, self.cashentry, True)
-        self.refillcalc = Calculator(resldr, self.refillentry, True)
+        self.cashcalc = Calculator(self.resldr, self.cashentry, True, self.fastStart)
+        self.refillcalc = Calculator(self.resldr, self.refillentry, True, self.fastStart)
+
+        # None или поле ввода суммы, изменения которого сейчас
+        # отменяются одним шагом (см. cash_edit_checkpoint());
+        # сбрасывается при уходе фокуса из поля и при прочих изменениях
+        self.cashEditEntry = None
+
+        # None или снимок списка на момент начала перетаскивания строки
+        self.dragSnapshot = None
+
+        for entry in (self.cashentry, self.refillentry):
+            entry.connect('focus-out-event', self.cash_entry_focus_out)
 
         # сумма выбранных в дереве
         self.selectedsumbox, self.selectedcounttxt, self.selectedsumtxt, \
@@ -173,11 +295,22 @@ class MainWnd():
         self.incartbox, self.incartcounttxt, self.incartsumtxt = get_ui_widgets(uibldr,
             ('incartbox', 'incartcounttxt', 'incartsumtxt'))
 
+        # отладочные пункты меню
+        uibldr.get_object('mnuDebugMemoryReport').set_visible(debugMode)
+
+        # панель статистики производительности
+        self.perfstatusbox, self.perfstatustxt, self.mnuViewPerfStatus = get_ui_widgets(uibldr,
+            ('perfstatusbox', 'perfstatustxt', 'mnuViewPerfStatus'))
+
+        # продолжительность последнего обновления TreeView (в секундах)
+        # и количество перезаписанных при этом строк TreeStore
+        self.lastRefreshTime = None
+        self.lastRefreshRows = 0
+
         #
-        # редактор товара
+        # редактор товара - создаётся методом get_item_editor()
         #
-        self.itemEditor = ItemEditorDlg(self.window, resldr,
-            self.cfg.itemEditorWindow, self.importanceIcons)
+        self.itemEditor = None
 
         # меню "товарных" команд - для вызова контекстного меню на списке товаров
         self.mnuItem = uibldr.get_object('mnuItem').get_submenu()
@@ -226,6 +359,19 @@ class MainWnd():
             'mnuItemMoveDown', 'btnItemMoveDown',
             'mnuItemMoveToBottom', 'btnItemMoveToBottom')
 
+        self.widgetsItemSort = WidgetList.new_from_builder(uibldr,
+            'mnuItemSort')
+        self.widgetsItemMoveChecked = WidgetList.new_from_builder(uibldr,
+            'mnuItemMoveCheckedToTop', 'mnuItemMoveCheckedToBottom')
+
+        self.mnuItemSortRecursive = uibldr.get_object('mnuItemSortRecursive')
+
+        self.mnuItemUndo, self.mnuItemRedo = get_ui_widgets(uibldr,
+            ('mnuItemUndo', 'mnuItemRedo'))
+
+        self.mnuRandomWeighted, self.mnuRandomUnpaid, self.mnuRandomUnchecked = get_ui_widgets(uibldr,
+            ('mnuRandomWeighted', 'mnuRandomUnpaid', 'mnuRandomUnchecked'))
+
         # эти - могут требовать дополнительных приседаний с бубном
         self.widgetsItemURL = WidgetList.new_from_builder(uibldr,
             'mnuItemOpenURL', 'btnItemOpenURL', 'mnuItemCopyURL')
@@ -246,64 +392,57 @@ class MainWnd():
         self.cbSelectAll = uibldr.get_object('cbSelectAll')
 
         #
+        # диалоговые окна и прочее, не нужное для отображения основного
+        # окна, лежат в отдельных файлах .ui и загружаются при первом
+        # обращении (см. load_ui_fragment())
         #
-        #
-        self.popoverFileCommentEditor = uibldr.get_object('popoverFileCommentEditor')
-        self.filecommententry = uibldr.get_object('filecommententry')
 
-        # потому что чортово Glade ентого не умеет, падло...
-        self.popoverFileCommentEditor.set_default_widget(uibldr.get_object('btnFCEntryDone'))
+        # ключи - имена файлов, значения - экземпляры Gtk.Builder
+        self.uiFragments = dict()
 
-        #
-        # ыбаутбокс
-        #
-        self.dlgAbout = uibldr.get_object('dlgAbout')
+        # редактор комментария к файлу - см. get_file_comment_editor()
+        self.popoverFileCommentEditor = None
+        self.filecommententry = None
 
-        logosize = Gtk.IconSize.lookup(Gtk.IconSize.DIALOG)[1] * 4
+        # ыбаутбокс - см. get_about_dialog()
+        self.dlgAbout = None
 
-        self.dlgAbout.set_logo(resldr.load_pixbuf('images/wishcalc_logo.svg', logosize, logosize))
-        self.dlgAbout.set_program_name(TITLE)
-        self.dlgAbout.set_comments(SUB_TITLE)
-        self.dlgAbout.set_version('v%s' % VERSION)
-        self.dlgAbout.set_copyright(COPYRIGHT)
-        self.dlgAbout.set_website(URL)
-        self.dlgAbout.set_website_label(URL)
+        # (файл .ui, имя диалога, title, isjson) - см. get_file_chooser()
+        self.fileChooserParams = {self.FileChooserMode.OPEN:('wishcalc_fileopen.ui', 'dlgFileOpen', 'Открыть', True),
+            self.FileChooserMode.SAVE_AS:('wishcalc_filesaveas.ui', 'dlgFileSaveAs', 'Сохранить как...', True),
+            self.FileChooserMode.EXPORT:('wishcalc_filesavecsv.ui', 'dlgFileSaveCSV', 'Экспорт в CSV', False)}
 
-        #
-        # диалог открытия файла
-        #
-        self.dlgFileOpen = uibldr.get_object('dlgFileOpen')
-
-        #
-        # диалог сохранения файла
-        #
-        self.dlgFileSaveAs = uibldr.get_object('dlgFileSaveAs')
-
-        #
-        # диалог экспорта файла CSV
-        #
-        self.dlgFileSaveCSV = uibldr.get_object('dlgFileSaveCSV')
-        self.chkExportHRHeaders = uibldr.get_object('chkExportHRHeaders')
-        self.chkExportHRValues = uibldr.get_object('chkExportHRValues')
-
-        # (dialog, title, isjson)
-        self.fileChooserParams = {self.FileChooserMode.OPEN:(self.dlgFileOpen, 'Открыть', True),
-            self.FileChooserMode.SAVE_AS:(self.dlgFileSaveAs, 'Сохранить как...', True),
-            self.FileChooserMode.EXPORT:(self.dlgFileSaveCSV, 'Экспорт в CSV', False)}
+        startupProfiler.phase_done('настройка виджетов')
 
         #
         # !!!
         #
         self.window.show_all()
 
-        self.cfg.load()
         #print('loaded:', self.cfg.mainWindow)
+
+        # обработчики сигналов ещё не подключены, потому видимость
+        # панели статистики выставляем сами
+        self.mnuViewPerfStatus.set_active(self.cfg.showPerfStatus)
+        self.perfstatusbox.set_visible(self.cfg.showPerfStatus)
+
         self.load_window_state()
-        self.itemEditor.load_window_state()
         #print('load_window_state called:', self.cfg.mainWindow)
         self.update_recent_files_menu()
 
+        startupProfiler.phase_done('отображение окна')
+
+        if not self.fastStart:
+            # приоритет у idle ниже, чем у отрисовки, так что первый
+            # кадр этим не задерживается
+            GLib.idle_add(self.prepare_dialogs)
+
         self.clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
+        # для копирования товаров (см. item_copy())
+        self.clipboardOwner = ClipboardOwner(Gdk.SELECTION_CLIPBOARD)
+        # поток для разбора вставляемого из буфера обмена
+        # (создаётся при первой вставке)
+        self.pasteExecutor = None
 
         uibldr.connect_signals(self)
 
@@ -316,10 +455,121 @@ class MainWnd():
         else:
             self.wishCalc = WishCalc(None)
 
+        startupProfiler.phase_done('загрузка файла')
+
         self.wishlist_is_loaded()
 
         self.update_sensitive_widgets_state()
 
+        startupProfiler.phase_done('первое обновление списка')
+
+        if startupProfiler.enabled:
+            self.startupDrawHandler = self.window.connect_after('draw', self.startup_first_draw)
+
+    def startup_first_draw(self, wnd, cr):
+        # первый кадр отрисован - запуск можно считать завершённым
+        self.window.disconnect(self.startupDrawHandler)
+
+        startupProfiler.phase_done('первый кадр')
+        startupProfiler.report()
+
+        return False
+
+    def prepare_dialogs(self):
+        """Создание редактора товара и диалоговых окон заранее,
+        чтобы при первом обращении к ним не было задержки.
+        Вызывается из цикла обработки событий после отображения
+        основного окна."""
+
+        self.get_item_editor()
+        self.get_about_dialog()
+        self.get_file_comment_editor()
+
+        for mode in self.FileChooserMode:
+            self.get_file_chooser(mode)
+
+        return False
+
+    def load_ui_fragment(self, filename):
+        """Возвращает экземпляр Gtk.Builder для файла filename,
+        при первом вызове загружая файл и подключая обработчики
+        сигналов."""
+
+        uibldr = self.uiFragments.get(filename)
+
+        if uibldr is None:
+            uibldr = self.resldr.load_gtk_builder(filename)
+            uibldr.connect_signals(self)
+
+            self.uiFragments[filename] = uibldr
+
+        return uibldr
+
+    def get_file_comment_editor(self):
+        """Возвращает экземпляр Gtk.Popover - редактор комментария
+        к файлу, при первом вызове создавая его."""
+
+        if self.popoverFileCommentEditor is None:
+            uibldr = self.load_ui_fragment('wishcalc_filecomment.ui')
+
+            self.filecommententry = uibldr.get_object('filecommententry')
+
+            popover = uibldr.get_object('popoverFileCommentEditor')
+            popover.set_relative_to(self.headerbar)
+
+            # потому что чортово Glade ентого не умеет, падло...
+            popover.set_default_widget(uibldr.get_object('btnFCEntryDone'))
+
+            self.popoverFileCommentEditor = popover
+
+        return self.popoverFileCommentEditor
+
+    def get_file_chooser(self, mode):
+        """Возвращает экземпляр Gtk.FileChooserDialog для режима mode
+        (FileChooserMode.*), при первом вызове создавая его."""
+
+        uifname, dlgname, title, isjson = self.fileChooserParams[mode]
+
+        dlg = self.load_ui_fragment(uifname).get_object(dlgname)
+
+        if dlg.get_transient_for() is None:
+            dlg.set_transient_for(self.window)
+
+        return dlg
+
+    def get_item_editor(self):
+        """Возвращает экземпляр ItemEditorDlg, при первом вызове
+        создавая его."""
+
+        if self.itemEditor is None:
+            self.itemEditor = ItemEditorDlg(self.window, self.resldr,
+                self.cfg.itemEditorWindow, self.importanceIcons, self.fastStart)
+            self.itemEditor.load_window_state()
+
+        return self.itemEditor
+
+    def get_about_dialog(self):
+        """Возвращает экземпляр Gtk.AboutDialog, при первом вызове
+        создавая его и загружая для него логотип и прочее."""
+
+        if self.dlgAbout is None:
+            dlg = self.load_ui_fragment('wishcalc_about.ui').get_object('dlgAbout')
+            dlg.set_transient_for(self.window)
+
+            logosize = Gtk.IconSize.lookup(Gtk.IconSize.DIALOG)[1] * 4
+
+            dlg.set_logo(self.resldr.load_pixbuf('images/wishcalc_logo.svg', logosize, logosize))
+            dlg.set_program_name(TITLE)
+            dlg.set_comments(SUB_TITLE)
+            dlg.set_version('v%s' % VERSION)
+            dlg.set_copyright(COPYRIGHT)
+            dlg.set_website(URL)
+            dlg.set_website_label(URL)
+
+            self.dlgAbout = dlg
+
+        return self.dlgAbout
+
     def update_recent_files_menu(self):
         if not self.cfg.recentFiles:
             self.mnuFileOpenRecent.set_submenu()
@@ -363,9 +613,10 @@ class MainWnd():
             self.file_open_filename(fname)
 
     def about_program(self, widget):
-        self.dlgAbout.show()
-        self.dlgAbout.run()
-        self.dlgAbout.hide()
+        dlg = self.get_about_dialog()
+        dlg.show()
+        dlg.run()
+        dlg.hide()
 
     def refresh_window_title(self):
         if self.wishCalc.filename:
@@ -441,17 +692,57 @@ class MainWnd():
         if self.mnuItemImportanceVisible == 0:
             self.wishlist_pop_up_menu(None, self.submnuItemImportance)
 
+    def wl_drag_begin(self, wgt, ctx):
+        # перетаскивание строк TreeView делает сам,
+        # потому снимок делаем заранее, а в историю он попадёт,
+        # только если список действительно изменился
+        self.dragSnapshot = self.wishCalc.make_snapshot()
+
     def wl_drag_end(self, wgt, ctx):
+        snapshot = self.dragSnapshot
+        self.dragSnapshot = None
+
+        # перетаскивание могли отменить или бросить строку на то же место
+        if snapshot is not None and not snapshot.same_as(self.wishCalc.make_snapshot()):
+            self.undo_checkpoint(snapshot)
+
         self.refresh_wishlistview()
 
+    def wl_query_tooltip(self, wgt, x, y, kbmode, tooltip):
+        hit, x, y, model, path, itr = wgt.get_tooltip_context(x, y, kbmode)
+        if not hit:
+            return False
+
+        itr = self.view_iter_to_store(itr)
+        store = self.wishCalc.store
+
+        item = store.get_value(itr, WishCalc.COL_ITEM_OBJ)
+
+        tooltip.set_markup(self.get_item_tooltip(item, store.iter_n_children(itr)))
+        wgt.set_tooltip_row(tooltip, path)
+
+        return True
+
     def wishlist_is_loaded(self):
         """Этот метод должен вызываться после успешной загрузки
         файла (т.е. если wishlist_load() не рухнул с исключением)."""
 
         # обязательно заменяем TreeStore загруженной!
-        self.wishlistview.set_model(self.wishCalc.store)
+        # (если включен поиск - фильтром для неё)
+        self.searchFilter = None
+        self.searchVisible = set()
+        self.searchShown.clear()
+        # Item.id и версии в другом файле - свои
+        self.searchNextItemId = None
+        self.itemTooltips.clear()
+        self.update_wishlistview_model()
         #...и надеемся, что предыдущий экземпляр будет укоцан потрохами PyGObject и питоньей сборкой мусора...
 
+        # история изменений относится к предыдущему списку
+        self.undoHistory.clear()
+        self.cashEditEntry = None
+        self.refresh_undo_redo_state()
+
         self.refresh_wishlistview()
 
         self.refresh_totalcash_view()
@@ -477,7 +768,8 @@ class MainWnd():
         OPEN, SAVE_AS, EXPORT = range(3)
 
     def __run_filename_dialog(self, mode):
-        dlg, title, isjson = self.fileChooserParams[mode]
+        dlg = self.get_file_chooser(mode)
+        title, isjson = self.fileChooserParams[mode][2:]
 
         dlg.set_title(title)
 
@@ -504,15 +796,19 @@ class MainWnd():
         """Экспорт в файла формата CSV с выбором имени,
         всех или выбранных товаров."""
 
-        self.chkExportHRHeaders.set_active(self.wishCalc.exportHRHeaders)
-        self.chkExportHRValues.set_active(self.wishCalc.exportHRValues)
+        chkExportHRHeaders, chkExportHRValues = get_ui_widgets(
+            self.load_ui_fragment(self.fileChooserParams[self.FileChooserMode.EXPORT][0]),
+            'chkExportHRHeaders', 'chkExportHRValues')
+
+        chkExportHRHeaders.set_active(self.wishCalc.exportHRHeaders)
+        chkExportHRValues.set_active(self.wishCalc.exportHRValues)
 
         dlg, r = self.__run_filename_dialog(self.FileChooserMode.EXPORT)
 
         if r == Gtk.ResponseType.OK:
             self.wishCalc.exportFilename = dlg.get_filename()
-            self.wishCalc.exportHRHeaders = self.chkExportHRHeaders.get_active()
-            self.wishCalc.exportHRValues = self.chkExportHRValues.get_active()
+            self.wishCalc.exportHRHeaders = chkExportHRHeaders.get_active()
+            self.wishCalc.exportHRValues = chkExportHRValues.get_active()
 
             try:
                 self.wishCalc.save_csv()
@@ -547,8 +843,9 @@ class MainWnd():
             self.file_open_filename(dlg.get_filename())
 
     def file_edit_comment(self, mnu):
+        popover = self.get_file_comment_editor()
         self.filecommententry.set_text(self.wishCalc.comment)
-        self.popoverFileCommentEditor.show()
+        popover.show()
 
     def filecommententry_changed(self, entry):
         self.wishCalc.comment = normalize_text(entry.get_text())
@@ -592,8 +889,11 @@ class MainWnd():
 
         self.widgetsItemCopyPaste.set_sensitive(bsens)
         self.widgetsItemEditing.set_sensitive(bsens)
-        self.widgetsItemMoveUp.set_sensitive(bsens & bcanmoveup)
-        self.widgetsItemMoveDown.set_sensitive(bsens & bcanmovedown)
+        # в упорядоченном отображении перемещения не видно
+        bcanmove = bsens and self.viewSort is None
+
+        self.widgetsItemMoveUp.set_sensitive(bcanmove & bcanmoveup)
+        self.widgetsItemMoveDown.set_sensitive(bcanmove & bcanmovedown)
         self.widgetsItemURL.set_sensitive(bsens & bcanopenurl)
 
         self.imgItemOpenURL.set_from_pixbuf(urlicon)
@@ -601,6 +901,15 @@ class MainWnd():
         self.widgetsSelectAll.set_sensitive(bcanselect)
         self.widgetsSelectNone.set_sensitive(bcanselect & bcanunselect)
 
+        self.widgetsItemSort.set_sensitive(hasitems)
+        self.widgetsItemMoveChecked.set_sensitive(bcanselect & bcanunselect)
+
+        self.refresh_undo_redo_state()
+
+    def refresh_undo_redo_state(self):
+        self.mnuItemUndo.set_sensitive(self.undoHistory.can_undo())
+        self.mnuItemRedo.set_sensitive(self.undoHistory.can_redo())
+
     def wishlistviewsel_changed(self, selection):
         self.update_sensitive_widgets_state()
 
@@ -618,6 +927,69 @@ class MainWnd():
 
             return self.iconPercent[int((avail / float(total)) * self.PERCENT_RANGE)]
 
+    # макс. количество запоминаемых всплывающих подсказок строк
+    ITEM_TOOLTIPS_CACHE_SIZE = 64
+
+    def get_item_name_markup(self, item, nchildren):
+        """Возвращает название товара item для отображения в TreeView
+        (в формате Pango Markup).
+        nchildren - количество вложенных элементов."""
+
+        itemname = markup_escape_text(item.name)
+
+        if nchildren > 1:
+            itemname = '%s <span size="smaller"><i>(%d)</i></span>' % (itemname, nchildren)
+
+        return itemname
+
+    def get_item_tooltip(self, item, nchildren):
+        """Возвращает текст всплывающей подсказки для строки TreeView
+        с товаром item (в формате Pango Markup).
+        nchildren - количество вложенных элементов.
+
+        Подсказки запоминаются в self.itemTooltips; ключ включает
+        в себя item.calc.rowKey (версию товара и расчётные значения,
+        от которых зависит отображение строки)."""
+
+        calc = item.calc
+
+        key = (item.id, calc.rowKey)
+
+        tooltip = self.itemTooltips.get(key)
+        if tooltip is not None:
+            self.itemTooltips.move_to_end(key)
+            return tooltip
+
+        infobuf = ['<b>%s</b>' % self.get_item_name_markup(item, nchildren)]
+
+        if item.info:
+            infobuf += ['', markup_escape_text(item.info)]
+
+        if not (item.incart and item.paid):
+            infomonthtxt = self.get_need_months_icon_text(calc.needTotal,
+                item.sum, calc.needMonths, None)[2]
+
+            if infomonthtxt:
+                infobuf += ['', infomonthtxt]
+
+        if item.incart:
+            infobuf += ['', '<u>Товар заказан%s.</u>' % ('' if not item.paid else ' и оплачен')]
+        elif calc.childrenInCart:
+            infobuf += ['', '<u>Некоторые из вложенных товаров заказаны.</u>']
+
+        # пока отключено, т.к. не уверен, что стоит долбать treeview
+        # обновлениями всех ветвей при клике по чекбоксам
+        #if calc.childrenSelected:
+        #    infobuf += ['', 'Выбрано несколько вложенных товаров.']
+
+        tooltip = '\n'.join(infobuf)
+
+        self.itemTooltips[key] = tooltip
+        if len(self.itemTooltips) > self.ITEM_TOOLTIPS_CACHE_SIZE:
+            self.itemTooltips.popitem(last=False)
+
+        return tooltip
+
     def get_need_months_icon_text(self, needsTotal, itemSum, nmonths, deficon):
         """Сочиняет текст для всплывающей подсказки и подбирает подобающую иконку.
 
@@ -670,7 +1042,15 @@ class MainWnd():
         """Полный пересчёт (а также обновление состояния чекбокса
         "выбрать всё")."""
 
-        nTotal, nSelected = self.wishCalc.recalculate()
+        self.wishCalc.recalculate()
+        self.refresh_select_all_state()
+
+    def refresh_select_all_state(self):
+        """Обновление состояния чекбокса "выбрать всё" по счётчикам
+        WishCalc (без пересчёта)."""
+
+        nTotal = self.wishCalc.totalItems
+        nSelected = self.wishCalc.totalItemsChecked
 
         if nTotal == 0:
             sa = False
@@ -682,6 +1062,94 @@ class MainWnd():
         self.cbSelectAll.set_active(sa)
         self.cbSelectAll.set_inconsistent(si)
 
+    # столбцы TreeStore, заполняемые refresh_wishlistview()
+    REFRESH_COLUMNS = WishCalc.VIEW_SORT_COLUMNS + (
+        # должен быть последним (см. __set_rows_visible())
+        WishCalc.COL_VISIBLE,
+        )
+
+    # индексы значений в кортеже, возвращаемом get_item_row_view()
+    ROW_VIEW_NAME, ROW_VIEW_COST, ROW_VIEW_NEEDS, ROW_VIEW_NEEDS_ICON,\
+    ROW_VIEW_MONTHS, ROW_VIEW_QUANTITY, ROW_VIEW_SUM,\
+    ROW_VIEW_IMPORTANCE_ICON, ROW_VIEW_INCART_ICON = range(9)
+
+    def get_item_row_view(self, item):
+        """Возвращает кортеж отображаемых значений строки TreeView
+        с товаром item (см. ROW_VIEW_*).
+
+        Значения вычисляются только для отрисовываемых строк (вызовом
+        из wl_cell_data()) и запоминаются в item.calc.rowView до тех пор,
+        пока refresh_wishlistview() не обнаружит изменения item.calc.rowKey."""
+
+        calc = item.calc
+
+        if calc.rowView is not None:
+            return calc.rowView
+
+        if item.incart and item.paid:
+            needs = 'оплачено'
+            needsicon = self.iconNMok
+            needmonths = ''
+        else:
+            if calc.needCash == 0:
+                needs = 'хватает'
+                needsicon = self.iconNMok
+            elif calc.needCash is None:
+                if item.sum <= 0:
+                    # сумма <0 для "скидок"
+                    needs = '-'
+                    needsicon = self.iconNMempty
+                else:
+                    needs = '?'
+                    needsicon = self.iconNMunk
+            else:
+                if calc.availCash > 0:
+                    needs = str(calc.needCash)
+                    needsicon = self.get_percent_icon(calc.availCash, item.sum)
+                else:
+                    needs = str(calc.needTotal) if calc.needTotal else ''
+                    needsicon = self.iconNMempty
+
+            needmonths, needsicon, _ = self.get_need_months_icon_text(calc.needTotal,
+                item.sum, calc.needMonths, needsicon)
+
+        importance = item.importance
+        #if importance == 0:
+        if importance < calc.childrenImportance:
+            importance = calc.childrenImportance
+
+        #!
+        if item.incart:
+            inCartIcon = self.iconNMincart
+        elif calc.childrenInCart:
+            inCartIcon = self.iconNMchildrenincart
+        else:
+            inCartIcon = self.iconNMnotincart
+
+        calc.rowView = (self.get_item_name_markup(item, calc.rowKey[-1]),
+            str(item.cost) if item.cost else '?',
+            needs,
+            needsicon,
+            needmonths,
+            str(item.quantity),
+            str(item.sum) if item.cost else '?',
+            self.importanceIcons.icons[importance].pixbuf,
+            inCartIcon,
+            #calc.childrenSelected,
+            )
+
+        return calc.rowView
+
+    def wl_cell_data(self, column, cell, model, itr, data):
+        """Заполнение свойства ячейки TreeView перед её отрисовкой.
+        data - кортеж из двух элементов: индекс значения в кортеже
+        get_item_row_view() и имя свойства CellRenderer'а."""
+
+        ix, prop = data
+
+        cell.set_property(prop,
+            self.get_item_row_view(model.get_value(itr, WishCalc.COL_ITEM_OBJ))[ix])
+
     def refresh_wishlistview(self, selitem=None):
         """Перерасчёт списка товаров, обновление содержимого TreeView.
 
@@ -689,133 +1157,77 @@ class MainWnd():
                   после обновления TreeView в нём должен быть подсвечен
                   элемент дерева, содержащий соотв. Item."""
 
-        self.recalculate_items()
+        refreshStarted = perf_counter()
 
-        # получается, что проходим по TreeStore второй раз (после recalculate)
-        # ну да и хрен с ним пока...
+        self.recalculate_items()
 
-        def __refresh_node(parentitr):
-            """Обновление полей элементов TreeStore на основе соответствующих
-            значений полей экземпляров WishCalc.Item.
+        if self.searchQuery is not None:
+            # товары, добавленные после предыдущего обновления,
+            # не должны исчезать из отфильтрованного списка
+            if self.searchNextItemId is not None:
+                self.searchShown.update(range(self.searchNextItemId, self.wishCalc.nextItemId))
 
-            Возвращает экземпляр Gtk.TreeIter, указывающий на элемент дерева,
-            который должен стать активным после обновления всего дерева."""
+            # список мог измениться - видимость строк определяем заново
+            self.searchVisible = self.wishCalc.search_items(self.searchQuery, self.searchShown)[1]
 
-            itr = self.wishCalc.store.iter_children(parentitr)
+        self.searchNextItemId = self.wishCalc.nextItemId
 
-            __itersel = None
+        searchVisible = self.searchVisible
 
-            while itr is not None:
-                item = self.wishCalc.store.get_value(itr, WishCalc.COL_ITEM_OBJ)
+        self.lastRefreshRows = 0
 
-                if item is selitem:
-                    __itersel = itr
+        # получается, что проходим по TreeStore второй раз (после recalculate)
+        # ну да и хрен с ним пока...
 
-                if item.incart and item.paid:
-                    needs = 'оплачено'
-                    needsicon = self.iconNMok
-                    needmonths = ''
-                    infomonthtxt = ''
-                else:
-                    if item.needCash == 0:
-                        needs = 'хватает'
-                        needsicon = self.iconNMok
-                    elif item.needCash is None:
-                        if item.sum <= 0:
-                            # сумма <0 для "скидок"
-                            needs = '-'
-                            needsicon = self.iconNMempty
-                        else:
-                            needs = '?'
-                            needsicon = self.iconNMunk
-                    else:
-                        if item.availCash > 0:
-                            needs = str(item.needCash)
-                            needsicon = self.get_percent_icon(item.availCash, item.sum)
-                        else:
-                            needs = str(item.needTotal) if item.needTotal else ''
-                            needsicon = self.iconNMempty
-
-                    needmonths, needsicon, infomonthtxt = self.get_need_months_icon_text(item.needTotal,
-                        item.sum, item.needMonths, needsicon)
-
-                itemname = markup_escape_text(item.name)
-
-                nchildren = self.wishCalc.store.iter_n_children(itr)
-                if nchildren > 1:
-                    itemname = '%s <span size="smaller"><i>(%d)</i></span>' % (itemname, nchildren)
-
-                infobuf = ['<b>%s</b>' % itemname]
-                infomonths = ''
-
-                if item.info:
-                    infobuf += ['', markup_escape_text(item.info)]
-
-                if infomonthtxt:
-                    infobuf += ['', infomonthtxt]
-
-                importance = item.importance
-                #if importance == 0:
-                if importance < item.childrenImportance:
-                    importance = item.childrenImportance
-
-                #!
-                if item.incart:
-                    inCartIcon = self.iconNMincart
-                    infoincart = '<u>Товар заказан%s.</u>' % ('' if not item.paid else ' и оплачен')
-                elif item.childrenInCart:
-                    inCartIcon = self.iconNMchildrenincart
-                    infoincart = '<u>Некоторые из вложенных товаров заказаны.</u>'
+        def __refresh_rows():
+            """Обновление полей элементов TreeStore на основе соответствующих
+            значений полей экземпляров WishCalc.Item."""
+
+            for row in get_tree_model_rows(self.wishCalc.store, None, WishCalc.COL_ITEM_OBJ):
+                item = row.values[0]
+
+                calc = item.calc
+
+                # отображаемые значения здесь не вычисляются - только
+                # то, от чего они зависят (у групп цена меняется при
+                # пересчёте, без изменения calc.version);
+                # nchildren должен быть последним (см. get_item_row_view())
+                rowkey = (calc.version, item.cost, item.sum,
+                    calc.needCash, calc.needTotal, calc.availCash, calc.needMonths,
+                    calc.childrenImportance, calc.childrenInCart,
+                    row.nchildren)
+
+                visible = item.id in searchVisible
+
+                if rowkey != calc.rowKey:
+                    # вычислим заново при отрисовке
+                    calc.rowKey = rowkey
+                    calc.rowView = None
+
+                    # всё, от чего зависят ключи упорядочивания, тоже
+                    # есть в rowkey - иначе их можно не вычислять
+                    rowvalues = self.wishCalc.view_sort_values(item) + (visible,)
+                elif calc.rowValues[-1] == visible:
+                    # строки, отображение которых не изменилось,
+                    # не трогаем - TreeView не будет их перерисовывать
+                    continue
                 else:
-                    inCartIcon = self.iconNMnotincart
-                    infoincart = ''
-
-                if infoincart:
-                    infobuf += ['', infoincart]
-
-                # пока отключено, т.к. не уверен, что стоит долбать treeview
-                # обновлениями всех ветвей при клике по чекбоксам
-                #if item.childrenSelected:
-                #    infobuf += ['', 'Выбрано несколько вложенных товаров.']
-
-                #
-                __subsel = __refresh_node(itr)
-
-                if __subsel is not None:
-                    __itersel = __subsel
-
-                self.wishCalc.store.set(itr,
-                    (WishCalc.COL_NAME,
-                        WishCalc.COL_COST,
-                        WishCalc.COL_NEEDED, WishCalc.COL_NEED_ICON,
-                        WishCalc.COL_NEED_MONTHS, WishCalc.COL_INFO,
-                        WishCalc.COL_QUANTITY, WishCalc.COL_SUM,
-                        WishCalc.COL_IMPORTANCE,
-                        WishCalc.COL_INCART,
-                        #WishCalc.COL_SELECTEDSUBITEMS,
-                        ),
-                    (itemname,
-                        str(item.cost) if item.cost else '?',
-                        needs,
-                        needsicon,
-                        needmonths,
-                        '\n'.join(infobuf),
-                        str(item.quantity),
-                        str(item.sum) if item.cost else '?',
-                        self.importanceIcons.icons[importance].pixbuf,
-                        inCartIcon,
-                        #item.childrenSelected,
-                        ))
-
-                itr = self.wishCalc.store.iter_next(itr)
-
-            return __itersel
-
-        itersel = __refresh_node(None)
+                    rowvalues = calc.rowValues[:-1] + (visible,)
+
+                calc.rowValues = rowvalues
+
+                self.lastRefreshRows += 1
+                # заодно - сигнал "row-changed", по которому TreeView
+                # перерисует строку
+                self.wishCalc.store.set(row.itr, self.REFRESH_COLUMNS, rowvalues)
+
+        __refresh_rows()
 
         # вертаем выбор взад
-        if itersel is not None:
-            self.item_select_by_iter(itersel)
+        if selitem is not None:
+            itersel = self.wishCalc.get_item_iter(selitem)
+            if itersel is not None:
+                self.item_select_by_iter(itersel)
 
         self.update_sensitive_widgets_state()
 
@@ -824,8 +1236,82 @@ class MainWnd():
         self.refresh_totalcash_view()
         self.refresh_remains_view()
 
+        self.lastRefreshTime = perf_counter() - refreshStarted
+
+        self.refresh_perf_status()
+
+    def refresh_perf_status(self):
+        """Обновление панели статистики производительности
+        (если она включена)."""
+
+        if not self.cfg.showPerfStatus or self.wishCalc is None:
+            return
+
+        self.perfstatustxt.set_text(' · '.join((
+            'товаров: %d' % self.wishCalc.totalItems,
+            'глубина: %d' % self.wishCalc.treeDepth,
+            'пересчёт: %s' % format_duration(self.wishCalc.lastRecalcTime),
+            'обновление: %s (строк: %d)' % (format_duration(self.lastRefreshTime), self.lastRefreshRows),
+            'сохранение: %s' % format_duration(self.wishCalc.lastSaveTime),
+            'память: %s' % format_size(get_process_rss()),
+            'быстрый старт: %s' % ('да' if self.fastStart else 'нет'))))
+
+    def view_perf_status_toggled(self, mnu):
+        self.cfg.showPerfStatus = mnu.get_active()
+        self.perfstatusbox.set_visible(self.cfg.showPerfStatus)
+
+        self.refresh_perf_status()
+
+    def debug_memory_report(self, mnu):
+        if self.wishCalc is None:
+            return
+
+        try:
+            report = memory_report_str(self.wishCalc)
+        except Exception as ex:
+            msg_dialog(self.window, TITLE, 'Ошибка при создании отчёта о расходе памяти:\n%s' % str(ex))
+            return
+
+        tv = Gtk.TextView()
+        tv.set_editable(False)
+        tv.set_monospace(True)
+        tv.get_buffer().set_text(report)
+
+        sw = Gtk.ScrolledWindow()
+        sw.set_min_content_width(WIDGET_BASE_WIDTH * 80)
+        sw.set_min_content_height(WIDGET_BASE_HEIGHT * 20)
+        sw.add(tv)
+        sw.show_all()
+
+        msg_dialog(self.window, 'Отчёт о расходе памяти', '',
+            msgtype=Gtk.MessageType.INFO, widgets=[sw])
+
+    def store_path_to_view(self, path):
+        """Преобразование пути path (экземпляра Gtk.TreePath) в TreeStore
+        в путь в модели, подключенной к TreeView.
+        Возвращает экземпляр Gtk.TreePath или None, если строка скрыта
+        фильтром поиска."""
+
+        for model in (self.searchFilter, self.sortModel):
+            if model is not None and path is not None:
+                path = model.convert_child_path_to_path(path)
+
+        return path
+
+    def view_iter_to_store(self, itr):
+        """Преобразование итератора itr модели, подключенной к TreeView,
+        в итератор TreeStore."""
+
+        for model in (self.sortModel, self.searchFilter):
+            if model is not None and itr is not None:
+                itr = model.convert_iter_to_child_iter(itr)
+
+        return itr
+
     def item_select_by_iter(self, itr, expandrow=False):
-        path = self.wishCalc.store.get_path(itr)
+        path = self.store_path_to_view(self.wishCalc.store.get_path(itr))
+        if path is None:
+            return
 
         if expandrow:
             self.wishlistview.expand_row(path, False)
@@ -860,14 +1346,22 @@ class MainWnd():
 
             item = self.wishCalc.get_item(itrsel)
 
-        item = self.itemEditor.edit(item,
+        item = self.get_item_editor().edit(item,
             not newitem and (False if itrsel is None else self.wishCalc.store.iter_n_children(itrsel) > 0))
 
         if item is not None:
             if not newitem:
-                # заменяем существующий экземпляр изменённым
-                self.wishCalc.replace_item(itrsel, item)
+                # изменяем существующий экземпляр на месте - только
+                # действительно изменённые поля
+                changes = self.wishCalc.get_item(itrsel).get_changes(item)
+                if not changes:
+                    return
+
+                self.undo_checkpoint()
+                item = self.wishCalc.apply_item_changes(itrsel, changes)
             else:
+                self.undo_checkpoint()
+
                 # добавляем новый
                 if newaschild is None:
                     parent = None
@@ -884,8 +1378,9 @@ class MainWnd():
 
                 if parent is not None:
                     # принудительно разворачиваем ветвь, иначе TreeView не изменит selection
-                    path = self.wishCalc.store.get_path(parent)
-                    self.wishlistview.expand_row(path, False)
+                    path = self.store_path_to_view(self.wishCalc.store.get_path(parent))
+                    if path is not None:
+                        self.wishlistview.expand_row(path, False)
 
             self.refresh_wishlistview(item)
 
@@ -898,21 +1393,17 @@ class MainWnd():
     def wl_item_selected_toggled(self, cr, path):
         # тыкнут чекбокс выбора элемента дерева
         # пока у нас один чекбокс на строку - столбец не проверяем
-        itr = self.wishCalc.store.get_iter(path)
-
-        item = self.wishCalc.store.get_value(itr, WishCalc.COL_ITEM_OBJ)
+        itr = self.view_iter_to_store(self.wishlistview.get_model().get_iter(path))
 
-        itemsel = not self.wishCalc.store.get_value(itr, WishCalc.COL_SELECTED)
-        self.wishCalc.store.set_value(itr, WishCalc.COL_SELECTED, itemsel)
+        itemsel = not self.wishCalc.get_item_checked(itr)
 
-        #if itemsel:
-        #    self.wishCalc.store.set_value(itr, WishCalc.COL_SELECTEDSUBITEMS, False)
-
-        # пересчитываем сумму ценников выбранных товаров
+        # сумма ценников выбранных товаров обновляется тут же,
+        # без полного пересчёта;
         # self.refresh_wishlistview() при этом вызывать не требуется
+        self.undo_checked_checkpoint(self.wishCalc.make_checked_change((itr,)))
+        self.wishCalc.set_item_checked(itr, itemsel)
 
-        self.recalculate_items()
-        #self.refresh_wishlistview()
+        self.refresh_select_all_state()
         self.refresh_selected_sum_view()
 
     def refresh_incart_view(self):
@@ -925,7 +1416,8 @@ class MainWnd():
         self.incartsumtxt.set_text(str(self.wishCalc.totalInCartSum))
 
     def refresh_selected_sum_view(self):
-        self.wishCalc.recalculate()
+        # значения totalSelected* должны быть уже обновлены
+        # вызовом recalculate() или set_item_checked()
 
         if self.wishCalc.totalSelectedCount:
             sumboxvisible = True
@@ -989,10 +1481,13 @@ class MainWnd():
 
         #self.update_sensitive_widgets_state() #!!!
 
+        self.refresh_perf_status()
+
     def get_selected_item_iter(self):
         """Возвращает Gtk.TreeIter если в TreeView выбрана строка,
-        иначе None."""
-        return self.wishlistviewsel.get_selected()[1]
+        иначе None.
+        Если включен поиск - возвращается итератор TreeStore, а не фильтра."""
+        return self.view_iter_to_store(self.wishlistviewsel.get_selected()[1])
 
     def item_set_importance(self, widget, importance=None):
         itrsel = self.get_selected_item_iter()
@@ -1000,9 +1495,12 @@ class MainWnd():
         if itrsel is None:
             return
 
-        item = self.wishCalc.get_item(itrsel)
+        if self.wishCalc.get_item(itrsel).importance == importance:
+            return
+
+        self.undo_checkpoint()
+        item = self.wishCalc.apply_item_changes(itrsel, {WishCalc.Item.IMPORTANCE:importance})
 
-        item.importance = importance
         self.refresh_wishlistview(item)
 
     def item_toggle_incart(self, widget):
@@ -1011,10 +1509,14 @@ class MainWnd():
         if itrsel is None:
             return
 
-        item = self.wishCalc.get_item(itrsel)
-        item.incart = not item.incart
-        if not item.incart:
-            item.paid = False
+        incart = not self.wishCalc.get_item(itrsel).incart
+
+        changes = {WishCalc.Item.INCART:incart}
+        if not incart:
+            changes[WishCalc.Item.PAID] = False
+
+        self.undo_checkpoint()
+        item = self.wishCalc.apply_item_changes(itrsel, changes)
 
         self.refresh_wishlistview(item)
 
@@ -1027,7 +1529,8 @@ class MainWnd():
         item = self.wishCalc.get_item(itrsel)
 
         if item.incart:
-            item.paid = not item.paid
+            self.undo_checkpoint()
+            self.wishCalc.apply_item_changes(itrsel, {WishCalc.Item.PAID:not item.paid})
 
             self.refresh_wishlistview(item)
 
@@ -1041,6 +1544,7 @@ class MainWnd():
         self.__do_edit_item(True, True)
 
     def __item_select_all(self, select):
+        self.undo_checked_checkpoint(self.wishCalc.make_select_items_change(select))
         self.wishCalc.select_items(select)
         self.recalculate_items()
         self.refresh_selected_sum_view()
@@ -1060,137 +1564,215 @@ class MainWnd():
     def item_collapse_all(self, widget):
         self.wishlistview.collapse_all()
 
-    def item_random_choice(self, widget):
-        # список всех Gtk.TreeIter дерева товаров
-        alliters = []
+    def update_wishlistview_model(self):
+        """Подключение к TreeView TreeStore или, если включен поиск,
+        фильтра для неё; если включено отображение в другом порядке -
+        поверх них подключается Gtk.TreeModelSort."""
 
-        def __gather_children(parentitr):
-            itr = self.wishCalc.store.iter_children(parentitr)
-            while itr is not None:
-                alliters.append(itr)
-                __gather_children(itr)
-                itr = self.wishCalc.store.iter_next(itr)
+        store = self.wishCalc.store
 
-        __gather_children(None)
+        if self.searchQuery is None:
+            self.searchFilter = None
+            model = store
+        else:
+            if self.searchFilter is None or self.searchFilter.get_model() is not store:
+                self.searchFilter = store.filter_new(None)
+                self.searchFilter.set_visible_column(WishCalc.COL_VISIBLE)
 
-        if alliters:
-            self.item_select_by_iter(random_choice(alliters), True)
+            model = self.searchFilter
 
-    def __get_item_names(self, itr, children=True):
-        """Получает и возвращает список строк с именами элемента дерева,
-        на который указывает itr (экземпляр Gtk.TreeIter), и всех
-        вложенных элементов, если children==True."""
+        if self.viewSort is None:
+            self.sortModel = None
+        else:
+            if self.sortModel is None or self.sortModel.get_model() is not model:
+                self.sortModel = Gtk.TreeModelSort(model=model)
 
-        item = self.wishCalc.get_item(itr)
-        names = [item.name]
+            self.sortModel.set_sort_column_id(*self.viewSort)
+            model = self.sortModel
 
-        def __gather_subitem_names(fromitr):
-            itr = self.wishCalc.store.iter_children(fromitr)
+        if self.wishlistview.get_model() is not model:
+            self.wishlistview.set_model(model)
 
-            while itr is not None:
-                names.append(self.wishCalc.get_item(itr).name)
+        # перетаскивание строк в отфильтрованном или упорядоченном
+        # дереве - ну его нафиг
+        self.wishlistview.set_reorderable(self.searchQuery is None and self.viewSort is None)
 
-                __gather_subitem_names(itr)
+    def view_sort_toggled(self, mnu):
+        # сигнал приходит и от выключаемого пункта
+        if not mnu.get_active():
+            return
 
-                itr = self.wishCalc.store.iter_next(itr)
+        self.viewSort = self.viewSortModes[mnu]
 
-        if children:
-            __gather_subitem_names(itr)
+        itr = self.get_selected_item_iter()
 
-        return names
+        self.update_wishlistview_model()
 
-    def __get_selected_items(self, copydata):
-        """Получение списка выбранных элементов дерева.
+        if itr is not None:
+            self.item_select_by_iter(itr)
 
-        copydata    - режим копирования;
-                      False - в список помещаются только строки
-                              с названиями товаров;
-                      True  - в список помещаются словари с полными
-                              данными товаров.
+        self.update_sensitive_widgets_state()
 
-        Если есть помеченные (чекбоксами) элементы - берём их все,
-        иначе - только тот, на котором курсор.
-        В выхлоп попадают все подэлементы выбранных элементов.
-        Возвращает, соответственно, список, если было что возвращать,
-        иначе - пустой список."""
+    def __set_rows_visible(self, itemids, visible):
+        """Установка значения visible (булевского) в столбце COL_VISIBLE
+        строк товаров с идентификаторами из itemids."""
 
-        retl = []
+        store = self.wishCalc.store
+        itemIndex = self.wishCalc.itemIndex
 
-        def __get_itemdict(itr):
-            itemdict = self.wishCalc.get_item(itr).get_fields_dict()
+        for itemid in itemids:
+            itr = itemIndex.get(itemid)
+            if itr is None:
+                continue
 
-            subitems = self.wishCalc.items_to_list(itr)
-            if subitems:
-                itemdict[WishCalc.Item.ITEMS] = subitems
+            store.set_value(itr, WishCalc.COL_VISIBLE, visible)
 
-            return itemdict
+            # refresh_wishlistview() должна знать, что в строке сейчас
+            calc = self.wishCalc.get_item(itr).calc
+            if calc.rowValues is not None:
+                calc.rowValues = calc.rowValues[:-1] + (visible,)
 
-        def __gather_checked_items(fromitr):
-            # проверяем сам элемент
+    def search_items(self, query):
+        """Поиск товаров по строке query (None или пустая строка -
+        выключение поиска).
+        Найденные товары вычисляются по индексу (см. WishCalc.search_items()),
+        а в TreeStore перезаписываются только строки, видимость которых
+        изменилась."""
 
-            lret = []
+        # добавленные во время поиска товары видны до смены строки поиска
+        self.searchShown.clear()
 
-            if fromitr is not None:
-                if self.wishCalc.get_item_checked(fromitr):
-                    if copydata:
-                        lret.append(__get_itemdict(fromitr))
-                    else:
-                        lret += self.__get_item_names(fromitr)
+        if query:
+            found, visible = self.wishCalc.search_items(query)
+        else:
+            query = None
+            found = None
+            visible = set()
 
-            itr = self.wishCalc.store.iter_children(fromitr)
+        show = visible - self.searchVisible
+        hide = self.searchVisible - visible
 
-            while itr is not None:
-                lret += __gather_checked_items(itr)
-                itr = self.wishCalc.store.iter_next(itr)
+        itr = self.get_selected_item_iter()
+        selitem = self.wishCalc.get_item(itr) if itr is not None else None
 
-            return lret
+        self.searchQuery = query
+        self.searchVisible = visible
 
-        if self.wishCalc.totalSelectedCount:
-            # есть помеченные
+        with TreeViewDetached(self.wishlistview, WishCalc.COL_ITEM_OBJ,
+                len(show) + len(hide) > self.BULK_CHANGE_DETACH_ROWS):
+            self.__set_rows_visible(hide, False)
+            self.__set_rows_visible(show, True)
+
+        self.update_wishlistview_model()
 
-            retl += __gather_checked_items(None)
+        if found is None:
+            self.searchresultlabel.set_text('')
         else:
-            # только выделенный элемент TreeView
-            itrsel = self.get_selected_item_iter()
+            self.searchresultlabel.set_text('найдено: %d' % len(found))
+            # найденное в свёрнутых группах тоже должно быть видно
+            self.wishlistview.expand_all()
 
-            if itrsel is None:
-                return
+        if selitem is not None:
+            itr = self.wishCalc.get_item_iter(selitem)
+            if itr is not None:
+                self.item_select_by_iter(itr)
 
-            if copydata:
-                retl.append(__get_itemdict(itrsel))
-            else:
-                retl += self.__get_item_names(itrsel)
+        self.update_sensitive_widgets_state()
+
+    def item_search(self, widget):
+        self.searchbar.set_search_mode(True)
+        self.searchentry.grab_focus()
+
+    def searchentry_changed(self, entry):
+        self.search_items(entry.get_text().strip())
 
-        return retl
+    def searchentry_stop(self, entry):
+        self.searchbar.set_search_mode(False)
+
+    def searchbar_mode_changed(self, searchbar, pspec):
+        if not searchbar.get_search_mode():
+            self.searchentry.set_text('')
+            self.search_items(None)
+
+    def item_random_choice(self, widget):
+        flags = 0
+        if self.mnuRandomUnpaid.get_active():
+            flags |= WishCalc.RANDOM_UNPAID
+        if self.mnuRandomUnchecked.get_active():
+            flags |= WishCalc.RANDOM_UNCHECKED
+
+        # при поиске - только из видимых строк
+        itr = self.wishCalc.random_item_iter(self.mnuRandomWeighted.get_active(), flags,
+            itemids=self.searchVisible if self.searchQuery is not None else None)
+
+        if itr is not None:
+            self.item_select_by_iter(itr, True)
+
+    def __get_item_names(self, itr, children=True):
+        """Получает и возвращает список строк с именами элемента дерева,
+        на который указывает itr (экземпляр Gtk.TreeIter), и всех
+        вложенных элементов, если children==True."""
+
+        item = self.wishCalc.get_item(itr)
+        names = [item.name]
+
+        if children:
+            names += map(lambda i: i.name, self.wishCalc.get_subtree_items(itr))
+
+        return names
+
+    def __get_selected_iters(self):
+        """Получение списка выбранных элементов дерева.
+
+        Если есть помеченные (чекбоксами) элементы - берём их все
+        (кроме вложенных в помеченные - они попадут в выхлоп вместе
+        с помеченным), иначе - только тот, на котором курсор.
+        Возвращает список экземпляров Gtk.TreeIter (пустой, если
+        ничего не выбрано)."""
+
+        if self.wishCalc.totalSelectedCount:
+            # есть помеченные
+            return self.wishCalc.get_checked_items()
+
+        # только выделенный элемент TreeView
+        itrsel = self.get_selected_item_iter()
+
+        return [itrsel] if itrsel is not None else []
 
     def item_copy(self, btn):
         """Кладём выбранные элементы с подэлементами в clipboard
         в виде JSON.
         Если есть помеченные (чекбоксами) элементы - кладём их все,
         иначе - только тот, на котором курсор.
-        А нету курсора - ничего и не делаем."""
+        А нету курсора - ничего и не делаем.
 
-        copylst = self.__get_selected_items(True)
+        JSON формируется без отступов и без промежуточных словарей
+        (см. WishCalc.items_to_json_str()); в буфер обмена он кладётся
+        и как текст, и в виде CLIPBOARD_TARGET (см. ClipboardOwner)."""
 
-        if len(copylst):
-            self.clipboard.set_text(json.dumps({self.CLIPBOARD_DATA:copylst},
-                ensure_ascii=False,
-                # отступы - на случай вставки в текстовый редактор,
-                # а не в WishCalc
-                indent='  '),
-                -1)
+        itrs = self.__get_selected_iters()
+
+        if itrs:
+            self.clipboardOwner.set_text('{%s:%s}' % (json.dumps(self.CLIPBOARD_DATA),
+                self.wishCalc.items_to_json_str(itrs)))
 
     def item_copy_as_text(self, wgt):
         """Действует аналогично item_copy(), но в clipboard помещается
         текст, разделенный переносами строк, содержащий только названия
         выбранных товаров."""
 
-        copylst = self.__get_selected_items(False)
+        copylst = []
+
+        for itr in self.__get_selected_iters():
+            copylst += self.__get_item_names(itr)
 
         if len(copylst):
             copylst.append('') # дабы join'ом добавился последний перевод строки
             self.clipboard.set_text('\n'.join(copylst), -1)
 
+    # максимальное количество сообщений об ошибках в сводке после вставки
+    PASTE_MAX_ERRORS = 10
+
     def __item_paste(self, intoselected):
         """Вставка товара из буфера обмена.
         Eсли в TreeView есть выбранный элемент:
@@ -1199,89 +1781,136 @@ class MainWnd():
             intoselected == False:
                 товар вставляется на том же уровне дерева после выбранного.
         Если выбранного элемента нет, товар вставляется в конец списка
-        на верхнем уровне дерева."""
+        на верхнем уровне дерева.
 
-        #
-        # пытаемся тащить данные из буфера обмена
-        #
+        Содержимое буфера обмена запрашивается асинхронно (сначала
+        в виде CLIPBOARD_TARGET, при его отсутствии - в виде текста),
+        разбирается и проверяется в отдельном потоке (см.
+        __parse_paste_data()), а вставляется в дерево уже по готовности
+        (см. __paste_parsed()), так что окно при вставке больших списков
+        не замирает."""
+
+        self.clipboard.request_contents(self.clipboardOwner.itemsAtom,
+            self.__paste_contents_received, intoselected)
+
+    def __paste_contents_received(self, clipboard, selectiondata, intoselected):
+        data = selectiondata.get_data() if selectiondata.get_length() > 0 else None
+
+        if not data:
+            # в буфере обмена не товары от WishCalc (или они от старой
+            # версии, кладущей в буфер только текст)
+            self.clipboard.request_text(self.__paste_text_received, intoselected)
+            return
+
+        self.__parse_paste_data_async(data, intoselected)
 
-        tmps = self.clipboard.wait_for_text()
-        if tmps is None:
+    def __paste_text_received(self, clipboard, text, intoselected):
+        if text is None:
             # нету там нифига - молча ничего не делаем
             return
 
+        self.__parse_paste_data_async(text, intoselected)
+
+    def __parse_paste_data_async(self, data, intoselected):
+        if self.pasteExecutor is None:
+            self.pasteExecutor = ThreadPoolExecutor(max_workers=1)
+
+        future = self.pasteExecutor.submit(self.__parse_paste_data, data)
+        future.add_done_callback(lambda f: GLib.idle_add(self.__paste_parsed, f, intoselected))
+
+    def __parse_paste_data(self, data):
+        """Разбор содержимого буфера обмена - строки (текста) или bytes
+        (данных CLIPBOARD_TARGET, см. unpack_clipboard_data()).
+        Вызывается из другого потока, потому UI не трогает.
+
+        Возвращает None, если в буфере обмена не наши данные, иначе
+        кортеж из трёх элементов:
+        1й: список элементов (см. WishCalc.items_from_list()),
+        2й: общее количество элементов,
+        3й: список сообщений об ошибках.
+        В случае несовместимых данных генерирует исключение ValueError."""
+
+        text = unpack_clipboard_data(data) if isinstance(data, bytes) else data
+
         try:
-            tmpd = json.loads(tmps)
+            tmpd = json.loads(text)
         except json.JSONDecodeError:
             # поломатый JSON - опять молча ничего не делаем
             return
-            #return 'неподдерживаемый формат содержимого буфера обмена'
 
-        if self.CLIPBOARD_DATA not in tmpd:
+        if not isinstance(tmpd, dict) or self.CLIPBOARD_DATA not in tmpd:
             # не наши данные - тоже молча ничего не делаем
             return
-            #return 'буфер обмена не содержит данных, поддерживаемых %s' % TITLE
+
+        items = tmpd[self.CLIPBOARD_DATA]
+
+        # на случай, ежели копипастить будут из предыдущей версии,
+        # проверяем, что нам приехало
+        if isinstance(items, dict):
+            items = [items]
+        elif not isinstance(items, list):
+            raise ValueError('В буфере обмена находятся данные от несовместимой версии программы')
+
+        errors = []
+        items, nitems = WishCalc.items_from_list(items, errors)
+
+        return (items, nitems, errors)
+
+    def __paste_parsed(self, future, intoselected):
+        """Вставка в дерево разобранного содержимого буфера обмена.
+        future  - экземпляр concurrent.futures.Future с результатом
+                  __parse_paste_data()."""
 
         E_PASTE = 'Вставка из буфера обмена'
 
-        itrsel = self.get_selected_item_iter()
-        if itrsel is None:
-            # ничего не выбрано - вставляем элемент в конец списка
-            parentitr = None
-        elif intoselected:
-            parentitr = itrsel
-            itrsel = None
-        else:
-            # иначе - после выбранного элемента на его уровне
-            parentitr = self.wishCalc.store.iter_parent(itrsel)
+        try:
+            parsed = future.result()
+        except Exception as ex:
+            msg_dialog(self.window, E_PASTE, str(ex))
+            return
 
-        def __do_paste_itemdict(itemdict):
-            # таки пытаемся уже чего-то вставить
-            item = WishCalc.Item()
-            try:
-                item.set_fields_dict(itemdict)
+        if parsed is None:
+            return
 
-                inserteditr = self.wishCalc.store.insert_after(parentitr, itrsel,
-                    self.wishCalc.make_store_row(item))
+        items, nitems, errors = parsed
 
-                # рекурсивно добавляем подэлементы, если они есть
-                if WishCalc.Item.ITEMS in itemdict:
-                    self.wishCalc.load_subitems(inserteditr,
-                        itemdict[WishCalc.Item.ITEMS], [])
+        if items:
+            itrsel = self.get_selected_item_iter()
+            if itrsel is None:
+                # ничего не выбрано - вставляем элемент в конец списка
+                parentitr = None
+            elif intoselected:
+                parentitr = itrsel
+                itrsel = None
+            else:
+                # иначе - после выбранного элемента на его уровне
+                parentitr = self.wishCalc.store.iter_parent(itrsel)
 
-                return (item, inserteditr)
+            self.undo_checkpoint()
 
-            except Exception as ex:
-                # пока - так
-                msg_dialog(self.window, E_PASTE,
-                    'Ошибка: %s' % str(ex))
-                return
+            with TreeViewDetached(self.wishlistview, WishCalc.COL_ITEM_OBJ,
+                    nitems > self.BULK_CHANGE_DETACH_ROWS):
+                selitem, itrsel = self.wishCalc.insert_items(parentitr, itrsel, items)
 
-        items = tmpd[self.CLIPBOARD_DATA]
+            self.refresh_wishlistview(selitem)
 
-        # на случай, ежели копипастить будут из предыдущей версии,
-        # проверяем, что нам приехало
-        if isinstance(items, list):
-            for itemdict in items:
-                selitem, itrsel =  __do_paste_itemdict(itemdict)
-        elif isinstance(items, dict):
-            selitem, itrsel = __do_paste_itemdict(items)
-        else:
-            msg_dialog(self.window, E_PASTE,
-                'В буфере обмена находятся данные от несовместимой версии программы')
-            return
+        if errors:
+            emsgs = errors[:self.PASTE_MAX_ERRORS]
+            if len(errors) > len(emsgs):
+                emsgs.append('...и ещё %d' % (len(errors) - len(emsgs)))
 
-        self.refresh_wishlistview(selitem)
+            msg_dialog(self.window, E_PASTE,
+                'Не удалось вставить элементов: %d\n\n%s' % (len(errors), '\n'.join(emsgs)))
 
     def item_paste(self, btn):
         """Вставка товара из буфера обмена."""
 
-        self.__item_paste(None)
+        self.__item_paste(False)
 
     def item_paste_into_selected(self, btn):
         """Вставка из буфера обмена дочерних элементов в выбранный"""
 
-        self.__item_paste(self.get_selected_item_iter())
+        self.__item_paste(True)
 
     def item_open_url(self, btn):
         itr = self.get_selected_item_iter()
@@ -1363,10 +1992,14 @@ class MainWnd():
                 buttons=Gtk.ButtonsType.YES_NO,
                 destructive_response=Gtk.ResponseType.YES) == Gtk.ResponseType.YES:
 
-            for itr in delitrs:
-                self.wishCalc.item_delete(itr, ispurchased)
+            self.undo_checkpoint()
+
+            with TreeViewDetached(self.wishlistview, WishCalc.COL_ITEM_OBJ,
+                    ndel > self.BULK_CHANGE_DETACH_ROWS):
+                self.wishCalc.items_delete(delitrs, ispurchased)
 
             self.refresh_wishlistview()
+            self.refresh_selected_sum_view()
 
     def item_purchased(self, btn):
         self.__do_delete_item(True)
@@ -1392,6 +2025,7 @@ class MainWnd():
             else:
                 moveref = None
 
+            self.undo_checkpoint()
             movefunc(itr, moveref)
 
             self.refresh_wishlistview()
@@ -1408,6 +2042,62 @@ class MainWnd():
     def item_to_bottom(self, btn):
         self.__move_selected_item(True, False)
 
+    def __sort_items(self, sortby):
+        """Упорядочивание товаров уровня дерева, на котором находится
+        выбранный элемент (или верхнего уровня, если ничего не выбрано).
+
+        sortby  - способ упорядочивания (одна из констант WishCalc.SORT_*)."""
+
+        itr = self.get_selected_item_iter()
+
+        if itr is None:
+            parentitr = None
+            selitem = None
+        else:
+            parentitr = self.wishCalc.store.iter_parent(itr)
+            selitem = self.wishCalc.get_item(itr)
+
+        self.undo_checkpoint()
+        self.wishCalc.sort_items(parentitr, sortby, self.mnuItemSortRecursive.get_active())
+
+        self.refresh_wishlistview(selitem)
+
+    def item_sort_by_importance(self, mnu):
+        self.__sort_items(WishCalc.SORT_IMPORTANCE)
+
+    def item_sort_by_cost(self, mnu):
+        self.__sort_items(WishCalc.SORT_COST)
+
+    def item_sort_by_sum(self, mnu):
+        self.__sort_items(WishCalc.SORT_SUM)
+
+    def item_sort_by_name(self, mnu):
+        self.__sort_items(WishCalc.SORT_NAME)
+
+    def item_sort_by_months(self, mnu):
+        self.__sort_items(WishCalc.SORT_MONTHS)
+
+    def __move_checked_items(self, tobottom):
+        """Перемещение помеченных товаров в начало или в конец
+        (если tobottom=True) их уровней дерева."""
+
+        if not self.wishCalc.totalSelectedCount:
+            return
+
+        itr = self.get_selected_item_iter()
+        selitem = self.wishCalc.get_item(itr) if itr is not None else None
+
+        self.undo_checkpoint()
+        self.wishCalc.move_checked_items(tobottom)
+
+        self.refresh_wishlistview(selitem)
+
+    def item_checked_to_top(self, mnu):
+        self.__move_checked_items(False)
+
+    def item_checked_to_bottom(self, mnu):
+        self.__move_checked_items(True)
+
     def get_cash_entry_changes(self, entry, errormsg):
         try:
             cash = int(entry.get_text())
@@ -1421,12 +2111,34 @@ class MainWnd():
             show_entry_error(entry, errormsg)
             return None
 
+    def cash_edit_checkpoint(self, entry):
+        """Запоминание состояния списка перед изменением суммы в поле
+        ввода entry. Последовательные изменения одного поля (ввод числа
+        по цифре) отменяются одним шагом."""
+
+        if self.cashEditEntry is not entry:
+            self.undo_checkpoint()
+            self.cashEditEntry = entry
+
+    def cash_entry_focus_out(self, entry, event):
+        if self.cashEditEntry is entry:
+            self.cashEditEntry = None
+
+        return False
+
     def cashentry_changed(self, entry):
         """Изменение поля доступной суммы"""
 
         v = self.get_cash_entry_changes(entry, 'Доступная сумма указана неправильно')
+        if v is None:
+            v = 0
+
+        # поле могли заполнить и из программы (напр. при отмене изменений)
+        if v == self.wishCalc.totalCash:
+            return
 
-        self.wishCalc.totalCash = v if v is not None else 0
+        self.cash_edit_checkpoint(entry)
+        self.wishCalc.totalCash = v
 
         self.refresh_wishlistview()
         self.refresh_selected_sum_view()
@@ -1436,8 +2148,11 @@ class MainWnd():
 
         v = self.get_cash_entry_changes(entry, 'Сумма ежемесячных пополнений указана неправильно')
         if v is not None:
-            self.wishCalc.refillCash = v
-            self.refresh_wishlistview()
+            if v != self.wishCalc.refillCash:
+                self.cash_edit_checkpoint(entry)
+                self.wishCalc.refillCash = v
+                self.refresh_wishlistview()
+
             bsens = v > 0
         else:
             bsens = False
@@ -1446,9 +2161,86 @@ class MainWnd():
 
     def do_refill_cash(self, btn):
         if self.wishCalc.refillCash > 0:
+            self.undo_checkpoint()
             self.wishCalc.totalCash += self.wishCalc.refillCash
             self.refresh_wishlistview()
 
+    def undo_checkpoint(self, snapshot=None):
+        """Запоминание текущего состояния списка перед его изменением.
+        Должно вызываться перед каждой операцией, которую можно отменить.
+        snapshot - None или сделанный ранее экземпляр WishCalc.Snapshot,
+                   который следует запомнить вместо текущего состояния."""
+
+        self.cashEditEntry = None
+        self.undoHistory.push(snapshot if snapshot is not None else self.wishCalc.make_snapshot())
+        self.refresh_undo_redo_state()
+
+    def undo_checked_checkpoint(self, change):
+        """Запоминание пометок элементов перед их изменением.
+        change - экземпляр WishCalc.CheckedChange (см.
+        WishCalc.make_checked_change()) или None; в последнем случае
+        запоминается снимок всего списка."""
+
+        if change is None:
+            self.undo_checkpoint()
+        else:
+            self.cashEditEntry = None
+            self.undoHistory.push(change)
+            self.refresh_undo_redo_state()
+
+    def __undo_redo(self, redo):
+        """Отмена последнего изменения списка или, если redo=True,
+        повтор отменённого."""
+
+        itr = self.get_selected_item_iter()
+        selitem = self.wishCalc.get_item(itr) if itr is not None else None
+
+        self.cashEditEntry = None
+
+        # запись, по которой восстанавливалось состояние
+        restored = []
+
+        def __restore(entry):
+            restored.append(entry)
+
+            if isinstance(entry, WishCalc.CheckedChange):
+                return self.wishCalc.apply_checked_change(entry)
+
+            # восстановленные товары получают прежние Item.id при новых
+            # (с нуля) ItemCalc.version, т.е. ключи подсказок могут совпасть
+            # с ключами подсказок других состояний тех же товаров
+            self.itemTooltips.clear()
+
+            # TreeStore обновляется только в изменившихся местах, так что
+            # TreeView не отключаем - развёрнутые ветви останутся как были
+            return self.wishCalc.restore_snapshot(entry)
+
+        done = self.undoHistory.redo(__restore) if redo else self.undoHistory.undo(__restore)
+
+        self.refresh_undo_redo_state()
+
+        if not done:
+            return
+
+        if isinstance(restored[0], WishCalc.CheckedChange):
+            # изменились только пометки - список не пересчитываем
+            self.refresh_select_all_state()
+            self.refresh_selected_sum_view()
+            self.update_sensitive_widgets_state()
+            return
+
+        self.refresh_wishlistview(selitem)
+        self.refresh_select_all_state()
+        self.refresh_selected_sum_view()
+
+        self.refillentry.set_text(str(self.wishCalc.refillCash))
+
+    def item_undo(self, mnu):
+        self.__undo_redo(False)
+
+    def item_redo(self, mnu):
+        self.__undo_redo(True)
+
     def refresh_remains_view(self):
         self.remainsentry.set_text(str(self.wishCalc.totalRemain) if self.wishCalc.totalRemain > 0 else 'нет')
 
@@ -1458,6 +2250,7 @@ class MainWnd():
 
         try:
             self.wishCalc.save()
+            self.refresh_perf_status()
 
             return True
         except Exception as ex:
@@ -1486,18 +2279,57 @@ class MainWnd():
 
 
 def process_cmdline(args):
-    if len(args) > 1:
-        return os.path.abspath(args[1])
+    """Разбор параметров командной строки.
+    Возвращает экземпляр argparse.Namespace с полями:
+        filename        - None или полный путь к файлу данных;
+        fastStart       - булевское значение, см. MainWnd.__init__();
+        startupProfile  - булевское значение, True, если нужно
+                          вывести в stderr статистику времени запуска
+                          (включается из wcperf.StartupProfiler,
+                          здесь - для справки и порядка);
+        memoryReport    - булевское значение, True, если вместо
+                          запуска UI нужно вывести отчёт о расходе
+                          памяти (см. wcmemreport.py)."""
+
+    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]),
+        description='%s - %s' % (TITLE_VERSION, SUB_TITLE))
+
+    parser.add_argument('filename', nargs='?', default=None,
+        help='файл списка (по умолчанию - %s в текущем каталоге)' % DEFAULT_FILENAME)
+    parser.add_argument('--fast-start', action='store_true', dest='fastStart',
+        help='создавать редактор товара, калькуляторы и прочие диалоги при первом обращении к ним')
+    parser.add_argument(startupProfiler.CMDLINE_OPTION, action='store_true', dest='startupProfile',
+        help='вывести в stderr продолжительность этапов запуска и импорта модулей')
+    parser.add_argument(MEMORY_REPORT_OPTION, action='store_true', dest='memoryReport',
+        help='не запуская UI, загрузить файл списка и вывести отчёт о расходе памяти')
+
+    opts = parser.parse_args(args[1:])
+
+    if opts.filename:
+        opts.filename = os.path.abspath(opts.filename)
     else:
         for wlfname in ('.',):# os.path.split(args[0])[0]):
             wlfname = os.path.join(os.path.abspath(wlfname), DEFAULT_FILENAME)
 
             if os.path.exists(wlfname):
-                return(wlfname)
+                opts.filename = wlfname
+                break
+
+    return opts
 
 
 def main(args):
-    MainWnd(process_cmdline(args)).main()
+    opts = process_cmdline(args)
+
+    if opts.memoryReport:
+        if not opts.filename:
+            print('Не указан файл списка', file=sys.stderr)
+            return 1
+
+        memory_report(filename=opts.filename)
+        return 0
+
+    MainWnd(opts.filename, opts.fastStart).main()
 
     return 0
 